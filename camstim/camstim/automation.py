@@ -57,7 +57,7 @@ class _BaseMouse(EObject):
 
     def lick(self, sensor_index=0):
         if self._lick_sensors:
-            self._lick_sensors[sensor_index].lickOccurred.emit()
+            self._lick_sensors[sensor_index].emit_lick()
 
 
 class PerfectDoCMouse(_BaseMouse):
@@ -19,6 +19,9 @@ import itertools
 import json
 #import shutil
 import zipfile
+import threading
+import Queue
+from timeit import default_timer
 from collections import OrderedDict
 
 import yaml
@@ -30,8 +33,11 @@ Signal = QtCore.Signal
 from misc import get_config, check_dirs, CAMSTIM_DIR, get_platform_info,\
     save_session, ImageStimNumpyuByte  # TODO:rename these??
 from experiment import EObject, Timetrials, Experiment, ETimer
+from frameloop import FrameLoop, VirtualClock
+from buffers import GrowableArray, ColumnLog, RingBuffer
 from lims import LimsInterface, LimsError, BehaviorTriggerFile
 from synchro import SyncPulse, SyncSquare
+from utils.output_tools import get_array_dir
 
 import logging
 
@@ -76,6 +82,8 @@ class BehaviorBase(EObject):
         self._update_timer = QtCore.QTimer()
         self._update_timer.timeout.connect(self.update)
         self._update_interval_ms = 1
+        self._frame_loop = None
+        self._virtual_clock = None
 
         logging.info("Initilized behavior.")
 
@@ -132,10 +140,11 @@ class BehaviorBase(EObject):
             return {}
 
     def start(self):
-        """ Starts the behavior session.  If configured to autoupdate, it begins
-            calling update at the specified interval.  Otherwise, it simply
-            starts all child objects. If session does not have a parent experiment,
-            it creates one.
+        """ Starts the behavior session.  If configured to autoupdate, it
+            is updated at the specified interval by a timer (or, if
+            `vsync_loop` is enabled, once per frame by a vsync-locked loop run
+            by the parent experiment).  Otherwise, it simply starts all child objects. If
+            session does not have a parent experiment, it creates one.
         """
         if not self._parent:
             self._parent = Experiment()
@@ -143,8 +152,22 @@ class BehaviorBase(EObject):
             self._parent.start()
         else:
             if self.auto_update:
-                self._update_timer.start(self._update_interval_ms)
+                cfg = self.config['behavior']
+                if cfg['vsync_loop'] and isinstance(self._parent, Experiment):
+                    self._frame_loop = FrameLoop(
+                        self.update,
+                        self._flip,
+                        process_events=self._parent.process_events,
+                        event_budget_ms=cfg['event_budget_ms'],
+                        fps=cfg['loop_fps'])
+                    self._parent.frame_loop = self._frame_loop
+                else:
+                    self._update_timer.start(self._update_interval_ms)
 
+            for e in self.encoders:
+                e.start()
+            for l in self.lick_sensors:
+                l.start()
             for item in self.items.values():
                 item.start()
 
@@ -166,6 +189,14 @@ class BehaviorBase(EObject):
             l.update(index)
         self.update_count += 1
 
+    def _flip(self):
+        """ Waits for the next frame.  No display here, so this uses a
+            virtual clock.
+        """
+        if not self._virtual_clock:
+            self._virtual_clock = VirtualClock(self.config['behavior']['loop_fps'])
+        self._virtual_clock.flip()
+
     def set_update_interval_ms(self, ms):
         self._update_interval_ms = ms
         logging.info("Update interval set to %s ms" % ms)
@@ -216,6 +247,9 @@ class BehaviorBase(EObject):
         #get any tasks passed in
         tasks = self.nidaq_tasks
 
+        # the encoder can read the AI task from its acquisition thread
+        self.ai_lock = threading.Lock()
+
         try:
             if not tasks.get('analog_input', None):
                 from toolbox.IO.nidaq import AnalogInput
@@ -248,8 +282,15 @@ class BehaviorBase(EObject):
 
     def close(self):
         self._update_timer.stop()
+        if self._frame_loop:
+            self._frame_loop.stop()
+        for e in self.encoders:
+            e.close()
+        for l in self.lick_sensors:
+            l.close()
         if self.ai:
-            self.ai.clear()
+            with self.ai_lock:
+                self.ai.clear()
             self.ai = str(self.ai)
         if self.ao:
             self.ao.clear()
@@ -368,16 +409,25 @@ class Behavior(BehaviorBase):
         if self.sync_sqr:
             self.sync_sqr.update(index)
 
-        if self.auto_update:
+        if self.auto_update and not self._frame_loop:
+            # timer driven, flip here
             if self.window:
-                if self.frame_pulse:
-                    self.frame_pulse.set_high()
-                self.window.flip()
-                if self.frame_pulse:
-                    self.frame_pulse.set_low()
+                self._flip()
 
         self._check_keys()
 
+    def _flip(self):
+        """ Flips the window, with a frame pulse if configured.  Uses a virtual
+            clock if there is no window.
+        """
+        if not self.window:
+            return super(Behavior, self)._flip()
+        if self.frame_pulse:
+            self.frame_pulse.set_high()
+        self.window.flip()
+        if self.frame_pulse:
+            self.frame_pulse.set_low()
+
     def _splash(self):
         """ Grey splash screen if we have sync square.
         """
@@ -476,10 +526,10 @@ class Behavior(BehaviorBase):
             - update config names
 
         """
+        cfg = self.config['encoder'] = self.load_config('Encoder',
+                                                        override=self.params)
         try:
             from toolbox.Encoders import AnalogEncoder
-            self.config['encoder'] = self.load_config('Encoder',
-                                                      override=self.params)
 
             nidevice = self.config['encoder']['nidevice']
             vin = self.config['encoder']['encodervinchannel']
@@ -494,7 +544,11 @@ class Behavior(BehaviorBase):
                                     task=self.ai,
                                     )
 
-            self.add_encoder(BehaviorEncoder(encoder))
+            self.add_encoder(BehaviorEncoder(
+                encoder,
+                acquisition_thread=cfg['acquisition_thread'],
+                sample_rate=cfg['sample_rate'],
+                lock=self.ai_lock))
 
         except ImportError as e:
             encoder = None
@@ -506,9 +560,13 @@ class Behavior(BehaviorBase):
         if not encoder:
             #logging.warning("Switching to keyboard control.")
             try:
-                encoder = KeyboardEncoder(self.window)
+                encoder = SimulatedEncoder(self.window,
+                                           speed=cfg['simulated_speed'])
 
-                self.add_encoder(BehaviorEncoder(encoder))
+                self.add_encoder(BehaviorEncoder(
+                    encoder,
+                    acquisition_thread=cfg['acquisition_thread'],
+                    sample_rate=cfg['sample_rate']))
             except Exception as e:
                 logging.warning("Couldn't create keyboard encoder: %s" % e)
 
@@ -600,11 +658,17 @@ class Behavior(BehaviorBase):
 
             except Exception as e:
                 logging.warning("Failed to initialize a hardware lick sensor: %s" % e)
-                ls = KeyboardLickSensor(self.window, hotkey=str(i))
+                if cfg['simulated_lick_rate']:
+                    ls = SimulatedLickSensor(rate=cfg['simulated_lick_rate'])
+                    logging.info("Simulated lick sensor added: %s" % i)
+                else:
+                    ls = KeyboardLickSensor(self.window, hotkey=str(i))
+                    logging.info("Keyboard lick sensor added: %s" % i)
                 lick_sensors.append(ls)
-                logging.info("Keyboard lick sensor added: %s" % i)
 
         for l in lick_sensors:
+            if cfg['poll_rate']:
+                l.set_polling(cfg['poll_rate'])
             self.add_lick_sensor(l)
 
     def _datastream_setup(self):
@@ -723,7 +787,7 @@ class VisualObject(EObject):
         self.correct_freq = 0.5
         self.fps = 60.0
         self.flash_interval_sec = None
-        self.draw_log = []
+        self.draw_log = GrowableArray(np.uint8)
 
         self.param_names = None
         self.possibility_table = None
@@ -733,7 +797,8 @@ class VisualObject(EObject):
         self.sequence = None
 
         self.update_count = 0
-        self.log = []  #keeps track of all stimulus changes
+        #keeps track of all stimulus changes
+        self.log = ColumnLog([("values", object), ("frame", np.int64)])
 
         self.on_draw = {}
 
@@ -991,6 +1056,8 @@ class VisualObject(EObject):
 
     def package(self):
         self.stimulus = str(self.stimulus.__dict__)
+        self.draw_log = self.draw_log.to_array()
+        self.log = self.log.rows()
         return super(VisualObject, self).package()
 
 ForagingObject = VisualObject  # backwards compatibility
@@ -1948,16 +2015,30 @@ class BehaviorEncoder(EObject):
     Encoder wrapper designed for behavior.  Saves position / voltage
         information every time it is updated.
 
+    If `acquisition_thread` is set, the encoder is sampled at `sample_rate`
+        on a background thread (see `EncoderThread`), and each update uses the
+        rotation summed over all samples since the last update.  The number
+        of samples in each update is saved in `samples`.
+
+    All encoder reads hold `lock`.  Pass the lock of the NIDAQ task that the
+        encoder reads from if anything else uses that task.
+
+    Keyboard and simulated encoders read their key state on the main thread,
+        in `update`.
+
     TODO: Find the proper place for this.
 
     """
-    def __init__(self, encoder, gain=1.0):
+    def __init__(self, encoder, gain=1.0, acquisition_thread=False,
+                 sample_rate=1000.0, lock=None):
         super(BehaviorEncoder, self).__init__()
         self._encoder = encoder
         self.gain = gain
+        self._lock = lock or threading.Lock()
 
         for i in range(10):
-            self._last_deg = self._encoder.get_degrees()
+            with self._lock:
+                self._last_deg = self._encoder.get_degrees()
             if self._last_deg is None:
                 time.sleep(0.1)
             else:
@@ -1968,7 +2049,7 @@ class BehaviorEncoder(EObject):
 
         self._last_dx = 0.0
 
-        self.dx = []
+        self.dx = GrowableArray(np.float32)
         self._dx = 0
 
         #should we really keep these?
@@ -1977,12 +2058,33 @@ class BehaviorEncoder(EObject):
 
         self.value = self._last_deg
 
+        if acquisition_thread:
+            self._thread = EncoderThread(encoder, sample_rate, self._last_deg,
+                                         lock=self._lock)
+            self.samples = GrowableArray(np.uint16)
+        else:
+            self._thread = None
+
+    def start(self):
+        if self._thread:
+            self._thread.start()
+
+    def close(self):
+        if self._thread:
+            self._thread.stop()
+            self.dropped_samples = self._thread.dropped
+
     def get_dx(self):
         """
         Returns the degree rotation since last call to get_dx.
         """
-        deg = self._encoder.get_degrees()
-        vin = self._encoder.get_vin()
+        if self._thread:
+            samples = self._thread.read()
+            self.samples.append(min(len(samples), 65535))
+            return samples.sum()
+        with self._lock:
+            deg = self._encoder.get_degrees()
+            vin = self._encoder.get_vin()
         #vsig = self._encoder.get_vsig()
         #print vin, vsig, deg
         #cover for some weird nidaq errors
@@ -1997,6 +2099,8 @@ class BehaviorEncoder(EObject):
         return dx
 
     def update(self, index=0):
+        if isinstance(self._encoder, KeyboardEncoder):
+            self._encoder.update_keys()  # pyglet state, main thread only
         dx = self.get_dx()
         if 180 > dx > -180:  # encoder hasn't looped
             self.value = dx*self.gain
@@ -2010,9 +2114,87 @@ class BehaviorEncoder(EObject):
 
     def package(self):
         self._encoder = str(self._encoder)
-        self.dx = np.array(self.dx, dtype=np.float32)
+        self.dx = self.dx.to_array()
+        if self._thread:
+            self.samples = self.samples.to_array()
         return super(BehaviorEncoder, self).package()
 
+
+class EncoderThread(object):
+    """
+    Samples an encoder on a background thread and passes the rotation of each
+        sample to the main thread through a `RingBuffer`.
+
+    Glitches are handled per sample, like `BehaviorEncoder` does per update:
+        samples with a bad vin repeat the last rotation, and samples where the
+        encoder looped repeat the last good rotation.
+
+    args:
+        encoder: encoder with `get_degrees` and `get_vin`.
+        sample_rate (float): samples per second.
+        initial_degrees (float): starting encoder value.
+        size (int): ring buffer size in samples.
+        lock (threading.Lock): held for each read of the encoder.
+
+    """
+    def __init__(self, encoder, sample_rate=1000.0, initial_degrees=0.0,
+                 size=8192, lock=None):
+        self._encoder = encoder
+        self._lock = lock or threading.Lock()
+        self.sample_rate = float(sample_rate)
+        self._last_deg = initial_degrees
+        self._last_dx = 0.0
+        self._ring = RingBuffer(size, np.float64)
+        self._stop = threading.Event()
+        self._thread = None
+
+    @property
+    def dropped(self):
+        return self._ring.dropped
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread:
+            self._thread.join(1.0)
+
+    def _run(self):
+        period = 1.0 / self.sample_rate
+        next_sample = default_timer()
+        while not self._stop.is_set():
+            self._ring.write(self._sample())
+            next_sample += period
+            remaining = next_sample - default_timer()
+            if remaining > 0:
+                time.sleep(remaining)
+            else:
+                next_sample = default_timer()  # fell behind, don't burst
+
+    def _sample(self):
+        with self._lock:
+            deg = self._encoder.get_degrees()
+            vin = self._encoder.get_vin()
+        if (6 > vin > 4) & (deg is not None):
+            dx = deg - self._last_deg
+            self._last_deg = deg
+        else:
+            dx = self._last_dx
+            self._last_deg += dx
+        if not 180 > dx > -180:  # encoder looped
+            dx = self._last_dx
+        self._last_dx = dx
+        return dx
+
+    def read(self):
+        """
+        Returns the rotation of each sample since the last read.
+        """
+        return self._ring.read()
+
 class _BaseReward(EObject):
     """
     Base class for rewards.  Used for both keyboard and NIDAQ based rewards.
@@ -2145,35 +2327,93 @@ class KeyboardReward(_BaseReward):
 class _BaseLickSensor(EObject):
     """ Base class for lick sensors. Used by both NIDAQ and keyboard lick
             sensors.
+
+    By default the sensor is read once per update.  If `poll_rate` is set
+        (see `set_polling`) it is instead read on a background thread by a
+        `LickPoller`, and licks are timed to the poll that saw them rather
+        than to the update.
+
+    `lickOccurred` sends the (time.clock(), frame) of each lick, which is
+        also kept in `last_lick`.
     """
-    lickOccurred = QtCore.Signal()
+    lickOccurred = QtCore.Signal(tuple)
 
     def __init__(self):
         super(_BaseLickSensor, self).__init__()
 
-        self.lick_data = []
+        self.lick_data = GrowableArray(np.uint8)
         self.lick_events = []
+        self.lick_times = GrowableArray(np.float64)
+        self.last_lick = (0.0, 0)  # (time.clock(), frame)
+        self.poll_rate = None
 
         self._events_since_last_packet = []
         self._last_value = 0
+        self._frame = 0
+        self._poller = None
 
     def test(self):
         return True
 
+    def set_polling(self, poll_rate):
+        """ Reads the sensor `poll_rate` times per second on a background
+            thread once started.
+        """
+        self.poll_rate = poll_rate
+
+    def start(self):
+        if self.poll_rate:
+            self._poller = LickPoller(self.read, self.poll_rate)
+            self._poller.frame = self._frame
+            self._poller.start()
+
+    def close(self):
+        if self._poller:
+            self._poller.stop()
+
     def update(self, index=None):
         """
         Updates the data, emits signal if lick occurred.
         """
-        data = self.read()
-        self.lick_data.append(data)
+        self._frame = index
+        if self._poller:
+            self._poller.frame = index
+            data = self._poller.value()
+            edges = self._poller.edges()
+        else:
+            data = self.read()
+            if data > self._last_value:
+                edges = [(time.clock(), index)]
+            else:
+                edges = []
 
-        if data > self._last_value:
-            self.lick_events.append(index)
-            self._events_since_last_packet.append(index)
-            self.lickOccurred.emit()
+        self.lick_data.append(data)
+        for t, frame in edges:
+            self.emit_lick(t, frame)
 
         self._last_value = data
 
+    def flush(self):
+        """ Emits any licks the poller has seen since the last update.  Lets
+            a task account for them before making a time critical decision.
+        """
+        if self._poller:
+            for t, frame in self._poller.edges():
+                self.emit_lick(t, frame)
+
+    def emit_lick(self, t=None, frame=None):
+        """ Records a lick and emits `lickOccurred`.
+        """
+        if t is None:
+            t = time.clock()
+        if frame is None:
+            frame = self._frame
+        self.last_lick = (t, frame)
+        self.lick_times.append(t)
+        self.lick_events.append(frame)
+        self._events_since_last_packet.append(frame)
+        self.lickOccurred.emit(self.last_lick)
+
     def read(self):
         """
         Returns the current value of the lick sensor.
@@ -2188,10 +2428,81 @@ class _BaseLickSensor(EObject):
         return events
 
     def package(self):
-        self.lick_data = np.where(np.array(self.lick_data, dtype=np.uint8) > 0)
+        self.lick_data = np.where(self.lick_data.to_array() > 0)
+        self.lick_times = self.lick_times.to_array()
         return super(_BaseLickSensor, self).package()
 
 
+class LickPoller(object):
+    """
+    Polls a lick line on a background thread.  Rising edges are queued with
+        their `time.clock()` time and the frame they happened in, which is
+        set by the main thread through `frame`.
+
+    args:
+        read (callable): returns the current value of the line.
+        poll_rate (float): reads per second.
+
+    """
+    def __init__(self, read, poll_rate=1000.0):
+        self._read = read
+        self.poll_rate = float(poll_rate)
+        self.frame = 0
+        self._edges = Queue.Queue()
+        self._value = 0
+        self._high_count = 0  # polls that saw the line high
+        self._high_seen = 0  # `_high_count` at the last `value` call
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread:
+            self._thread.join(1.0)
+
+    def _run(self):
+        period = 1.0 / self.poll_rate
+        next_poll = default_timer()
+        last = 0
+        while not self._stop.is_set():
+            value = self._read()
+            if value > last:
+                self._edges.put((time.clock(), self.frame))
+            if value:
+                self._high_count += 1
+            self._value = value
+            last = value
+            next_poll += period
+            remaining = next_poll - default_timer()
+            if remaining > 0:
+                time.sleep(remaining)
+            else:
+                next_poll = default_timer()
+
+    def value(self):
+        """ Returns 1 if the line was high at any poll since the last call,
+            so licks shorter than a frame are still logged.
+        """
+        count = self._high_count
+        high = count != self._high_seen or self._value
+        self._high_seen = count
+        return 1 if high else 0
+
+    def edges(self):
+        """ Returns the queued (time, frame) rising edges. """
+        edges = []
+        while True:
+            try:
+                edges.append(self._edges.get_nowait())
+            except Queue.Empty:
+                return edges
+
+
 class BehaviorLickSensor(_BaseLickSensor):
     """
     NIDAQ-based lick sensor.
@@ -2262,6 +2573,45 @@ class KeyboardLickSensor(_BaseLickSensor):
             return 0
 
 
+class SimulatedLickSensor(_BaseLickSensor):
+    """
+    Simulated lick line.  Licks start at random (a Poisson process) and
+        hold the line high for `lick_ms`.  Call `lick` to start one now.
+
+    args:
+        rate (float): mean licks per second.
+        lick_ms (float): duration of each lick.
+        seed (int): random seed.
+
+    """
+    def __init__(self, rate=0.0, lick_ms=30.0, seed=None):
+        super(SimulatedLickSensor, self).__init__()
+        self.rate = rate
+        self.lick_ms = lick_ms
+        self._rng = np.random.RandomState(seed)
+        self._lick_start = None
+        self._next_lick = self._draw_next(default_timer())
+
+    def _draw_next(self, t):
+        if self.rate > 0:
+            return t + self._rng.exponential(1.0 / self.rate)
+        return None
+
+    def lick(self):
+        """ Starts a lick now. """
+        self._lick_start = default_timer()
+
+    def read(self):
+        t = default_timer()
+        if self._next_lick is not None and t >= self._next_lick:
+            self._lick_start = self._next_lick
+            self._next_lick = self._draw_next(t)
+        if self._lick_start is not None and \
+                t - self._lick_start < self.lick_ms / 1000.0:
+            return 1
+        return 0
+
+
 class KeyboardEncoder(object):
     """
     Uses keystrokes in specified window to simulate an encoder.
@@ -2274,11 +2624,19 @@ class KeyboardEncoder(object):
 
         self._window = window
         self.current_value = 0.0
+        self.key_state = 0
 
         self._keys = key.KeyStateHandler()
         if self._window:
             self._window.winHandle.push_handlers(self._keys)
 
+    def update_keys(self):
+        """
+        Reads the key state into `key_state`.  Pyglet isn't thread safe, so
+            this has to be called from the main thread.
+        """
+        self.key_state = self._check_keys()
+
     def get_degrees(self):
         #check keys
         #self.window.winHandle.dispatch_events()  #only necessary if we aren't flipping window
@@ -2302,6 +2660,41 @@ class KeyboardEncoder(object):
             return 0
 
 
+class SimulatedEncoder(KeyboardEncoder):
+    """
+    Simulated encoder that turns at a constant speed, with optional noise,
+        plus keyboard input if there is a window.  Unlike `KeyboardEncoder`
+        its value depends on elapsed time, not on how often it is read, so
+        it can be sampled at any rate.  Keys are read by `update_keys`, so
+        `get_degrees` can be called from an acquisition thread.
+
+    args:
+        window (psychopy.visual.Window): window for keyboard input.
+        speed (float): rotation in degrees per second.
+        noise (float): s.d. of the noise added to each read, in degrees.
+        key_speed (float): rotation in degrees per second while a key is held.
+        seed (int): seed for the noise.
+
+    """
+    def __init__(self, window=None, speed=0.0, noise=0.0, key_speed=60.0,
+                 seed=None):
+        super(SimulatedEncoder, self).__init__(window)
+        self.speed = speed
+        self.noise = noise
+        self.key_speed = key_speed
+        self._rng = np.random.RandomState(seed)
+        self._last_time = default_timer()
+
+    def get_degrees(self):
+        now = default_timer()
+        dt = now - self._last_time
+        self._last_time = now
+        self.current_value += (self.speed + self.key_state*self.key_speed)*dt
+        if self.noise:
+            self.current_value += self._rng.normal(0.0, self.noise)
+        return self.current_value
+
+
 class DummyPsycopyStimulus(object):
     def __init__(self, *args, **kwargs):
         self.pos = (0, 0)
@@ -2370,6 +2763,11 @@ class LimsBehaviorUpload(object):
             zf = zipfile.ZipFile(zip_destination, 'w',
                                  compression=zipfile.ZIP_DEFLATED)  # zipped
             zf.write(pickle_path, os.path.basename(pickle_path))
+            array_dir = get_array_dir(pickle_path)  # sidecar arrays
+            if os.path.isdir(array_dir):
+                for filename in sorted(os.listdir(array_dir)):
+                    zf.write(os.path.join(array_dir, filename),
+                             "/".join([os.path.basename(array_dir), filename]))
             zf.close()
         except IOError as e:
             import traceback; traceback.print_exc()
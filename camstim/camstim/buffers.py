@@ -0,0 +1,178 @@
+"""
+buffers.py
+
+Growable typed buffers for per-frame data logs.
+
+"""
+import numpy as np
+
+
+class GrowableArray(object):
+    """
+    Append-only 1D array of a fixed dtype.  Values are written into
+        preallocated chunks, so appending never copies earlier data.
+
+    `to_array` returns the contents as a numpy array.  If the data spans
+        several chunks they are merged once, into a single buffer with room
+        to keep growing, so exporting repeatedly is a view until the next
+        chunk is started.  The returned array is a view of the buffer, copy
+        it if you need to modify it.
+
+    args:
+        dtype (numpy.dtype): dtype of the values.
+        chunk_size (int): number of values per chunk.
+
+    """
+    def __init__(self, dtype=np.float64, chunk_size=4096):
+        self.dtype = np.dtype(dtype)
+        self.chunk_size = chunk_size
+        self._chunks = []  # full chunks
+        self._current = np.empty(chunk_size, dtype=self.dtype)
+        self._n = 0  # values in `_current`
+        self._length = 0
+
+    def append(self, value):
+        if self._n == len(self._current):
+            self._chunks.append(self._current)
+            self._current = np.empty(self.chunk_size, dtype=self.dtype)
+            self._n = 0
+        self._current[self._n] = value
+        self._n += 1
+        self._length += 1
+
+    def extend(self, values):
+        for value in values:
+            self.append(value)
+
+    def __len__(self):
+        return self._length
+
+    def tail(self, n):
+        """
+        Returns a copy of the last `n` values.
+        """
+        n = min(n, self._length)
+        if n <= self._n:
+            return self._current[self._n-n:self._n].copy()
+        parts = [self._current[:self._n]]
+        remaining = n - self._n
+        for chunk in reversed(self._chunks):
+            if remaining <= 0:
+                break
+            parts.insert(0, chunk[max(len(chunk)-remaining, 0):])
+            remaining -= len(chunk)
+        return np.concatenate(parts)
+
+    def to_array(self):
+        """
+        Returns all values as a numpy array (see class docstring).
+        """
+        if self._chunks:
+            merged = np.empty(self._length + self.chunk_size, dtype=self.dtype)
+            offset = 0
+            for chunk in self._chunks + [self._current[:self._n]]:
+                merged[offset:offset+len(chunk)] = chunk
+                offset += len(chunk)
+            self._chunks = []
+            self._current = merged
+            self._n = self._length
+        return self._current[:self._n]
+
+    def __array__(self, dtype=None):
+        array = self.to_array()
+        if dtype is not None:
+            return array.astype(dtype)
+        return array
+
+    def __getitem__(self, key):
+        return self.to_array()[key]
+
+    def __iter__(self):
+        return iter(self.to_array())
+
+
+class ColumnLog(object):
+    """
+    Append-only table with one `GrowableArray` per column.  Used for logs
+        that get a row per event, like stimulus changes.
+
+    Ex:
+        log = ColumnLog([("value", object), ("frame", np.int32)])
+        log.append(("gratings_0", 10))
+
+    args:
+        columns (list): (name, dtype) for each column.
+        chunk_size (int): rows per chunk.
+
+    """
+    def __init__(self, columns, chunk_size=256):
+        self.names = [name for name, _ in columns]
+        self.columns = [GrowableArray(dtype, chunk_size) for _, dtype in
+                        columns]
+
+    def append(self, row):
+        for column, value in zip(self.columns, row):
+            column.append(value)
+
+    def __len__(self):
+        return len(self.columns[0])
+
+    def to_arrays(self):
+        """
+        Returns a dictionary of numpy arrays, one per column.
+        """
+        return {name: column.to_array() for name, column in
+                zip(self.names, self.columns)}
+
+    def rows(self):
+        """
+        Returns the log as a list of row tuples.
+        """
+        return zip(*[column.to_array().tolist() for column in self.columns])
+
+
+class RingBuffer(object):
+    """
+    Fixed size ring buffer for passing samples from one producer thread to
+        one consumer thread without locking.  The producer only advances the
+        write count and the consumer only advances the read count.
+
+    If the consumer falls more than `size` samples behind, the oldest samples
+        are lost and counted in `dropped`.
+
+    args:
+        size (int): number of samples held.
+        dtype (numpy.dtype): sample dtype.
+
+    """
+    def __init__(self, size=8192, dtype=np.float64):
+        self.size = size
+        self._data = np.zeros(size, dtype=dtype)
+        self._written = 0
+        self._read = 0
+        self.dropped = 0
+
+    def write(self, value):
+        """
+        Adds a sample.  Producer thread only.
+        """
+        self._data[self._written % self.size] = value
+        self._written += 1
+
+    def read(self):
+        """
+        Returns a copy of all samples written since the last read.  Consumer
+            thread only.
+        """
+        written = self._written
+        start = self._read
+        if written - start > self.size:
+            self.dropped += written - start - self.size
+            start = written - self.size
+        self._read = written
+        if written == start:
+            return self._data[:0].copy()
+        i, j = start % self.size, written % self.size
+        if i < j:
+            return self._data[i:j].copy()
+        return np.concatenate((self._data[i:], self._data[:j]))
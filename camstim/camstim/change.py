@@ -13,8 +13,6 @@ import io
 import random
 import itertools
 import json
-import pickle
-import zipfile
 import string
 from collections import OrderedDict
 
@@ -30,6 +28,9 @@ from .misc import get_config, check_dirs, CAMSTIM_DIR, get_platform_info,\
 from .experiment import EObject, Timetrials, Experiment, ETimer
 from .lims import LimsInterface, LimsError, BehaviorTriggerFile
 from .translator import TrialTranslator
+from .buffers import ColumnLog
+from .images import ImageSetCache, read_image_set
+from .zro.telemetry import TelemetrySender
 
 import logging
 
@@ -90,6 +91,7 @@ class DoCTask(Task):
         self._setup_default_epochs()
         self._setup_safety_timer()
         self._setup_remote_interface()
+        self._setup_trial_publisher()
 
 
     def _setup_default_epochs(self):
@@ -167,6 +169,16 @@ class DoCTask(Task):
             self._trial_translator = None
             logging.warning("Failed to create remote interface: {}".format(e))
 
+    def _setup_trial_publisher(self):
+        """ Trials are translated, published and logged on a background
+            thread so that a slow subscriber or log handler can't delay the
+            next trial.
+        """
+        self._trial_publisher = TelemetrySender(
+            self._publish_trial,
+            max_queued=self._doc_config['trial_queue_size'])
+        self._trial_publisher.start()
+
     def _safety_timer_start(self):
         st_dur = self._doc_config["safety_timer_padding"] + \
             self.expected_trial_duration
@@ -196,13 +208,22 @@ class DoCTask(Task):
         epoch.epochEnded.connect(self._epoch_ended)
         self._epochs.append(epoch)
 
-    def _lick_event(self):
+    def _lick_event(self, lick):
         # send lick even to all active epochs
-        t = time.clock()
+        t, frame = lick
+        if frame is None:
+            frame = self.update_count
         self._last_lick = t
-        self._trial_licks.append((t, self.update_count))
+        self._trial_licks.append((t, frame))
         for epoch in self._active_epochs:
-            epoch._lick_event()
+            epoch._lick_event(t)
+
+    def _flush_licks(self):
+        """ Handles licks seen by polled lick sensors since the last
+            update.
+        """
+        for sensor in self.lick_sensors:
+            sensor.flush()
 
     def _next_trial(self):
         """ Called to initial the next trial. """
@@ -415,16 +436,23 @@ class DoCTask(Task):
         }
         self._current_trial_data.update(trial_data)
         self.trial_log.append(self._current_trial_data)
+        self._trial_publisher.put((trial_data, self._current_trial_data))
+        self._clear_trial_data()
+
+    def _publish_trial(self, trial):
+        """ Publishes and logs a (trial_data, full_trial_data) pair.  Runs on
+            the trial publisher thread.
+        """
+        trial_data, full_trial_data = trial
         if self._remote_interface:
             #### Remove translation after OAG update
             if self._trial_translator:
-                trial_data = self._trial_translator.translate_trial(self._current_trial_data)
+                trial_data = self._trial_translator.translate_trial(full_trial_data)
                 logging.debug("Trial translated.")
             ######################################## 
             self._remote_interface.publish(trial_data)
             logging.debug("Published trial to sink.")
-        logging.info("Trial data: {}".format(self._current_trial_data))
-        self._clear_trial_data()
+        logging.info("Trial data: %s", full_trial_data)
 
     def _clear_trial_data(self):
         self._event_log = []
@@ -477,10 +505,15 @@ class DoCTask(Task):
         level("{} - {}".format(self.update_count, message))
 
     def _close(self):
+        # the footer goes out on the publisher thread, after the last trials
+        self._trial_publisher.stop(last=self._publish_footer)
+        super(DoCTask, self)._close()
+
+    def _publish_footer(self):
+        """ Publishes the footer.  Runs on the trial publisher thread. """
         if self._remote_interface:
             logging.info("PUBLISHING FOOTER")
             self._remote_interface.publish_footer()
-        super(DoCTask, self)._close()
 
 
 ########################################################
@@ -490,12 +523,12 @@ class DoCTask(Task):
 
 class DoCEpoch(Epoch):
     """ A DoC Epoch.  Handles lick events from Task. """
-    def _lick_event(self):
+    def _lick_event(self, t=None):
         pass
 
 class DoCNoStimEpoch(DoCEpoch):
     """ DoC Epoch that disables stimulus flashing. """
-    def _lick_event(self):
+    def _lick_event(self, t=None):
         self._task._early_response()
 
     def _on_entry(self):
@@ -523,7 +556,9 @@ class DoCResponseWindow(DoCEpoch):
         else:
             self._rewarded = False
 
-    def _lick_event(self):
+    def _lick_event(self, t=None):
+        if t is not None and self.entries and t < self.entries[-1]:
+            return  # lick happened before the window opened
         if self._task._in_catch_trial:
             if not self._false_alarm:
                 self._false_alarm = True
@@ -535,6 +570,13 @@ class DoCResponseWindow(DoCEpoch):
                     self._available = False
                     self._rewarded = True
 
+    def exit(self):
+        """ Licks polled since the last update may still fall inside the
+            window, so they are handled before it closes.
+        """
+        self._task._flush_licks()
+        super(DoCResponseWindow, self).exit()
+
     def _on_exit(self):
         self._available = False
         if not self._task._in_catch_trial:
@@ -573,7 +615,7 @@ class DoCStimulusWindow(DoCEpoch):
     def _change_handler(self):
         self._after_change = True
 
-    def _lick_event(self):
+    def _lick_event(self, t=None):
         if not self._after_change:
             self._task._early_response()
         else:
@@ -587,11 +629,11 @@ class DoCStimulusWindow(DoCEpoch):
         self._task.check_for_completion()
 
 class DoCMinPrechange(DoCEpoch):
-    def _lick_event(self):
+    def _lick_event(self, t=None):
         self._task._early_response()
 
 class DoCMinNoLickEpoch(DoCEpoch):
-    def _lick_event(self):
+    def _lick_event(self, t=None):
         """ Any lick event should reset the timer. """
         self.reset()
 
@@ -614,7 +656,7 @@ class DoCMinNoLickEpoch(DoCEpoch):
         self._task.check_for_completion()
 
 class DoCTimeoutEpoch(DoCEpoch):
-    def _lick_event(self):
+    def _lick_event(self, t=None):
         self.reset()
 
     def _on_exit(self):
@@ -792,7 +834,8 @@ class DoCStimulus(VisualObject):
         self._scheduled_on_change = []
 
         self._change_log = []
-        self._tweak_log = []
+        self._tweak_log = ColumnLog([("value", object), ("frame", np.int64),
+                                     ("time", np.float64)])
 
     @property
     def tweak_on_flash(self):
@@ -990,6 +1033,12 @@ class DoCImageStimulus(DoCStimulus):
 
     OR a path to pickled data of this shape.
 
+    Image sets and sampling matrices loaded from a path are converted to
+        memory-mapped arrays in `cache_dir` (see `images.ImageSetCache`), so
+        later runs, and other task processes on the same machine, load them
+        without unpickling or copying.  Use cache_dir=False to read them
+        directly.
+
     #TODO: refactor to remove any duplication with DoCStimulus
     """
     def __init__(self,
@@ -1000,6 +1049,7 @@ class DoCImageStimulus(DoCStimulus):
                  pos=(0,0),
                  size=None,
                  units="pix",
+                 cache_dir=None,
                  **kwargs
                  ):
         self.pos = pos
@@ -1007,6 +1057,10 @@ class DoCImageStimulus(DoCStimulus):
         self.units = units
         self.sampling = sampling
         self.sequence = sequence
+
+        if cache_dir is None:
+            cache_dir = os.path.join(CAMSTIM_DIR, "image_cache", "image_sets")
+        self._cache = ImageSetCache(cache_dir) if cache_dir else None
         
         self._window = window
 
@@ -1051,16 +1105,10 @@ class DoCImageStimulus(DoCStimulus):
         """
         if isinstance(image_set, str):
             self.image_path = image_set
-            if image_set.endswith(".zip"):
-                # image data is zipped
-                with zipfile.ZipFile(image_set, 'r') as myzip:
-                    inner_path = image_set.replace(".zip", ".pkl")
-                    with myzip.open(os.path.basename(inner_path)) as f:
-                        self._image_set = pickle.load(f)
+            if self._cache:
+                self._image_set = self._cache.get_image_set(image_set)
             else:
-                # not zipped
-                with open(image_set, 'rb') as f:
-                    self._image_set = pickle.load(f)
+                self._image_set = read_image_set(image_set)
             for group_name, group in self._image_set.items():
                 images = group.items()
                 self.add_stimulus_group(group_name, images)
@@ -1068,7 +1116,11 @@ class DoCImageStimulus(DoCStimulus):
             # TODO: fix hard-coded path here.  where should this live?
             num_groups = len(list(self._image_set.items()))
             path = self.sequence or "//allen/aibs/mpe/Software/stimulus_files/sequences/paths_for_even_matrix_sampling_n={}.csv".format(num_groups)
-            self.sampling_matrix = np.loadtxt(path, delimiter=",", dtype='|S2')
+            if self._cache:
+                self.sampling_matrix = self._cache.get_sampling_matrix(path)
+            else:
+                self.sampling_matrix = np.loadtxt(path, delimiter=",",
+                                                  dtype='|S2')
             self._category_codes = [string.ascii_lowercase[n] for n in range(num_groups)]
             self._select_image_walk()
             #import pdb;pdb.set_trace()
@@ -1084,6 +1136,9 @@ class DoCImageStimulus(DoCStimulus):
         super(DoCImageStimulus, self).add_stimulus_group(group_name, "Image", images)
         if not self._initialized:
             self._initialize()
+        if hasattr(self.stimulus, "preload"):
+            # a change only rebinds the new image's texture
+            self.stimulus.preload([image for _, image in images])
 
     def set_stim_param(self, param, value):
         """ Sets the parameter to a specified value. """
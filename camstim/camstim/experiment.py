@@ -15,7 +15,9 @@ from collections import OrderedDict
 
 from qtpy import QtCore
 
-from misc import getPlatformInfo, printHeader, save_session, CAMSTIM_DIR
+from misc import getPlatformInfo, printHeader, save_session, CAMSTIM_DIR, \
+    wecanpicklethat, PickleSerializer
+from utils.output_tools import get_array_dir
 
 if "Windows" in platform.system():
     try:
@@ -64,14 +66,22 @@ class Experiment(QtCore.QObject):
         self.threads = []
         self._qthreads = []
 
+        # save large arrays out of band, or as an indexed container
+        #   (see OutputFile)
+        self.sidecar_arrays = False
+        self.indexed_output = False
+
+        # vsync-locked loop to run instead of the Qt event loop (see FrameLoop)
+        self.frame_loop = None
+
         self._app = QtCore.QCoreApplication(sys.argv)
         self.closed.connect(self._app.quit)
         signal.signal(signal.SIGINT, self.exit_handler)
 
-        # Signal timer lets python handle signals like CRTL+C
+        # Signal timer lets python handle signals like CRTL+C.  Only needed
+        #   when running the Qt event loop.
         self._signal_timer = QtCore.QTimer()
         self._signal_timer.timeout.connect(lambda: None)
-        self._signal_timer.start(100)
 
     def add_item(self, item, name=""):
         """
@@ -105,7 +115,18 @@ class Experiment(QtCore.QObject):
             QtCore.QTimer.singleShot(1, thread.run)
         self.started.emit()
 
-        sys.exit(self._app.exec_())
+        if self.frame_loop:
+            # an item wants to be updated every frame
+            self.closed.connect(self.frame_loop.stop)
+            self.frame_loop.run()
+            sys.exit(0)
+        else:
+            self._signal_timer.start(100)
+            sys.exit(self._app.exec_())
+
+    def process_events(self, budget_ms):
+        """ Processes pending Qt events for at most `budget_ms`. """
+        self._app.processEvents(QtCore.QEventLoop.AllEvents, int(budget_ms))
 
     def update(self):
         #is this necessary?
@@ -116,7 +137,8 @@ class Experiment(QtCore.QObject):
             output file.
         """
         self.stop_time = datetime.datetime.now()
-        self._output_file = OutputFile()
+        self._output_file = OutputFile(sidecar_arrays=self.sidecar_arrays,
+                                       indexed=self.indexed_output)
 
         for item in self.items.values():
             item.close()
@@ -129,6 +151,8 @@ class Experiment(QtCore.QObject):
         self.closed.emit()
 
         self.items = OrderedDict({k: v.package() for k, v in self.items.iteritems()})
+        if self.frame_loop:
+            self.frame_loop = self.frame_loop.package()
 
         #_ = [pprint.pprint(item) for item in wecanpicklethat(self.__dict__).items()]
         self._output_file.add_data(self.__dict__)
@@ -340,21 +364,41 @@ class OutputFile(QtCore.QObject):
     """
     Docstring for OutputFile
 
+    Args:
+        path (Optional[str]): output file path.
+        output (Optional[dict]): initial output data.
+        sidecar_arrays (Optional[bool]): save large arrays out of band as .npy
+            files in a "<name>_arrays" folder next to the output file.  Load
+            with `camstim.utils.output_tools.load_output`.
+        indexed (Optional[bool]): save an indexed container, with each top
+            level key and each stimulus as a separate record.  Single keys
+            can be read with `camstim.utils.output_tools.IndexedOutput`, and
+            `load_output` still loads the whole thing.  Indexed files aren't
+            pickles, so `pickle.load` can't read them.  `save` can write a
+            plain pickle instead, e.g. for a backup.
+
     #TODO: Should this be an EObject?
     """
 
     output_saved = QtCore.Signal()
 
-    def __init__(self, path="", output={}):
+    def __init__(self, path="", output={}, sidecar_arrays=False,
+                 indexed=False):
         super(OutputFile, self).__init__(None)
         self.path = path
         self._output = output
+        self.sidecar_arrays = sidecar_arrays
+        self.indexed = indexed
 
         self.dt = datetime.datetime.now()
         self.dt_str = self.dt.strftime('%y%m%d%H%M%S')
 
-    def save(self, path=""):
-        import cPickle as pickle
+    def save(self, path="", indexed=None):
+        """ Saves the output.  `indexed` overrides `self.indexed` for this
+                save.
+        """
+        if indexed is None:
+            indexed = self.indexed
         output = wecanpicklethat(self._output)
         if path:
             self.path = path
@@ -370,8 +414,15 @@ class OutputFile(QtCore.QObject):
             dirname = os.path.dirname(path)
             path = os.path.join(dirname, self.dt_str+"-"+filename)
             logging.warning("File path already exists, saving to: {}".format(path))
+        array_dir = get_array_dir(path) if self.sidecar_arrays else None
+        serializer = PickleSerializer(array_dir=array_dir)
         with open(path, 'wb') as f:
-            pickle.dump(output, f)
+            if indexed:
+                unpickleable = serializer.dump_indexed(output, f)
+            else:
+                unpickleable = serializer.dump(output, f)
+        if unpickleable:
+            logging.warning("Unpickleable output discarded: {}".format(unpickleable))
         self.path = path
 
 
@@ -379,27 +430,6 @@ class OutputFile(QtCore.QObject):
         self._output.update(data_dict)
 
 
-def wecanpicklethat(datadict):
-    """
-    Input is a dictionary.
-        Attempts to pickle every item.  If it doesn't pickle it is discarded
-        and its key is added to the output as "unpickleable"
-    """
-    import cPickle as pickle
-    pickleable = {}
-    unpickleable = []
-    for k, v in datadict.iteritems():
-        try:
-            if k[0] != "_":  # we don't want private counters and such
-                test = v
-                _ = pickle.dumps(test)
-                pickleable[k] = v
-        except:
-            unpickleable.append(k)
-    pickleable['unpickleable'] = unpickleable
-    return pickleable
-
-
 if __name__ == '__main__':
 
     logging.basicConfig(level=logging.INFO,
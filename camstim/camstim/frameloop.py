@@ -0,0 +1,142 @@
+"""
+frameloop.py
+
+Vsync-locked update loop for behavior experiments.
+
+"""
+import time
+import logging
+from timeit import default_timer
+
+import numpy as np
+
+from profiler import FrameProfiler
+
+
+class VirtualClock(object):
+    """
+    Stands in for `window.flip` when there is no display window.  `flip`
+        blocks until the next tick of a fixed rate clock.  If a tick has
+        already been missed, it waits for the next one, like a late flip
+        waits for the next vsync.
+
+    args:
+        fps (float): tick rate.
+
+    """
+    def __init__(self, fps=60.0):
+        self.fps = float(fps)
+        self.period = 1.0 / self.fps
+        self._next = None
+
+    def flip(self):
+        now = default_timer()
+        if self._next is None:
+            self._next = now
+        elif now > self._next:
+            # missed ticks are dropped, not caught up on
+            self._next += np.ceil((now - self._next) / self.period) * self.period
+        remaining = self._next - default_timer()
+        if remaining > 0:
+            time.sleep(remaining)
+        self._next += self.period
+
+
+class FrameLoop(object):
+    """
+    Runs an update function once per display frame, paced by `flip`.
+
+    Each iteration:
+        1) calls `update(index)`
+        2) calls `flip()`, which blocks until the next vsync (or virtual tick)
+        3) processes pending Qt events for at most `event_budget_ms`, so that
+            timers and signals can't push the next update past its frame.
+
+    The time of each flip is recorded.  Latency is the time from a flip
+        returning to the start of the next update (the event processing
+        delay).  Jitter is the standard deviation of the flip intervals.
+        Phase times are also kept in a `FrameProfiler`.
+
+    args:
+        update (callable): called with the frame index once per frame.
+        flip (callable): blocks until the frame is displayed.
+        process_events (callable): called with a time budget in ms to process
+            pending events (ex: `QCoreApplication.processEvents`).
+        event_budget_ms (float): time budget for processing events.
+        fps (float): nominal frame rate, for reporting.
+
+    """
+    def __init__(self,
+                 update,
+                 flip,
+                 process_events=None,
+                 event_budget_ms=2.0,
+                 fps=60.0):
+        self._update = update
+        self._flip = flip
+        self._process_events = process_events
+        self.event_budget_ms = event_budget_ms
+        self.fps = fps
+
+        self.frame_count = 0
+        self.profiler = FrameProfiler()
+        self._flip_times = []
+        self._latencies = []
+        self._running = False
+
+    def run(self):
+        """
+        Runs until `stop` is called.
+        """
+        self._running = True
+        logging.info("Frame loop started at {} fps.".format(self.fps))
+        while self._running:
+            self.step()
+        self.profiler.finish()
+        logging.info("Frame loop stopped after {} frames.".format(
+            self.frame_count))
+
+    def stop(self):
+        self._running = False
+
+    def step(self):
+        """
+        Runs a single frame.
+        """
+        profiler = self.profiler
+        profiler.start_frame(self.frame_count)
+        if self._flip_times:
+            self._latencies.append(default_timer() - self._flip_times[-1])
+        self._update(self.frame_count)
+        profiler.mark("update")
+        self.frame_count += 1
+        if not self._running:
+            return  # closed during update, window may be gone
+        self._flip()
+        self._flip_times.append(default_timer())
+        profiler.mark("flip")
+        if self._process_events:
+            self._process_events(self.event_budget_ms)
+            profiler.mark("events")
+
+    @property
+    def intervals(self):
+        """ Flip intervals in seconds. """
+        return np.diff(self._flip_times)
+
+    def package(self):
+        """
+        Returns the loop timing as a picklable dictionary.
+        """
+        intervals = self.intervals * 1000.0
+        latencies = np.array(self._latencies) * 1000.0
+        return {
+            'fps': self.fps,
+            'frame_count': self.frame_count,
+            'event_budget_ms': self.event_budget_ms,
+            'intervals_ms': intervals,
+            'latency_ms': latencies,
+            'jitter_ms': float(intervals.std()) if len(intervals) else 0.0,
+            'max_latency_ms': float(latencies.max()) if len(latencies) else 0.0,
+            'phases': self.profiler.package(),
+        }
@@ -11,6 +11,7 @@ from scipy.optimize import curve_fit
 import time
 
 from util import make_graphs, gamma_test
+from search import gamma_curve
 
 # Units in CM, taken from 'old' code
 MONITOR_WIDTH = 52
@@ -135,13 +136,13 @@ class GammaWindow(object):
                 # a traceback for it...
                 if x[0] != 1E-9:
                     x[0] += 1E-9
-            return (k*(pow(x,g)))+a
+            return gamma_curve(x, k, g, a)
 
         p0 = [200, 2, 10]
         for i in range(0,4):
             popt, pcov = curve_fit(func, values, data[:,i], p0)
             fitparams[i,:] = popt
-            yf = ((popt[0])*(pow(values, (popt[1]))))+(popt[2])
+            yf = gamma_curve(values, *popt)
 
         make_graphs(intensity=10*values,
                     rawlum=data[:,3],
@@ -28,6 +28,8 @@ import util
 import datetime
 
 from winmonitor import WinMonitor
+from search import find_brightness, brightness_for_luminance
+from simulate import SimulatedDisplay, SimulatedColorCAL
 
 def get_spectrometer(index=0, integration_mult=5):
     """Tries to open the spectrometer at index.
@@ -75,16 +77,20 @@ def get_colorcal(ports=range(0,10)):
     return cc
 
 
-def gamma(screen=0, target_candela=50, squelch = False):
+def gamma(screen=0, target_candela=50, squelch = False, spec=None):
     """Runs gamma calibration on monitor.
     screen : Index of monitor to use, indexed from 0, same as psychopy
     target_candela : lum target required for saving calibration file name
+    spec : spectrometer to use instead of opening one, like a
+           simulate.SimulatedSpectrometer
 
     returns the name of the gamma corrected monitor (with brightness setting appended to the name, eg. "GammaCorrect43"
     
     DW: We need to re-write GammaWindow.
     """
-    spec = get_spectrometer(integration_mult=100)
+    own_spec = spec is None
+    if own_spec:
+        spec = get_spectrometer(integration_mult=100)
     savepath = util.make_folders()
     if not squelch:
         print("Config will be saved to: {}".format(psychopy.monitors.calibTools.monitorFolder))
@@ -97,7 +103,8 @@ def gamma(screen=0, target_candela=50, squelch = False):
                      screen=screen,
                      target_candela=target_candela)
     monitor_type = gw.monitorcal()
-    spec.close()
+    if own_spec:
+        spec.close()
     del spec
     return monitor_type    
 
@@ -182,6 +189,12 @@ def step_luminance(colorcal, step_size = 10, lum_target=50.0, screen = 0):
     for lum in luminances:
         print(lum, end=',')
     print('')
+    estimate = brightness_for_luminance(range(0, 110, step_size)[:len(luminances)],
+                                        luminances,
+                                        lum_target)
+    if estimate is not None:
+        optimal_brightness = int(round(estimate))
+        print('Estimated brightness, {}'.format(optimal_brightness))
     mon.brightness = init_brightness
     mon.contrast = init_contrast
     return optimal_brightness
@@ -201,8 +214,10 @@ def luminance_search(colorcal,
     1. set brightness
     2. calibrate gamma @ brightness
     3. check luminance @ color_target
-    4. If luminance within tolerance of target, done. Otherwise pick new 
-         brightness and go back to 1.
+    4. If luminance within tolerance of target, done. Otherwise fit the
+         luminance model to the measurements so far, pick the brightness it
+         predicts (or bisect, if that's outside the bracket around the
+         target) and go back to 1.  See `search.find_brightness`.
 
     Args:
         colorcal (psychopy.hardware.crs.ColorCal): a ColorCal
@@ -215,39 +230,29 @@ def luminance_search(colorcal,
         int: optimal brightness for reaching `lum_target` @ `color_target`
 
     """
-    # starting brightness
-    b = 50
-    max_bright = 100
-    min_bright = 0
-
     mon = WinMonitor(screen)
     init_brightness = mon.brightness
     init_contrast = mon.contrast
-    optimal_brightness = None
     mon.contrast = 50
-    # Should require at most 8 iterations regardless of tolerance.
-    for _ in range(8):
+
+    def measure(b):
         mon.brightness = b
-        # Calibrate monitor @ brightness        
+        # Calibrate monitor @ brightness
         monitor_cal = gamma(screen=screen, target_candela=lum_target)
         # Check Luminance
-        lum = get_luminance(monitor_cal, colorcal, screen=screen)
+        lum = get_luminance(monitor_cal, colorcal, screen=screen,
+                            color=color_target)
         print("Luminance @ brightness {}: {}".format(b, lum))
-        if abs(lum-lum_target) <= lum_tolerance:
-            # found optimal brightness
-            optimal_brightness = b
-            break
-        elif lum > lum_target:
-            # lower
-            max_bright = b
-        elif lum < lum_target:
-            # higher
-            min_bright = b
-        else:
-            # shouldn't ever happen
-            raise ValueError("Here be dragins.")
-            
-        b = int((max_bright + min_bright)/2)
+        return lum
+
+    # Should require at most 8 iterations regardless of tolerance.
+    optimal_brightness, probes = find_brightness(measure,
+                                                 lum_target=lum_target,
+                                                 lum_tolerance=lum_tolerance,
+                                                 start=50,
+                                                 bounds=(0, 100),
+                                                 max_probes=8)
+    print("Measurements: {}".format(len(probes)))
 
     # return to original brightness
     mon.brightness = init_brightness
@@ -344,8 +349,27 @@ def main(*args):
         else:
             print("Optimal brightness not found.")
 
+    elif command == "simulate":
+        # runs the brightness search on a simulated monitor and ColorCAL
+        lum_target = arg2 or lum_target
+        display = SimulatedDisplay()
+        colorcal = SimulatedColorCAL(display, noise=0.005)
+
+        def measure(b):
+            display.brightness = b
+            return colorcal.getLum()
+
+        for model in (True, False):
+            b, probes = find_brightness(measure,
+                                        lum_target=lum_target,
+                                        lum_tolerance=lum_tolerance,
+                                        model=model)
+            print("{}: brightness {} after {} measurements {}".format(
+                "Model search" if model else "Bisection", b, len(probes),
+                probes))
+
     else:
-        print("Valid commands are: \n\t1. calibrate\n\t2. devices\n\t3. luminance\n\t4. verify\t5. step")
+        print("Valid commands are: \n\t1. calibrate\n\t2. devices\n\t3. luminance\n\t4. verify\t5. step\n\t6. simulate")
 
 if __name__ == "__main__":
     #TODO: use argparse library
@@ -0,0 +1,136 @@
+# -*- coding: utf-8 -*-
+"""! @file  search.py
+
+   @brief Model-based search for the monitor brightness that gives a target
+          luminance.
+
+Each luminance measurement is a slow photometer integration (and, in
+`calibrate.luminance_search`, a gamma calibration too), so instead of
+bisecting the brightness range the search fits the luminance curve used by
+`GammaWindow.fit_gamma` to the measurements it has so far and probes where
+the fit says the target is.  When the fit points outside the bracket of
+measurements around the target, the search bisects the bracket instead.
+"""
+import logging
+
+import numpy as np
+from scipy.optimize import curve_fit
+
+
+def gamma_curve(x, k, g, a):
+    """Luminance model: k * x^g + a."""
+    return k * np.power(x, g) + a
+
+
+def fit_luminance(brightness, luminance):
+    """Fits `gamma_curve` to luminance vs brightness (0-100).
+
+    Returns (k, g, a) for brightness scaled to 0-1, or None if the fit
+        fails.
+    """
+    x = np.asarray(brightness, dtype=float) / 100.0
+    y = np.asarray(luminance, dtype=float)
+    if len(np.unique(x)) < 3:
+        return None
+    p0 = [max(y.max() - y.min(), 1e-3), 1.0, max(y.min(), 0.0)]
+    try:
+        popt, _ = curve_fit(gamma_curve, x, y, p0,
+                            bounds=([0.0, 0.1, -np.inf], [np.inf, 10.0, np.inf]))
+    except (RuntimeError, ValueError) as e:
+        logging.debug("Luminance fit failed: %s", e)
+        return None
+    return popt
+
+
+def brightness_for_luminance(brightness, luminance, lum_target):
+    """Estimates the brightness (0-100, not rounded) that gives `lum_target`
+        from measurements at other brightness settings, or None.
+    """
+    brightness = np.asarray(brightness, dtype=float)
+    luminance = np.asarray(luminance, dtype=float)
+    if len(brightness) >= 3:
+        fit = fit_luminance(brightness, luminance)
+        if fit is not None:
+            k, g, a = fit
+            if k > 0 and lum_target > a:
+                return 100.0 * ((lum_target - a) / k) ** (1.0 / g)
+            return None
+    # too few measurements for the full curve, so leave out the offset and
+    #   fit a power law through the measurements closest to the target
+    usable = (brightness > 0) & (luminance > 0)
+    brightness, luminance = brightness[usable], luminance[usable]
+    if len(brightness) == 0 or lum_target <= 0:
+        return None
+    order = np.argsort(np.abs(luminance - lum_target))[:2]
+    b, lum = np.log(brightness[order]), np.log(luminance[order])
+    if len(b) == 2 and b[0] != b[1] and lum[0] != lum[1]:
+        g = (lum[1] - lum[0]) / (b[1] - b[0])
+    else:
+        g = 1.0  # assume luminance is proportional to brightness
+    if g <= 0:
+        return None
+    return np.exp(b[0] + (np.log(lum_target) - lum[0]) / g)
+
+
+def find_brightness(measure,
+                    lum_target=50.0,
+                    lum_tolerance=2.0,
+                    start=50,
+                    bounds=(0, 100),
+                    max_probes=8,
+                    model=True):
+    """
+    Searches for the brightness setting where `measure` is within
+        `lum_tolerance` of `lum_target`.  Luminance must increase with
+        brightness.
+
+    Args:
+        measure (callable): sets a brightness and returns the luminance
+        lum_target (float): target luminance in cd/m^2
+        lum_tolerance (float): luminance tolerance in cd/m^2
+        start (int): first brightness to measure
+        bounds (tuple): (min, max) brightness
+        max_probes (int): maximum number of measurements
+        model (bool): pick probes from the luminance model.  Otherwise
+            bisects, like the original search.
+
+    Returns:
+        tuple: brightness, or None if not found, and the list of
+            (brightness, luminance) measurements in the order they were made
+
+    """
+    lo, hi = bounds
+    lo_measured = hi_measured = False
+    probes = []
+    b = int(start)
+    for _ in range(max_probes):
+        lum = float(measure(b))
+        probes.append((b, lum))
+        logging.info("Luminance @ brightness %s: %s", b, lum)
+        if abs(lum - lum_target) <= lum_tolerance:
+            return b, probes
+        if lum > lum_target:
+            hi, hi_measured = b, True
+        else:
+            lo, lo_measured = b, True
+
+        # settings that haven't been ruled out
+        first = lo + 1 if lo_measured else lo
+        last = hi - 1 if hi_measured else hi
+        if first > last:
+            break
+        b = int((lo + hi) / 2)
+        if model:
+            estimate = brightness_for_luminance([p[0] for p in probes],
+                                                [p[1] for p in probes],
+                                                lum_target)
+            if estimate is not None:
+                estimate = int(round(estimate))
+                if first <= estimate <= last:
+                    b = estimate
+                elif estimate > last and not hi_measured:
+                    b = last  # is the target reachable at all?
+                elif estimate < first and not lo_measured:
+                    b = first
+        b = min(max(b, first), last)
+    return None, probes
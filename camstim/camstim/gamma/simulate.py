@@ -0,0 +1,143 @@
+# -*- coding: utf-8 -*-
+"""! @file  simulate.py
+
+   @brief Simulated monitor, spectrometer and ColorCAL for testing the
+          calibration without hardware.
+
+The simulated devices all look at one `SimulatedDisplay`, whose luminance
+follows `search.gamma_curve` in brightness and a power law in gray level.
+
+    display = SimulatedDisplay()
+    colorcal = SimulatedColorCAL(display)
+    display.brightness = 40
+    print(colorcal.getLum())
+
+"""
+import numpy as np
+
+from search import gamma_curve
+
+
+class SimulatedDisplay(object):
+    """A monitor with WinMonitor-like brightness and contrast settings.
+
+    max_lum : luminance of white at full brightness
+    black_lum : luminance of black
+    brightness_gamma : exponent of white luminance vs brightness
+    gamma : exponent of luminance vs gray level, unless `corrected`
+    corrected : the gamma correction has been applied
+    """
+    brightness_min = contrast_min = 0
+    brightness_max = contrast_max = 100
+
+    def __init__(self,
+                 max_lum=230.0,
+                 black_lum=0.2,
+                 brightness_gamma=1.6,
+                 gamma=2.2,
+                 corrected=True,
+                 brightness=50,
+                 contrast=50):
+        self.max_lum = max_lum
+        self.black_lum = black_lum
+        self.brightness_gamma = brightness_gamma
+        self.gamma = gamma
+        self.corrected = corrected
+        self.brightness = brightness
+        self.contrast = contrast
+        self.color = 0.0
+
+    def luminance(self, color=None):
+        """Luminance in cd/m^2 of a gray level (-1 to 1)."""
+        if color is None:
+            color = self.color
+        level = (np.clip(color, -1.0, 1.0) + 1.0) / 2.0
+        if not self.corrected:
+            level = level ** self.gamma
+        white = gamma_curve(self.brightness / 100.0,
+                            self.max_lum - self.black_lum,
+                            self.brightness_gamma,
+                            self.black_lum)
+        return self.black_lum + (white - self.black_lum) * level
+
+
+class SimulatedWindow(object):
+    """Stands in for the psychopy window that `util.gamma_test` draws."""
+    def __init__(self, display):
+        self.display = display
+
+    def setColor(self, color):
+        self.display.color = float(np.mean(color))
+
+    def flip(self):
+        pass
+
+    def close(self):
+        pass
+
+
+class _Port(object):
+    def close(self):
+        pass
+
+
+class SimulatedColorCAL(object):
+    """Reads the display's luminance like psychopy's ColorCAL.
+
+    noise : relative standard deviation of each reading
+    """
+    longName = "Simulated ColorCAL"
+    portString = "simulated"
+
+    def __init__(self, display, noise=0.0, seed=None):
+        self.display = display
+        self.noise = noise
+        self.measurements = 0
+        self.com = _Port()
+        self._random = np.random.RandomState(seed)
+
+    def getNeedsCalibrateZero(self):
+        return False
+
+    def getLum(self):
+        self.measurements += 1
+        lum = self.display.luminance()
+        return lum * (1.0 + self.noise * self._random.randn())
+
+
+class SimulatedSpectrometer(object):
+    """Returns spectra like a seabreeze Spectrometer.
+
+    The spectrum has red, green and blue peaks at the wavelengths that
+        `GammaWindow.fit_gamma` reads, scaled by the display luminance.
+    """
+    minimum_integration_time_micros = 1000
+    peaks = (450.0, 535.0, 600.0)
+
+    def __init__(self, display, noise=0.0, seed=None, counts_per_lum=100.0):
+        self.display = display
+        self.noise = noise
+        self.counts_per_lum = counts_per_lum
+        self.measurements = 0
+        self.integration_time = self.minimum_integration_time_micros
+        self._random = np.random.RandomState(seed)
+        self._wavelengths = np.arange(340.0, 1030.0, 0.5)
+        self._response = sum(np.exp(-0.5 * ((self._wavelengths - p) / 20.0) ** 2)
+                             for p in self.peaks) / len(self.peaks)
+
+    def integration_time_micros(self, micros):
+        self.integration_time = micros
+
+    def wavelengths(self):
+        return self._wavelengths
+
+    def spectrum(self):
+        self.measurements += 1
+        scale = self.counts_per_lum * self.integration_time / float(
+            self.minimum_integration_time_micros)
+        counts = self._response * self.display.luminance() * scale
+        counts = counts * (1.0 + self.noise * self._random.randn(len(counts)))
+        return np.vstack([self._wavelengths, counts])
+
+    def close(self):
+        pass
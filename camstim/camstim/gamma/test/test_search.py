@@ -0,0 +1,61 @@
+"""
+Tests the brightness search on a simulated monitor.
+"""
+import unittest
+
+import numpy as np
+
+from camstim.gamma.search import find_brightness, fit_luminance, gamma_curve
+from camstim.gamma.simulate import (SimulatedDisplay, SimulatedColorCAL,
+                                    SimulatedSpectrometer, SimulatedWindow)
+
+
+class TestSearch(unittest.TestCase):
+    def setUp(self):
+        self.display = SimulatedDisplay()
+        self.colorcal = SimulatedColorCAL(self.display, noise=0.002, seed=0)
+
+    def measure(self, b):
+        self.display.brightness = b
+        return self.colorcal.getLum()
+
+    def test_fit_luminance(self):
+        b = np.arange(0, 110, 10)
+        lum = gamma_curve(b / 100.0, 100.0, 1.8, 0.5)
+        k, g, a = fit_luminance(b, lum)
+        self.assertAlmostEqual(g, 1.8, places=3)
+
+    def test_find_brightness(self):
+        model_probes = bisection_probes = 0
+        for target in (5.0, 20.0, 50.0, 90.0):
+            b, probes = find_brightness(self.measure, lum_target=target,
+                                        lum_tolerance=1.0)
+            self.assertLess(abs(self.measure(b) - target), 1.0)
+            self.assertLessEqual(len(probes), 3)
+            _, bisection = find_brightness(self.measure, lum_target=target,
+                                           lum_tolerance=1.0, model=False)
+            model_probes += len(probes)
+            bisection_probes += len(bisection)
+        self.assertLess(model_probes, bisection_probes)
+
+    def test_unreachable(self):
+        b, probes = find_brightness(self.measure, lum_target=500.0)
+        self.assertIsNone(b)
+        self.assertEqual(probes, [(50, probes[0][1]), (100, probes[1][1])])
+
+    def test_spectrometer(self):
+        spec = SimulatedSpectrometer(self.display)
+        window = SimulatedWindow(self.display)
+        totals = []
+        for color in (-1.0, 0.0, 1.0):
+            window.setColor([color] * 3)
+            wavelengths, counts = spec.spectrum()
+            totals.append(counts[(wavelengths > 534) & (wavelengths < 536)].mean())
+        self.assertTrue(totals[0] < totals[1] < totals[2])
+        self.assertAlmostEqual(totals[1] / totals[2],
+                               self.display.luminance(0.0) /
+                               self.display.luminance(1.0))
+
+if __name__ == "__main__":
+    suite = unittest.TestLoader().loadTestsFromTestCase(TestSearch)
+    unittest.TextTestRunner(verbosity=2).run(suite)
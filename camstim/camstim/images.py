@@ -0,0 +1,251 @@
+"""
+images.py
+
+Image decoding and caching for image stimuli, and conversion of image sets
+    to memory-mappable arrays.
+
+"""
+import os
+import json
+import hashlib
+import logging
+from collections import OrderedDict
+from multiprocessing.pool import ThreadPool
+
+import numpy as np
+
+
+def decode_image(path):
+    """
+    Decodes an image to a 2D uint8 array, the way NaturalScenes always has.
+    """
+    import matplotlib.pyplot as plt
+    img = plt.imread(path).astype(np.ubyte)
+    if img.ndim != 2:
+        raise ValueError("Image must be grayscale: {}".format(path))
+    return img
+
+
+class DecodedImageCache(object):
+    """
+    On-disk cache of decoded images, keyed by the sha1 of the image file.
+        Cached images are .npy files that are opened memory-mapped, so an
+        image set is only decoded the first time it is used.
+
+    args:
+        cache_dir (str): cache folder.
+        decode (callable): decodes an image file to an array.
+
+    """
+    def __init__(self, cache_dir, decode=decode_image):
+        self.cache_dir = cache_dir
+        self.decode = decode
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+
+    def _key(self, path):
+        sha1 = hashlib.sha1()
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b""):
+                sha1.update(block)
+        return sha1.hexdigest()
+
+    def load(self, path):
+        """
+        Returns the decoded image, memory-mapped from the cache.  Decodes and
+            caches it if necessary.
+        """
+        cached = os.path.join(self.cache_dir, self._key(path) + ".npy")
+        if os.path.isfile(cached):
+            try:
+                return np.load(cached, mmap_mode='r')
+            except (IOError, ValueError):
+                logging.warning("Bad decoded image cache file: {}".format(
+                    cached))
+        img = self.decode(path)
+        tmp = "{}.{}.tmp".format(cached, os.getpid())
+        with open(tmp, 'wb') as f:
+            np.save(f, img)
+        if os.path.isfile(cached):
+            os.remove(cached)
+        os.rename(tmp, cached)
+        return np.load(cached, mmap_mode='r')
+
+    def load_all(self, paths, workers=4):
+        """
+        Loads images with a pool of `workers` threads.  Returns a list with
+            the image, or the exception that loading it raised, for each path.
+        """
+        def load(path):
+            try:
+                return self.load(path)
+            except Exception as e:
+                return e
+
+        if workers <= 1 or len(paths) <= 1:
+            return [load(p) for p in paths]
+        pool = ThreadPool(min(workers, len(paths)))
+        try:
+            return pool.map(load, paths)
+        finally:
+            pool.close()
+            pool.join()
+
+
+def read_image_set(path):
+    """
+    Reads a pickled image set, optionally zipped, in the format used by
+        `DoCImageStimulus`:
+
+        {"group0_name": {"image0_name": image0_data, ...}, ...}
+
+    """
+    import zipfile
+    try:
+        import cPickle as pickle
+    except ImportError:
+        import pickle
+    if path.endswith(".zip"):
+        with zipfile.ZipFile(path, 'r') as myzip:
+            inner_path = os.path.basename(path.replace(".zip", ".pkl"))
+            with myzip.open(inner_path) as f:
+                return pickle.load(f)
+    with open(path, 'rb') as f:
+        return pickle.load(f)
+
+
+def convert_image_set(image_set, dest_dir):
+    """
+    Converts an image set (or the path to one) to memory-mappable arrays in
+        `dest_dir`.  Images of the same shape and type are stacked into one
+        .npy file, and "index.json" lists the groups and image names in their
+        original order with the file and row of each image.
+
+    Returns the path to the index.
+    """
+    if isinstance(image_set, basestring):
+        image_set = read_image_set(image_set)
+    if not os.path.isdir(dest_dir):
+        os.makedirs(dest_dir)
+
+    stacks = OrderedDict()  # (shape, dtype) -> list of images
+    groups = []
+    for group_name, group in image_set.items():
+        images = []
+        for image_name, image in group.items():
+            image = np.asarray(image)
+            key = (image.shape, image.dtype.str)
+            if key not in stacks:
+                stacks[key] = []
+            images.append([image_name, list(stacks).index(key),
+                           len(stacks[key])])
+            stacks[key].append(image)
+        groups.append([group_name, images])
+
+    files = []
+    for i, stack in enumerate(stacks.values()):
+        filename = "images{}.npy".format(i)
+        np.save(os.path.join(dest_dir, filename), np.stack(stack))
+        files.append(filename)
+    index = {
+        "files": files,
+        "groups": [[group_name, [[name, files[f], row] for name, f, row in
+                                 images]] for group_name, images in groups],
+    }
+    index_path = os.path.join(dest_dir, "index.json")
+    tmp = "{}.{}.tmp".format(index_path, os.getpid())
+    with open(tmp, 'w') as f:
+        json.dump(index, f)
+    if os.path.isfile(index_path):
+        os.remove(index_path)
+    os.rename(tmp, index_path)  # written last, so it marks a complete set
+    return index_path
+
+
+def open_image_set(index_path):
+    """
+    Opens a converted image set.  Returns an OrderedDict of groups, each an
+        OrderedDict of image name to image, where the images are views of
+        read-only memory-mapped arrays.  Processes that open the same set
+        share its pages instead of holding their own copies.
+    """
+    folder = os.path.dirname(index_path)
+    with open(index_path, 'r') as f:
+        index = json.load(f)
+    arrays = dict((filename, np.load(os.path.join(folder, filename),
+                                     mmap_mode='r'))
+                  for filename in index["files"])
+    image_set = OrderedDict()
+    for group_name, images in index["groups"]:
+        image_set[str(group_name)] = OrderedDict(
+            (str(name), arrays[filename][row]) for name, filename, row in images)
+    return image_set
+
+
+def convert_sampling_matrix(csv_path, npy_path):
+    """
+    Converts a sampling matrix csv, which holds two letter image codes, to a
+        .npy file.
+    """
+    matrix = np.loadtxt(csv_path, delimiter=",", dtype='|S2')
+    tmp = "{}.{}.tmp".format(npy_path, os.getpid())
+    with open(tmp, 'wb') as f:
+        np.save(f, matrix)
+    if os.path.isfile(npy_path):
+        os.remove(npy_path)
+    os.rename(tmp, npy_path)
+    return npy_path
+
+
+class ImageSetCache(object):
+    """
+    Local cache of converted image sets and sampling matrices.  Entries are
+        keyed by the source path, size and modification time, so a changed
+        source is converted again, and an unchanged one is opened without
+        reading the source at all.
+
+    args:
+        cache_dir (str): cache folder.
+
+    """
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+
+    def _entry(self, source):
+        stat = os.stat(source)
+        key = "{}|{}|{}".format(os.path.abspath(source), stat.st_size,
+                                int(stat.st_mtime))
+        name = os.path.splitext(os.path.basename(source))[0]
+        return os.path.join(self.cache_dir, "{}_{}".format(
+            name, hashlib.sha1(key).hexdigest()[:16]))
+
+    def get_image_set(self, source):
+        """
+        Returns the memory-mapped image set for a pickled or zipped source,
+            converting it first if necessary.
+        """
+        folder = self._entry(source)
+        index_path = os.path.join(folder, "index.json")
+        if os.path.isfile(index_path):
+            try:
+                return open_image_set(index_path)
+            except (IOError, ValueError, KeyError):
+                logging.warning("Bad image set cache: {}".format(folder))
+        logging.info("Converting image set: {}".format(source))
+        return open_image_set(convert_image_set(source, folder))
+
+    def get_sampling_matrix(self, source):
+        """
+        Returns the sampling matrix for a csv source, converting it first if
+            necessary.
+        """
+        npy_path = self._entry(source) + ".npy"
+        if os.path.isfile(npy_path):
+            try:
+                return np.load(npy_path, mmap_mode='r')
+            except (IOError, ValueError):
+                logging.warning("Bad sampling matrix cache: {}".format(
+                    npy_path))
+        return np.load(convert_sampling_matrix(source, npy_path), mmap_mode='r')
@@ -17,12 +17,15 @@ import ctypes
 import ctypes.util
 import ConfigParser
 import io
+import cPickle as pickle
+import pickle as pickle_ops  # opcodes only
 import __main__
 
 import numpy
 from psychopy import visual, monitors
 
 import camstim
+from camstim.utils.output_tools import INDEX_MAGIC, INDEX_HEADER
 
 CAMSTIM_DIR = os.path.expanduser('~/camstim/')
 
@@ -45,12 +48,27 @@ mouseid = 'test'
 userid = 'user'
 bgcolor = (0,0,0)
 controlstream = True
+controlstream_port = 1111
+controlstream_allowed = {'GET': ['*']}  # fnmatch patterns of names for 'SET', 'GET' and 'RUN'
 trigger = None
 triggerdiport = 0
 triggerdiline = 0
 trigger_delay_sec = 0.0
 savesweeptable = True
 eyetracker = False
+sidecar_arrays = False                # large arrays saved as .npy next to the output pkl
+# indexed output files aren't pickles, so backups are saved as plain pickles,
+#   and sidecar_arrays and indexed_output are off when lims_upload is set
+indexed_output = False                # output saved as an indexed container (see OutputFile)
+frame_profiler = False                # per-frame phase timing saved as "frame_profiler"
+check_keys_interval = 1               # frames between keyboard checks
+
+[MovieCache]
+cache_dir = None                      # defaults to CAMSTIM_DIR/movies
+quota_gb = None                       # least recently used movies are removed over this size
+chunk_mb = 64                         # chunk size for parallel copies
+copy_workers = 4                      # copy threads per movie
+verify_hash = True                    # re-hash cached movies modified since they were copied
 
 [Sync]
 sync_sqr = False
@@ -68,6 +86,9 @@ task_id = "dummy_task"
 volume_limit = None
 lims_upload = False
 default_monitor_calibration = 'testMonitor' # if no window is passed
+vsync_loop = False                   # auto_update once per flip instead of with the update timer
+loop_fps = 60.0                      # virtual clock rate for the loop if no window is passed
+event_budget_ms = 2.0                # max time spent on Qt events per frame in the loop
 
 [DetectionOfChange]
 abort_on_cycle_end = True            
@@ -86,6 +107,7 @@ failure_repeats = 10                 # repeats failed trials up to N times
 free_reward_trials = 10              # free reward if no licks for N trials
 periodic_flash = (0.25, 0.5)         # (on, off)
 trial_translator = False             # translates 2.0 trials to 1.0 trials before publishing
+trial_queue_size = 100               # trials waiting to be published before the oldest is dropped
 
 [Datastream]
 data_export_type = "zro"
@@ -97,6 +119,9 @@ data_export_rep_port = 8888
 nidevice = 'Dev1'
 encodervinchannel = 0
 encodervsigchannel = 1
+acquisition_thread = False           # sample the encoder on a background thread
+sample_rate = 1000.0                 # samples per second for the acquisition thread
+simulated_speed = 0.0                # deg/s of the simulated encoder used without hardware
 
 [Optogenetics]
 optogenetics = False
@@ -111,6 +136,8 @@ invert_logic = False
 [Licksensing]
 nidevice = 'Dev1'
 lick_lines = [(0, 0)]                # list of (port, line) numbers
+poll_rate = None                     # polls/s on a background thread (None to read once per frame)
+simulated_lick_rate = 0.0            # licks/s of simulated sensors used without hardware (0 for keyboard)
 
 [Eyetracking]
 
@@ -359,17 +386,16 @@ def createConfig(path):
 
 def wecanpicklethat(datadict):
     """ Input is a dictionary.
-        Attempts to pickle every item.  If it doesn't pickle it is discarded
-        and its key is added to the output as "unpickleable"
+        Discards private keys and adds an "unpickleable" list to the output.
+        Items are no longer test-pickled here.  `PickleSerializer` pickles
+        each one exactly once when the output is written, discarding any that
+        don't pickle and adding their keys to "unpickleable".
     """
-    import cPickle as pickle
     pickleable = {}
-    unpickleable = []
+    unpickleable = list(datadict.get('unpickleable', []))
     for k, v in datadict.iteritems():
         try:
-            if k[0] != "_":  # we don't want private counters and such
-                test = v
-                teststring = pickle.dumps(test)
+            if k[0] != "_" and k != 'unpickleable':  # we don't want private counters and such
                 pickleable[k] = v
         except:
             unpickleable.append(k)
@@ -377,6 +403,232 @@ def wecanpicklethat(datadict):
     return pickleable
 
 
+class PickleSerializer(object):
+    """
+    Single pass pickler for output dictionaries.  Each value is pickled once at
+        the highest protocol and its bytes are reused directly in the output
+        stream, so nothing is pickled twice.  Values that don't pickle are
+        discarded and their keys are added to the "unpickleable" list of the
+        dictionary that contained them.  Nested dictionaries (and lists or
+        tuples of them) that fail are filtered item by item instead of being
+        discarded whole.
+
+    The output is a standard pickle of the input dictionary.
+
+    If `array_dir` is set, large numpy arrays (and lists of equally shaped
+        arrays, like "posbyframe") are written out of band as .npy files in
+        that directory and only referenced from the pickle.  Load these with
+        `camstim.utils.output_tools.load_output`, which memory-maps them.
+
+    `dump_indexed` writes an indexed container instead, which can be read one
+        key at a time with `camstim.utils.output_tools.IndexedOutput`.
+
+    args:
+        protocol (int): pickle protocol. Must be 2 or higher.
+        array_dir (str): directory for out of band arrays.
+        min_array_bytes (int): arrays smaller than this stay in the pickle.
+
+    """
+    def __init__(self, protocol=pickle.HIGHEST_PROTOCOL, array_dir=None,
+                 min_array_bytes=65536):
+        if protocol < 2:
+            raise ValueError("PickleSerializer requires pickle protocol 2+")
+        self.protocol = protocol
+        self.array_dir = array_dir
+        self.min_array_bytes = min_array_bytes
+        self.unpickleable = []
+        self.array_prefix = ""  # prefix for out of band array file names
+        self._arrays = {}
+
+    def dump(self, datadict, f):
+        """
+        Writes `datadict` to the open file `f`.  Returns the list of discarded
+            keys, as "."-separated paths from the top level.
+        """
+        self.unpickleable = []
+        self._arrays = {}
+        if self.array_dir and not os.path.isdir(self.array_dir):
+            os.makedirs(self.array_dir)
+        f.write(pickle_ops.PROTO + chr(self.protocol))
+        self._write_dict(datadict, f.write, "")
+        f.write(pickle_ops.STOP)
+        return self.unpickleable
+
+    def dump_indexed(self, datadict, f, split_keys=("stimuli", "items")):
+        """
+        Writes `datadict` to the open file `f` as an indexed container.  Each
+            top level key is a separate record, except for `split_keys`, whose
+            lists or dictionaries get one record per member.  Returns the list
+            of discarded keys.
+        """
+        records = []
+        groups = {}
+        unpickleable = []
+
+        def write_record(name, value):
+            self.array_prefix = "r{}_".format(len(records))
+            start = f.tell()
+            discarded = self.dump({"value": value}, f)
+            for path in discarded:
+                unpickleable.append(name + path[len("value"):])
+            if "value" in discarded:
+                return False  # nothing left to index
+            records.append((name, start, f.tell() - start))
+            return True
+
+        f.write(INDEX_HEADER.pack(INDEX_MAGIC, 0, 0))
+        for k, v in datadict.iteritems():
+            if k in split_keys and isinstance(v, (dict, list, tuple)):
+                if isinstance(v, dict):
+                    kind, members = "dict", [(str(m), v[m]) for m in v]
+                else:
+                    kind, members = "list", [(str(i), m) for i, m in
+                                             enumerate(v)]
+                groups[k] = (kind, [m for m, value in members if
+                                    write_record("{}/{}".format(k, m), value)])
+            else:
+                write_record(k, v)
+
+        index_offset = f.tell()
+        index = pickle.dumps({"records": records,
+                              "groups": groups,
+                              "unpickleable": [u for u in unpickleable if
+                                               "." not in u]},
+                             pickle.HIGHEST_PROTOCOL)
+        f.write(index)
+        end = f.tell()
+        f.seek(0)
+        f.write(INDEX_HEADER.pack(INDEX_MAGIC, index_offset, len(index)))
+        f.seek(end)
+        self.array_prefix = ""
+        self.unpickleable = unpickleable
+        return unpickleable
+
+    def dumps(self, datadict):
+        """
+        Returns the pickled string of `datadict`.
+        """
+        f = io.BytesIO()
+        self.dump(datadict, f)
+        return f.getvalue()
+
+    def _body(self, value):
+        """
+        Pickles a value and strips the protocol header and stop opcode, so the
+            bytes can be embedded in a larger stream.
+        """
+        if not self.array_dir:
+            return pickle.dumps(value, self.protocol)[2:-1]
+        buf = io.BytesIO()
+        pickler = pickle.Pickler(buf, self.protocol)
+        pickler.persistent_id = self._persistent_id
+        pickler.dump(value)
+        return buf.getvalue()[2:-1]
+
+    def _persistent_id(self, obj):
+        """
+        Moves large arrays out of band.  Returns None for everything else so
+            that it is pickled normally.
+        """
+        if isinstance(obj, numpy.ndarray):
+            if obj.dtype.hasobject or obj.nbytes < self.min_array_bytes:
+                return None
+        elif type(obj) is list and len(obj) > 1 and \
+                isinstance(obj[0], numpy.ndarray):
+            first = obj[0]
+            if first.dtype.hasobject or \
+                    first.nbytes * len(obj) < self.min_array_bytes:
+                return None
+            for a in obj:
+                if not isinstance(a, numpy.ndarray) or a.shape != first.shape \
+                        or a.dtype != first.dtype:
+                    return None
+        else:
+            return None
+        return self._save_array(obj)
+
+    def _save_array(self, obj):
+        """
+        Saves an array or a list of equally shaped arrays to a .npy file.  Lists
+            are stacked into a single array, row by row, and their persistent
+            id is marked so that they load as lists again.
+        """
+        if id(obj) in self._arrays:
+            return self._arrays[id(obj)]
+        filename = "{}{}.npy".format(self.array_prefix, len(self._arrays))
+        path = os.path.join(self.array_dir, filename)
+        if isinstance(obj, numpy.ndarray):
+            numpy.save(path, obj)
+        else:
+            out = numpy.lib.format.open_memmap(path, mode='w+',
+                                               dtype=obj[0].dtype,
+                                               shape=(len(obj),)+obj[0].shape)
+            for i, a in enumerate(obj):
+                out[i] = a
+            out.flush()
+            del out
+        if isinstance(obj, numpy.ndarray):
+            pid = ("npy", filename)
+        else:
+            pid = ("npy", filename, "list")
+        self._arrays[id(obj)] = pid
+        return pid
+
+    def _value(self, value, path):
+        """
+        Gets the embeddable bytes for a value.  Containers that fail to pickle
+            are rebuilt from their items.  Raises if the value can't be saved.
+        """
+        try:
+            return self._body(value)
+        except Exception:
+            if isinstance(value, dict):
+                parts = []
+                self._write_dict(value, parts.append, path)
+                return "".join(parts)
+            elif type(value) in (list, tuple):
+                return self._sequence(value, path)
+            raise
+
+    def _sequence(self, seq, path):
+        parts = [pickle_ops.MARK]
+        for i, item in enumerate(seq):
+            parts.append(self._value(item, "{}[{}]".format(path, i)))
+        if type(seq) is tuple:
+            parts.append(pickle_ops.TUPLE)
+        else:
+            parts.insert(0, pickle_ops.EMPTY_LIST)
+            parts.append(pickle_ops.APPENDS)
+        return "".join(parts)
+
+    def _write_dict(self, datadict, write, path):
+        if type(datadict) is dict:
+            write(pickle_ops.EMPTY_DICT)
+        else:
+            # dict subclass (OrderedDict etc.): cls() then set items
+            write(self._body(type(datadict)) + pickle_ops.EMPTY_TUPLE +
+                  pickle_ops.REDUCE)
+        unpickleable = None
+        if 'unpickleable' in datadict:
+            unpickleable = list(datadict['unpickleable'])
+        for k, v in datadict.iteritems():
+            if k == 'unpickleable':
+                continue
+            key_path = "{}.{}".format(path, k) if path else str(k)
+            try:
+                item = self._body(k) + self._value(v, key_path)
+            except Exception:
+                if unpickleable is None:
+                    unpickleable = []
+                unpickleable.append(k)
+                self.unpickleable.append(key_path)
+                continue
+            write(item + pickle_ops.SETITEM)
+        if unpickleable is not None:
+            write(self._body('unpickleable') + self._body(unpickleable) +
+                  pickle_ops.SETITEM)
+
+
 def save_session(mouse_id, dt, data, script="", adjustment={}):
     """ Saves a session to MouseInfo service layer """
     from mouse_info import Session
@@ -475,22 +727,11 @@ def setGammaRamp(pygletWindow, newRamp, nAttempts=3):
 
 
 def pickle2hdf5(pickle_file):
-    """ Safely converts a pickle file to an hdf5 file, prints anything that doesn't convert. """
-    import hdf5pickle
-    import tables
-    import cPickle as pickle
-    fname = pickle_file.split(".")[0]
-    h5 = tables.openFile(fname + ".h5", 'w')
-    pkl = open(pickle_file, 'rb')
-    data = pickle.load(pkl)
-    for k, v in data.iteritems():
-        try:
-            hdf5pickle.dump(v, h5, "/" + k)
-        except Exception, e:
-            print k, v, e
-
-    h5.close()
-    pkl.close()
+    """ Converts a pickle file to an hdf5 file with the same name.  See
+            `camstim.utils.hdf5_tools`.
+    """
+    from camstim.utils.hdf5_tools import export_hdf5
+    return export_hdf5(pickle_file)
 
 
 class SyncSquare(visual.GratingStim):
@@ -533,6 +774,13 @@ class ImageStimNumpyuByte(visual.ImageStim):
 
     '''Subclass of ImageStim which allows fast updates of numpy ubyte images,
        bypassing all internal PsychoPy format conversions.
+
+       Texture storage is allocated once per image size, and later images
+       of the same size are uploaded with glTexSubImage2D.  Small, fixed sets
+       of images (like DoC image groups) can be uploaded ahead of time with
+       `preload`, after which setting one of them only rebinds its texture.
+       With double_buffer=True (for movies), each image is uploaded to the
+       texture that isn't being displayed.
     '''
 
     def __init__(self,
@@ -554,13 +802,17 @@ class ImageStimNumpyuByte(visual.ImageStim):
                  texRes=128,
                  name='',
                  autoLog=True,
-                 maskParams=None):
+                 maskParams=None,
+                 double_buffer=False):
 
         if image is None or type(image) != numpy.ndarray or len(image.shape) != 2:
             raise ValueError(
                 'ImageStimNumpyuByte must be numpy.ubyte ndarray (0-255)')
 
         self.interpolate = interpolate
+        self.double_buffer = double_buffer
+        self._tex_shapes = {}  # texture id -> allocated image shape
+        self._preloaded = {}  # id(image) -> (image, texture id)
 
         # convert incoming Uint to RGB trio only during initialization to keep PsychoPy happy
         # else, error is: ERROR   numpy arrays used as textures should be in
@@ -594,31 +846,46 @@ class ImageStimNumpyuByte(visual.ImageStim):
                                   name=name, autoLog=autoLog,
                                   maskParams=maskParams)
 
+        self._own_textures = [self._get_tex_id()]
+        if double_buffer:
+            self._own_textures.append(self._new_texture())
+        self._front = 0
+
         self.setImage = self.setReplaceImage
         self.setImage(image)
 
-    def setReplaceImage(self, tex):
-        '''
-        Use this function instead of 'setImage' to bypass format conversions
-        and increase movie playback rates.
-        '''
-        #intensity = tex.astype(numpy.ubyte)
-        intensity = tex
-        internalFormat = GL.GL_LUMINANCE
-        pixFormat = GL.GL_LUMINANCE
-        dataType = GL.GL_UNSIGNED_BYTE
-        # data = numpy.ones((intensity.shape[0],intensity.shape[1],3),numpy.ubyte)#initialise data array as a float
-        # data[:,:,0] = intensity#R
-        # data[:,:,1] = intensity#G
-        # data[:,:,2] = intensity#B
-        data = intensity
-        texture = tex.ctypes  # serialise
+    def _get_tex_id(self):
         try:
-            tid = self._texID  # psychopy renamed this at some point.
+            return self._texID  # psychopy renamed this at some point.
         except AttributeError:
-            tid = self.texID
+            return self.texID
+
+    def _set_tex_id(self, tid):
+        if _tex_key(tid) == _tex_key(self._get_tex_id()):
+            return
+        if hasattr(self, "_texID"):
+            self._texID = tid
+        else:
+            self.texID = tid
+        self._needUpdate = True  # draw list binds the texture
+
+    def _new_texture(self):
+        tid = GL.GLuint()
+        GL.glGenTextures(1, ctypes.byref(tid))
+        return tid
+
+    def _upload(self, tid, data):
+        """ Uploads an image to a texture, allocating its storage if it
+                doesn't have any of the right size yet.
+        """
+        texture = data.ctypes  # serialise
         GL.glEnable(GL.GL_TEXTURE_2D)
         GL.glBindTexture(GL.GL_TEXTURE_2D, tid)
+        if self._tex_shapes.get(_tex_key(tid)) == data.shape:
+            GL.glTexSubImage2D(GL.GL_TEXTURE_2D, 0, 0, 0,
+                               data.shape[1], data.shape[0],
+                               GL.GL_LUMINANCE, GL.GL_UNSIGNED_BYTE, texture)
+            return
         # makes the texture map wrap (this is actually default anyway)
         if self.interpolate:
             interpolation = GL.GL_LINEAR
@@ -630,11 +897,53 @@ class ImageStimNumpyuByte(visual.ImageStim):
                            GL.GL_TEXTURE_MAG_FILTER, interpolation)
         GL.glTexParameteri(GL.GL_TEXTURE_2D,
                            GL.GL_TEXTURE_MIN_FILTER, interpolation)
-        GL.glTexImage2D(GL.GL_TEXTURE_2D, 0, internalFormat,
+        GL.glTexImage2D(GL.GL_TEXTURE_2D, 0, GL.GL_LUMINANCE,
                         # [JRG] for non-square, want data.shape[1], data.shape[0]
                         data.shape[1], data.shape[0], 0,
-                        pixFormat, dataType, texture)
-        pass
+                        GL.GL_LUMINANCE, GL.GL_UNSIGNED_BYTE, texture)
+        self._tex_shapes[_tex_key(tid)] = data.shape
+
+    def preload(self, images):
+        '''
+        Uploads images to textures of their own.  Setting one of these
+        arrays later only rebinds its texture, so the arrays must not be
+        modified after they are preloaded.
+        '''
+        for image in images:
+            if id(image) not in self._preloaded:
+                tid = self._new_texture()
+                self._upload(tid, image)
+                self._preloaded[id(image)] = (image, tid)
+
+    def setReplaceImage(self, tex):
+        '''
+        Use this function instead of 'setImage' to bypass format conversions
+        and increase movie playback rates.
+        '''
+        preloaded = self._preloaded.get(id(tex))
+        if preloaded is not None and preloaded[0] is tex:
+            self._set_tex_id(preloaded[1])
+            return
+        if self.double_buffer:
+            self._front = 1 - self._front
+        tid = self._own_textures[self._front]
+        self._upload(tid, tex)
+        self._set_tex_id(tid)
+
+    def clearTextures(self):
+        current = _tex_key(self._get_tex_id())
+        textures = getattr(self, "_own_textures", []) + \
+            [t for _, t in getattr(self, "_preloaded", {}).values()]
+        for tid in textures:
+            if _tex_key(tid) != current:  # psychopy deletes this one
+                GL.glDeleteTextures(1, ctypes.byref(tid))
+        self._own_textures = []
+        self._preloaded = {}
+        visual.ImageStim.clearTextures(self)
+
+
+def _tex_key(tid):
+    return getattr(tid, "value", tid)  # GLuints aren't hashable
 
 if __name__ == "__main__":
     pass
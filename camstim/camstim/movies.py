@@ -0,0 +1,622 @@
+"""
+movies.py
+
+Movie frame reading and local movie caching for MovieStim.
+
+"""
+import os
+import re
+import json
+import time
+import uuid
+import errno
+import Queue
+import hashlib
+import logging
+import threading
+
+import numpy as np
+
+
+def open_numpy_movie(path):
+    """
+    Opens a .npy movie memory-mapped, so frames are only read from disk
+        when they are used.  Checks that it is a 3 dimensional uint8 array.
+    """
+    movie = np.load(path, mmap_mode='r')
+    if movie.ndim != 3:
+        raise ValueError("Movie must have 3 dimenstions: (t, y, x))")
+    if not movie.dtype in [np.uint8, np.ubyte]:
+        raise ValueError("Movie must be dtype numpy.uint8")
+    return movie
+
+
+class MovieFrameReader(object):
+    """
+    Reads movie frames ahead of time on a background thread into a small ring
+        of preallocated buffers.
+
+    `order` is the sequence of movie frames in the order they will be shown.
+        `get(k)` returns the `k`th of them.  The thread stays up to
+        `ring_size - 1` frames ahead of the last frame returned, and never
+        overwrites it.  If a frame isn't ready (the thread fell behind or
+        playback jumped), it is read directly and counted in `misses`, and
+        the thread continues from there.
+
+    args:
+        movie (numpy.ndarray): movie frames (t, y, x), usually memory-mapped.
+        order (array-like): movie frame indices in display order.
+        ring_size (int): number of frame buffers.
+
+    """
+    def __init__(self, movie, order=(), ring_size=8):
+        self.movie = movie
+        self.ring_size = ring_size
+        self.misses = 0
+        self._ring = np.zeros((ring_size,) + movie.shape[1:], dtype=movie.dtype)
+        self._direct = np.zeros(movie.shape[1:], dtype=movie.dtype)
+        self._last = None  # buffer returned by the last `get`
+        self._order = np.asarray(order, dtype=np.int64)
+        self._produced = 0  # order positions read into the ring
+        self._consumed = -1  # last order position returned
+        self._generation = 0  # changes whenever read ahead is repositioned
+        self._cond = threading.Condition()
+        self._running = False
+        self._thread = None
+
+    def set_order(self, order):
+        """
+        Sets a new display order and starts reading it from the beginning.
+        """
+        with self._cond:
+            self._order = np.asarray(order, dtype=np.int64)
+            self._produced = 0
+            self._consumed = -1
+            self._last = None
+            self._generation += 1
+            self._cond.notify()
+
+    def start(self):
+        self._running = True
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        with self._cond:
+            self._running = False
+            self._cond.notify()
+        if self._thread:
+            self._thread.join(1.0)
+            self._thread = None
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while self._running and not self._can_produce():
+                    self._cond.wait(0.1)
+                if not self._running:
+                    return
+                k = self._produced
+                frame = self._order[k]
+                generation = self._generation
+            # read outside the lock, the consumer can't use this slot yet
+            buf = self._ring[k % self.ring_size]
+            buf[...] = self.movie[frame]
+            with self._cond:
+                if self._generation == generation:  # not repositioned
+                    self._produced = k + 1
+
+    def _can_produce(self):
+        return (self._produced < len(self._order) and
+                self._produced - self._consumed < self.ring_size)
+
+    def get(self, k):
+        """
+        Returns the `k`th frame of the display order.  The buffer is reused
+            once the reader moves `ring_size - 1` frames past it.
+        """
+        with self._cond:
+            if k == self._consumed:
+                return self._last
+            if self._consumed < k < self._produced:
+                buf = self._ring[k % self.ring_size]
+            else:
+                # read it here and restart read ahead after it
+                self.misses += 1
+                buf = self._direct
+                buf[...] = self.movie[self._order[k]]
+                self._produced = k + 1
+                self._generation += 1
+            self._consumed = k
+            self._last = buf
+            self._cond.notify()
+            return buf
+
+    def package(self):
+        if self.misses:
+            logging.warning("Movie read ahead missed {} frames.".format(
+                self.misses))
+        return {
+            "ring_size": self.ring_size,
+            "misses": self.misses,
+        }
+
+
+class FileLock(object):
+    """
+    Lock shared between processes through a lock file, which is created
+        exclusively and holds the owner's pid and a token unique to the lock
+        object.
+
+    The owner touches the lock file every `stale_s / 4` seconds.  A lock file
+        that hasn't been touched for `stale_s` seconds was left by a process
+        that died.  A waiter takes it over by renaming it to a name of its
+        own, which only one waiter can do, and removes it only if it still
+        holds the owner that was found stale.  `release` only removes the
+        lock file if it still holds this lock's token.
+
+    Ex:
+        with FileLock(path + ".lock"):
+            ...
+
+    """
+    def __init__(self, path, stale_s=60.0, poll_s=0.1):
+        self.path = path
+        self.stale_s = stale_s
+        self.poll_s = poll_s
+        self._token = "{} {}".format(os.getpid(), uuid.uuid4().hex)
+        self._released = threading.Event()
+        self._heartbeat = None
+
+    def acquire(self):
+        while True:
+            try:
+                fd = os.open(self.path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+                self._remove_stale()
+                time.sleep(self.poll_s)
+                continue
+            os.write(fd, self._token)
+            os.close(fd)
+            break
+        self._released.clear()
+        self._heartbeat = threading.Thread(target=self._touch)
+        self._heartbeat.daemon = True
+        self._heartbeat.start()
+
+    def release(self):
+        self._released.set()
+        self._heartbeat.join()
+        if self._read(self.path) == self._token:
+            os.remove(self.path)
+        else:
+            logging.warning("Lock was taken over by another process: "
+                            "{}".format(self.path))
+
+    def _read(self, path):
+        try:
+            with open(path, 'r') as f:
+                return f.read()
+        except IOError:
+            return None
+
+    def _touch(self):
+        while not self._released.wait(self.stale_s / 4.0):
+            try:
+                os.utime(self.path, None)
+            except OSError as e:
+                logging.warning("Failed to touch lock {}: {}".format(
+                    self.path, e))
+
+    def _remove_stale(self):
+        owner = self._read(self.path)
+        taken = "{}.{}.stale".format(self.path, self._token.split()[-1])
+        try:
+            if time.time() - os.path.getmtime(self.path) <= self.stale_s:
+                return
+            os.rename(self.path, taken)
+        except OSError:
+            return  # released, or taken over by another waiter
+        if self._read(taken) == owner:
+            logging.warning("Removed stale lock: {} ({})".format(self.path,
+                                                                owner))
+            os.remove(taken)
+        elif not os.path.exists(self.path):
+            # replaced by a live lock after it was checked, so put it back
+            os.rename(taken, self.path)
+        else:
+            os.remove(taken)
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.release()
+
+
+class MovieCache(object):
+    """
+    Local cache of movie files copied from a network share.
+
+    Cached files are recorded in an index ("cache_index.json") with the size
+        and modification time of their source, and a hash of their contents.
+        A cached copy is used only if its source hasn't changed and its own
+        size matches.  If `verify_hash` is set and the copy was modified since
+        it was indexed, it is hashed again before it is trusted.  If the
+        source can't be reached, the copy is used if its size and hash match
+        the index.
+
+    Files are copied in `chunk_size` chunks by `workers` threads, into a
+        temporary file that is renamed once it is complete, so an interrupted
+        copy is never used.  The hash is the sha1 of the sha1 digests of the
+        chunks, so that chunks can be hashed in parallel too.
+
+    `prefetch` copies movies in the background, and `get` waits for a
+        prefetch of the same movie instead of starting another copy.
+
+    The cache can be shared by several processes (like the Agent prefetching
+        movies for the script it is about to run).  Each movie is checked and
+        copied while holding its `FileLock` ("<movie>.lock"), so a process
+        waits for another's copy instead of starting its own.  The index has
+        a lock too, and is re-read under it before each change is saved.
+
+    If `quota_bytes` is set, the least recently used movies are removed once
+        the cache grows past it.
+
+    args:
+        cache_dir (str): local cache folder.
+        quota_bytes (int): maximum cache size.
+        chunk_size (int): bytes per copied chunk.
+        workers (int): copy threads per movie.
+        verify_hash (bool): re-hash cached movies modified since they were
+            indexed.
+
+    """
+    INDEX_NAME = "cache_index.json"
+
+    def __init__(self,
+                 cache_dir,
+                 quota_bytes=None,
+                 chunk_size=64*1024*1024,
+                 workers=4,
+                 verify_hash=True):
+        self.cache_dir = cache_dir
+        self.quota_bytes = quota_bytes
+        self.chunk_size = chunk_size
+        self.workers = workers
+        self.verify_hash = verify_hash
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        self._lock = threading.RLock()
+        self._pending = {}  # name: prefetch thread
+        self._errors = {}  # name: prefetch exception
+        self._index = {}
+        self.reload_index()
+
+    @property
+    def _index_path(self):
+        return os.path.join(self.cache_dir, self.INDEX_NAME)
+
+    def _index_lock(self):
+        return FileLock(self._index_path + ".lock")
+
+    def _movie_lock(self, name):
+        return FileLock(os.path.join(self.cache_dir, name + ".lock"))
+
+    def _load_index(self):
+        try:
+            with open(self._index_path, 'r') as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return {}
+
+    def _save_index(self):
+        """ Writes the index.  Hold the index lock. """
+        tmp = "{}.{}.tmp".format(self._index_path, os.getpid())
+        with open(tmp, 'w') as f:
+            json.dump(self._index, f, indent=1)
+        if os.path.isfile(self._index_path):
+            os.remove(self._index_path)  # rename can't replace on windows
+        os.rename(tmp, self._index_path)
+
+    def reload_index(self):
+        """
+        Re-reads the index, for changes made by other processes.
+        """
+        with self._lock, self._index_lock():
+            self._index = self._load_index()
+
+    def _update_index(self, entries):
+        """
+        Saves changes to index entries.  `entries` is {name: entry}, where an
+            entry of None removes the name.  Entries changed by other
+            processes since the index was read are kept.
+        """
+        with self._lock, self._index_lock():
+            self._index = self._load_index()
+            for name, entry in entries.items():
+                if entry is None:
+                    self._index.pop(name, None)
+                else:
+                    self._index[name] = entry
+            self._save_index()
+
+    def local_path(self, source):
+        return os.path.join(self.cache_dir, os.path.basename(source))
+
+    def is_valid(self, source):
+        """
+        Checks whether the cached copy of `source` can be used.
+        """
+        name = os.path.basename(source)
+        local = self.local_path(source)
+        with self._lock:
+            entry = self._index.get(name)
+        if not entry or not os.path.isfile(local):
+            return False
+        try:
+            src = os.stat(source)
+        except OSError as e:
+            logging.warning("Can't reach movie source, checking the cached "
+                            "copy instead: {}".format(e))
+            src = None
+        if src and (entry['source_size'] != src.st_size or
+                    entry['source_mtime'] != src.st_mtime):
+            logging.info("Cached movie is out of date: {}".format(name))
+            return False
+        st = os.stat(local)
+        if st.st_size != entry['source_size']:
+            logging.warning("Cached movie is the wrong size: {}".format(name))
+            return False
+        if not src or st.st_mtime != entry['mtime']:
+            if (not src or self.verify_hash) and \
+                    self.hash_file(local) != entry['sha1']:
+                logging.warning("Cached movie is corrupt: {}".format(name))
+                return False
+            with self._lock:
+                entry['mtime'] = st.st_mtime
+        return True
+
+    def get(self, source):
+        """
+        Returns the path of a valid local copy of `source`, copying it if
+            necessary.
+        """
+        name = os.path.basename(source)
+        local = self.local_path(source)
+        if os.path.abspath(source) == os.path.abspath(local):
+            return local
+        with self._lock:
+            pending = self._pending.get(name)
+        if pending and pending is not threading.current_thread():
+            logging.info("Waiting for movie prefetch: {}".format(name))
+            pending.join()
+        with self._movie_lock(name):
+            self.reload_index()
+            if self.is_valid(source):
+                logging.info("Movie file already exists locally @ {}".format(
+                    local))
+            else:
+                logging.info("Movie not saved locally, copying...")
+                t0 = time.time()
+                self._copy(source, local)
+                logging.info("... Done! ({:.1f} s)".format(time.time() - t0))
+            with self._lock:
+                entry = dict(self._index[name], last_used=time.time())
+            self._update_index({name: entry})
+        self.evict(keep=[name])
+        return local
+
+    def prefetch(self, sources):
+        """
+        Starts copying `sources` into the cache in the background.  Returns
+            the prefetch threads.
+        """
+        threads = []
+        for source in sources:
+            name = os.path.basename(source)
+            with self._lock:
+                if name in self._pending and self._pending[name].is_alive():
+                    continue
+                thread = threading.Thread(target=self._prefetch,
+                                          args=(source,))
+                thread.daemon = True
+                self._pending[name] = thread
+            thread.start()
+            threads.append(thread)
+        return threads
+
+    def _prefetch(self, source):
+        name = os.path.basename(source)
+        try:
+            self.get(source)
+        except Exception as e:
+            logging.warning("Failed to prefetch movie {}: {}".format(source, e))
+            self._errors[name] = e
+        finally:
+            with self._lock:
+                self._pending.pop(name, None)
+
+    def wait(self):
+        """
+        Waits for all prefetches.  Returns {name: exception} for those that
+            failed.
+        """
+        while True:
+            with self._lock:
+                pending = self._pending.values()
+            if not pending:
+                return dict(self._errors)
+            for thread in pending:
+                thread.join()
+
+    def _chunks(self, size):
+        return [(offset, min(self.chunk_size, size - offset)) for offset in
+                range(0, size, self.chunk_size)]
+
+    def _run_chunks(self, chunks, work):
+        """
+        Calls `work(index, offset, length)` for each chunk on `workers`
+            threads.  Raises the first error.
+        """
+        jobs = Queue.Queue()
+        for i, (offset, length) in enumerate(chunks):
+            jobs.put((i, offset, length))
+        errors = []
+
+        def worker():
+            while not errors:
+                try:
+                    job = jobs.get_nowait()
+                except Queue.Empty:
+                    return
+                try:
+                    work(*job)
+                except Exception as e:
+                    errors.append(e)
+
+        threads = [threading.Thread(target=worker) for _ in
+                   range(max(1, min(self.workers, len(chunks))))]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        if errors:
+            raise errors[0]
+
+    def _copy(self, source, local):
+        """
+        Copies `source` to `local` and indexes it.  Hold the movie lock.
+        """
+        src = os.stat(source)
+        size = src.st_size
+        tmp = "{}.{}.part".format(local, os.getpid())
+        with open(tmp, 'wb') as f:
+            f.truncate(size)
+        chunks = self._chunks(size)
+        digests = [None] * len(chunks)
+
+        def copy_chunk(i, offset, length):
+            with open(source, 'rb') as fin, open(tmp, 'r+b') as fout:
+                fin.seek(offset)
+                data = fin.read(length)
+                if len(data) != length:
+                    raise IOError("Short read from {}".format(source))
+                fout.seek(offset)
+                fout.write(data)
+            digests[i] = hashlib.sha1(data).digest()
+
+        try:
+            self._run_chunks(chunks, copy_chunk)
+            if os.path.getsize(tmp) != size:
+                raise IOError("Copy of {} is the wrong size.".format(source))
+            if os.path.isfile(local):
+                try:
+                    os.remove(local)
+                except OSError as e:
+                    # windows can't remove a file that is memory-mapped
+                    raise IOError("Can't replace cached movie {}, is it open "
+                                  "in another process? {}".format(local, e))
+            os.rename(tmp, local)
+        except Exception:
+            if os.path.isfile(tmp):
+                os.remove(tmp)
+            raise
+
+        self._update_index({os.path.basename(local): {
+            'source': source,
+            'source_size': size,
+            'source_mtime': src.st_mtime,
+            'mtime': os.stat(local).st_mtime,
+            'sha1': hashlib.sha1("".join(digests)).hexdigest(),
+            'last_used': time.time(),
+        }})
+
+    def hash_file(self, path):
+        """
+        Hashes a file the way copies are hashed (see class docstring).
+        """
+        chunks = self._chunks(os.path.getsize(path))
+        digests = [None] * len(chunks)
+
+        def hash_chunk(i, offset, length):
+            with open(path, 'rb') as f:
+                f.seek(offset)
+                digests[i] = hashlib.sha1(f.read(length)).digest()
+
+        self._run_chunks(chunks, hash_chunk)
+        return hashlib.sha1("".join(digests)).hexdigest()
+
+    def evict(self, keep=()):
+        """
+        Removes the least recently used movies until the cache is under
+            quota.  Movies in `keep`, being prefetched, or locked by another
+            process are not removed.  Neither are movies that can't be
+            removed because another process has them open.
+        """
+        if not self.quota_bytes:
+            return
+        with self._lock, self._index_lock():
+            self._index = self._load_index()
+            entries = sorted(self._index.items(),
+                             key=lambda item: item[1]['last_used'])
+            total = sum(e['source_size'] for _, e in entries)
+            for name, entry in entries:
+                if total <= self.quota_bytes:
+                    break
+                if name in keep or name in self._pending or \
+                        os.path.exists(self._movie_lock(name).path):
+                    continue
+                path = os.path.join(self.cache_dir, name)
+                try:
+                    if os.path.isfile(path):
+                        os.remove(path)
+                except OSError as e:
+                    logging.warning("Failed to evict {}: {}".format(name, e))
+                    continue
+                logging.info("Evicted cached movie: {}".format(name))
+                del self._index[name]
+                total -= entry['source_size']
+            self._save_index()
+
+
+_movie_cache = None
+
+
+def get_movie_cache():
+    """
+    Gets the movie cache, configured by the [MovieCache] section of the
+        stim config.
+    """
+    global _movie_cache
+    if _movie_cache is None:
+        from misc import get_config, CAMSTIM_DIR
+        config = get_config("MovieCache",
+                            os.path.join(CAMSTIM_DIR, "config/stim.cfg"))
+        quota_gb = config.get('quota_gb')
+        _movie_cache = MovieCache(
+            config.get('cache_dir') or os.path.join(CAMSTIM_DIR, "movies"),
+            quota_bytes=int(quota_gb * 1024**3) if quota_gb else None,
+            chunk_size=int(config.get('chunk_mb', 64) * 1024**2),
+            workers=config.get('copy_workers', 4),
+            verify_hash=config.get('verify_hash', True))
+    return _movie_cache
+
+
+def find_script_movies(script_text):
+    """
+    Finds the .npy movie paths quoted in a script.
+    """
+    return re.findall(r"""["']([^"'\n]+\.npy)["']""", script_text)
+
+
+def prefetch_movies(sources):
+    """
+    Starts copying movies into the local cache in the background.  Returns the
+        prefetch threads.
+    """
+    return get_movie_cache().prefetch(sources)
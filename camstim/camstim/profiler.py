@@ -0,0 +1,189 @@
+"""
+profiler.py
+
+Per-frame phase timing for the SweepStim render loop.
+
+"""
+import logging
+from timeit import default_timer
+
+import numpy as np
+
+
+class FrameProfiler(object):
+    """
+    Records the time spent in each phase of every frame (stimulus updates, item
+        updates, flip, etc) into a preallocated ring buffer.  Whenever the
+        buffer fills it is folded into per-phase histograms and a running list
+        of the slowest frames, so memory use is fixed for any session length.
+
+    Usage is `start_frame` once at the top of a frame and then `mark` after
+        each phase.  `mark` assigns the time since the previous mark to the
+        named phase.  Phases are added the first time they are marked.  Phase
+        histograms and means only count the frames that the phase ran on.
+
+    args:
+        size (int): ring buffer length in frames.
+        max_phases (int): maximum number of phases.
+        bin_ms (float): histogram bin width in ms.
+        max_ms (float): histogram range in ms.  Longer times go in the last bin.
+        n_slowest (int): number of slowest frames to keep breakdowns for.
+
+    """
+    def __init__(self,
+                 size=3600,
+                 max_phases=32,
+                 bin_ms=0.25,
+                 max_ms=50.0,
+                 n_slowest=20):
+        self.size = size
+        self.max_phases = max_phases
+        self.bin_ms = bin_ms
+        self.n_slowest = n_slowest
+
+        self.phase_names = []
+        self._phase_index = {}
+
+        self._times = np.zeros((size, max_phases), dtype=np.float64)
+        self._ran = np.zeros((size, max_phases), dtype=bool)
+        self._vsyncs = np.zeros(size, dtype=np.int64)
+        self._row = -1
+        self._last = 0.0
+        self.frame_count = 0
+
+        self.bin_edges_ms = np.arange(0.0, max_ms + bin_ms, bin_ms)
+        n_bins = len(self.bin_edges_ms)  # last bin is overflow
+        self._hist = np.zeros((max_phases, n_bins), dtype=np.int64)
+        self._frame_hist = np.zeros(n_bins, dtype=np.int64)
+        self._sum = np.zeros(max_phases, dtype=np.float64)
+        self._count = np.zeros(max_phases, dtype=np.int64)
+        self._max = np.zeros(max_phases, dtype=np.float64)
+
+        self._slowest_vsyncs = np.zeros(0, dtype=np.int64)
+        self._slowest_times = np.zeros((0, max_phases), dtype=np.float64)
+
+    def start_frame(self, vsync):
+        """
+        Starts timing a new frame.
+        """
+        if self._row == self.size - 1:
+            self._fold()
+        self._row += 1
+        self._vsyncs[self._row] = vsync
+        self.frame_count += 1
+        self._last = default_timer()
+
+    def mark(self, phase):
+        """
+        Ends a phase.  The time since the last mark (or frame start) is added
+            to `phase` for the current frame.
+        """
+        t = default_timer()
+        index = self._phase_index.get(phase)
+        if index is None:
+            index = self._add_phase(phase)
+        if index is not None and self._row >= 0:
+            self._times[self._row, index] += t - self._last
+            self._ran[self._row, index] = True
+        self._last = default_timer()
+
+    def _add_phase(self, phase):
+        if len(self.phase_names) == self.max_phases:
+            logging.warning("Frame profiler is full, not timing: {}".format(phase))
+            self._phase_index[phase] = None
+            return None
+        index = len(self.phase_names)
+        self.phase_names.append(phase)
+        self._phase_index[phase] = index
+        return index
+
+    def _fold(self):
+        """
+        Folds the filled part of the ring buffer into the histograms and the
+            slowest frames, then empties it.
+        """
+        n = self._row + 1
+        if n == 0:
+            return
+        times = self._times[:n]
+        ran = self._ran[:n]
+        totals = times.sum(axis=1)
+        n_bins = len(self.bin_edges_ms)
+        scale = 1000.0 / self.bin_ms
+
+        bins = np.minimum((times * scale).astype(np.int64), n_bins - 1)
+        for i in range(len(self.phase_names)):
+            self._hist[i] += np.bincount(bins[ran[:, i], i], minlength=n_bins)
+        frame_bins = np.minimum((totals * scale).astype(np.int64), n_bins - 1)
+        self._frame_hist += np.bincount(frame_bins, minlength=n_bins)
+        self._sum += times.sum(axis=0)
+        self._count += ran.sum(axis=0)
+        self._max = np.maximum(self._max, times.max(axis=0))
+
+        candidates = np.vstack((self._slowest_times, times))
+        vsyncs = np.concatenate((self._slowest_vsyncs, self._vsyncs[:n]))
+        order = np.argsort(candidates.sum(axis=1))[::-1][:self.n_slowest]
+        self._slowest_times = candidates[order]
+        self._slowest_vsyncs = vsyncs[order]
+
+        self._times[:n] = 0.0
+        self._ran[:n] = False
+        self._row = -1
+
+    def finish(self):
+        """
+        Folds any frames still in the ring buffer.
+        """
+        self._fold()
+
+    def _mean_times(self):
+        """ Mean time of each phase over the frames it ran on. """
+        return self._sum / np.maximum(self._count, 1)
+
+    def _ms(self, times):
+        return {name: float(times[i]*1000.0) for i, name in
+                enumerate(self.phase_names)}
+
+    def log_summary(self, n_slowest=5):
+        """
+        Logs mean and max phase times and the breakdown of the slowest frames.
+        """
+        self.finish()
+        if not self.frame_count:
+            return
+        mean_ms = self._ms(self._mean_times())
+        max_ms = self._ms(self._max)
+        for name in self.phase_names:
+            logging.info("Phase {}: mean={:.3f}ms, max={:.3f}ms".format(
+                name, mean_ms[name], max_ms[name]))
+        for vsync, times in zip(self._slowest_vsyncs[:n_slowest],
+                                self._slowest_times[:n_slowest]):
+            breakdown = ", ".join(["{}={:.2f}ms".format(k, v) for k, v in
+                                   sorted(self._ms(times).items(),
+                                          key=lambda x: -x[1])])
+            logging.info("Slow frame {}: total={:.2f}ms ({})".format(
+                vsync, times.sum()*1000.0, breakdown))
+
+    def package(self):
+        """
+        Returns the timing summary as a picklable dictionary.
+        """
+        self.finish()
+        n = len(self.phase_names)
+        return {
+            'phase_names': list(self.phase_names),
+            'frame_count': self.frame_count,
+            'bin_edges_ms': self.bin_edges_ms,
+            'histograms': {name: self._hist[i].copy() for i, name in
+                           enumerate(self.phase_names)},
+            'frame_histogram': self._frame_hist.copy(),
+            'phase_counts': {name: int(self._count[i]) for i, name in
+                             enumerate(self.phase_names)},
+            'mean_ms': self._ms(self._mean_times()),
+            'max_ms': self._ms(self._max),
+            'slowest': [{'vsync': int(vsync),
+                         'total_ms': float(times[:n].sum()*1000.0),
+                         'phases_ms': self._ms(times)}
+                        for vsync, times in zip(self._slowest_vsyncs,
+                                                self._slowest_times)],
+        }
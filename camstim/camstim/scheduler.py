@@ -0,0 +1,119 @@
+"""
+scheduler.py
+
+Per-item update rates for the SweepStim and Behavior update loops.
+
+"""
+from fractions import gcd
+
+import numpy as np
+
+
+class ItemScheduler(object):
+    """
+    Decides which items are updated on each frame.
+
+    Each item is updated every `interval` frames, on the frames where
+        `frame % interval == phase`.  Items due on the same frame are updated
+        in order of `priority` (lowest first), then in the order they were
+        added.
+
+    An item can declare its rate with `update_interval`, `update_phase` and
+        `update_priority` attributes, which `add` uses unless they are passed
+        in.  If no phase is given, the item gets the phase that is shared with
+        the fewest other periodic items, so that work which doesn't need to
+        run every frame is spread out across frames.  Among equally shared
+        phases, the one whose frames have the lowest cost (see
+        `set_frame_costs`) is picked.
+
+    """
+    def __init__(self):
+        self._entries = []
+        self._count = 0
+        self._frame_costs = None
+
+    def add(self, name, item, interval=None, phase=None, priority=None):
+        """
+        Schedules an item, replacing any item already scheduled as `name`.
+        """
+        if interval is None:
+            interval = getattr(item, "update_interval", 1)
+        if phase is None:
+            phase = getattr(item, "update_phase", None)
+        if priority is None:
+            priority = getattr(item, "update_priority", 0)
+
+        interval = int(interval)
+        if interval < 1:
+            raise ValueError("Update interval must be at least 1 frame.")
+
+        self.remove(name)
+        auto = phase is None
+        if auto:
+            phase = self.least_loaded_phase(interval)
+        phase = int(phase) % interval
+
+        self._entries.append((priority, self._count, name, item, interval,
+                              phase, auto))
+        self._entries.sort()
+        self._count += 1
+
+    def remove(self, name):
+        """
+        Unschedules an item by name.
+        """
+        self._entries = [e for e in self._entries if e[2] != name]
+
+    def set_frame_costs(self, costs):
+        """
+        Sets the cost of each frame's other work (for example the number of
+            stimuli starting a new sweep on it), and moves the items whose
+            phase was picked automatically off the costly frames.
+        """
+        self._frame_costs = np.asarray(costs, dtype=float)
+        placed = [e for e in self._entries if not e[6]]
+        for entry in sorted(self._entries, key=lambda e: e[1]):
+            if entry[6]:
+                phase = self.least_loaded_phase(entry[4], placed)
+                entry = entry[:5] + (phase, True)
+                placed.append(entry)
+        placed.sort()
+        self._entries = placed
+
+    def least_loaded_phase(self, interval, entries=None):
+        """
+        Returns the phase in [0, interval) that shares frames with the fewest
+            items that don't update every frame, then has the lowest frame
+            cost.
+        """
+        if entries is None:
+            entries = self._entries
+        loads = []
+        for phase in range(interval):
+            load = 0
+            for entry in entries:
+                other_interval, other_phase = entry[4:6]
+                if other_interval == 1:
+                    continue
+                # the two items share frames if their phases agree modulo
+                #   the gcd of their intervals
+                if (phase - other_phase) % gcd(interval, other_interval) == 0:
+                    load += 1
+            cost = 0.0
+            if self._frame_costs is not None:
+                cost = self._frame_costs[phase::interval].sum()
+            loads.append((load, cost, phase))
+        return min(loads)[2]
+
+    def due(self, frame):
+        """
+        Returns a list of (name, item) for the items to update on `frame`.
+        """
+        return [(e[2], e[3]) for e in self._entries if frame % e[4] == e[5]]
+
+    def package(self):
+        """
+        Returns the schedule as a picklable dictionary.
+        """
+        return {e[2]: {'interval': e[4], 'phase': e[5], 'priority': e[0]}
+                for e in self._entries}
@@ -20,6 +20,10 @@ import os
 import logging
 import math
 import shutil
+import ast
+import fnmatch
+import threading
+import Queue
 from collections import OrderedDict
 
 from psychopy import visual, event
@@ -28,11 +32,32 @@ import numpy as np
 from stim import Stim
 from experiment import EObject, OutputFile
 from synchro import SyncPulse, SyncSquare
+from profiler import FrameProfiler
+from scheduler import ItemScheduler
+from movies import MovieFrameReader, open_numpy_movie, get_movie_cache
+from images import DecodedImageCache
 ##TODO: find better place for stuff in Core.py
 from misc import buildSweepTable, getSweepFrames, getConfig, wecanpicklethat, \
     getMonitorInfo, getPlatformInfo, check_dirs, ImageStimNumpyuByte, CAMSTIM_DIR
 
 
+def sweep_changes(frame_list):
+    """
+    Finds the frames where a frame list shows a new sweep.  Blank frames don't
+        count, and a sweep shown again after a blank isn't a change, the same
+        as in `Stimulus.update`.
+
+    Returns:
+        tuple: (frames, sweeps) arrays of the change frames and their sweeps.
+    """
+    frame_list = np.asarray(frame_list)
+    frames = np.flatnonzero(frame_list >= 0)
+    sweeps = frame_list[frames]
+    changes = np.ones(len(sweeps), dtype=bool)
+    changes[1:] = sweeps[1:] != sweeps[:-1]
+    return frames[changes], sweeps[changes]
+
+
 class Stimulus(EObject):
     """
     Container for a single stimulus.  Builds its sweep table, allows you to set
@@ -451,6 +476,11 @@ class MovieStim(Stimulus):
     """
     A movie stimulus designed for playing Numpy uint8 movies of arbitrary
         size/resolution.
+
+    The movie is memory-mapped.  Frames are read ahead in display order by a
+        `MovieFrameReader` into `ring_size` buffers, and uploaded to the
+        texture on the frame they are shown, so memory use doesn't depend on
+        the length of the movie.
     """
     def __init__(self,
                  movie_path,
@@ -468,23 +498,29 @@ class MovieStim(Stimulus):
                  flip_v=False,
                  flip_h=False,
                  interpolate=False,
+                 ring_size=8,
                  ):
 
         self.movie_path = movie_path
         self.frame_length = frame_length
 
         movie_data = self.load_movie(movie_path)
+        self.movie_shape = movie_data.shape
+        self._reader = MovieFrameReader(movie_data, ring_size=ring_size)
+        self._read_positions = None
 
         psychopy_stimulus = ImageStimNumpyuByte(window,
-                                                image=movie_data[0],
+                                                image=np.array(movie_data[0]),
                                                 size=size,
                                                 pos=pos,
                                                 units='pix',
                                                 flipVert=flip_v,
                                                 flipHoriz=flip_h,
-                                                interpolate=interpolate)
+                                                interpolate=interpolate,
+                                                double_buffer=True)
+        # sweep values are movie frame indices, see `update`
         sweep_params = {
-            'ReplaceImage': (movie_data, 0),
+            'ReplaceImage': (range(len(movie_data)), 0),
         }
         super(MovieStim, self).__init__(psychopy_stimulus,
                                         sweep_params,
@@ -497,22 +533,71 @@ class MovieStim(Stimulus):
                                         shuffle=shuffle,
                                         fps=fps,
                                         save_sweep_table=False)
+        self._reader.start()
 
-    def _local_copy(self, source):
+    def _build_frame_list(self):
+        super(MovieStim, self)._build_frame_list()
+        self._set_read_order()
+
+    def set_display_sequence(self, display_intervals):
+        super(MovieStim, self).set_display_sequence(display_intervals)
+        self._set_read_order()
+
+    def _set_read_order(self):
         """
-        Creates a local copy of a movie.
+        Gives the reader the movie frames in the order that the frame list
+            will show them, and maps each display frame to its position in
+            that order.
         """
-        filename = os.path.basename(source)
-        local_dir = os.path.join(CAMSTIM_DIR, "movies")
-        check_dirs(local_dir)
-        local_path = os.path.join(local_dir, filename)
-        if os.path.isfile(local_path):
-            print("Movie file already exists locally @ {}".format(local_path))
+        change_frames, change_sweeps = sweep_changes(self.frame_list)
+        positions = np.searchsorted(change_frames,
+                                    np.arange(len(self.frame_list)),
+                                    side='right') - 1
+        positions[np.asarray(self.frame_list) < 0] = -1
+        self._read_positions = positions
+        movie_frames = np.array([row[0] for row in self.sweep_table],
+                                dtype=np.int64)
+        self._reader.set_order(movie_frames[change_sweeps])
+
+    def update(self, frame):
+        """
+        Updates the stimulus based on the current frame.  New movie frames
+            come from the read ahead buffers.
+
+        Args:
+            frame (int): frame number for this update.
+        """
+        self.current_frame = frame
+        try:
+            sweep_number = self.frame_list[frame]
+        except IndexError:
+            #stimulus finished
+            return
+        if sweep_number == self._current_sweep:
+            #still on same sweep
+            pass
+        elif sweep_number == -1:
+            #on a grey screen or blank screen
+            return
         else:
-            print("Movie not saved locally, copying...")
-            shutil.copy(source, local_path)
-            print("... Done!")
-        return local_path
+            #new sweep
+            image = self._reader.get(self._read_positions[frame])
+            self.stim.setReplaceImage(image)
+            self._current_sweep = sweep_number
+
+        self.draw()
+
+    def package(self):
+        self._reader.stop()
+        self.read_ahead = self._reader.package()
+        return super(MovieStim, self).package()
+
+    def _local_copy(self, source):
+        """
+        Gets a validated local copy of a movie from the movie cache (see
+            `camstim.movies.MovieCache`).
+        """
+        return get_movie_cache().get(source)
 
     def load_movie(self, path):
         """
@@ -525,25 +610,23 @@ class MovieStim(Stimulus):
 
     def load_numpy_movie(self, path):
         """
-        Loads a numpy movie.  Ensures that it is read as a contiguous array and
+        Opens a numpy movie, memory-mapped.  Ensures that it is uint8 and
             three dimensional.
         """
         self.movie_local_path = self._local_copy(path)
-        movie_data = np.ascontiguousarray(np.load(self.movie_local_path))
-
-        # check shape/type
-        if movie_data.ndim != 3:
-            raise ValueError("Movie must have 3 dimenstions: (t, y, x))")
-        if not movie_data.dtype in [np.uint8, np.ubyte]:
-            raise ValueError("Movie must be dtype numpy.uint8")
-
-        return movie_data
+        return open_numpy_movie(self.movie_local_path)
 
 class NaturalScenes(Stimulus):
     """
     Modified version of Stimulus class for natural scenes.  Has special sweep
         table and update method.
 
+    Images are decoded by `workers` threads into a cache of decoded arrays in
+        `cache_dir` (keyed by file hash), and memory-mapped from there.  The
+        texture for an image is created the first time it is needed, and the
+        next `preload` upcoming images get theirs ahead of time, one per
+        frame.
+
     TODO: remove any code overlap with `Stimulus`
 
     """
@@ -559,6 +642,9 @@ class NaturalScenes(Stimulus):
                  runs=1,
                  shuffle=False,
                  fps=60.0,
+                 cache_dir=None,
+                 workers=4,
+                 preload=2,
                  ):
 
         if isinstance(image_path_list, str):
@@ -575,27 +661,30 @@ class NaturalScenes(Stimulus):
             self._image_path_list = image_path_list
 
         # load the images, save a list of paths that were successfully loaded.
-        self.stim = []
+        self._window = window
+        self._pos = pos
+        self._images = []
         self.image_path_list = []
-        
-        from camstim.misc import ImageStimNumpyuByte
-        import matplotlib.pyplot as plt
-        
-        for img_path in self._image_path_list:
-            try:
-                img = plt.imread(img_path).astype(np.ubyte)
-                scene = ImageStimNumpyuByte(window,
-                                            image=img,
-                                            pos=pos,
-                                            size=img.shape[::-1],
-                                            units="pix",
-                                            flipVert=True)
-                
-                self.stim.append(scene)
-                self.image_path_list.append(img_path)
-            except (IOError, ValueError) as e:
-                import traceback; traceback.print_exc()
-                print("Failed to load: {} It will be skipped.".format(img_path))
+        self.preload = preload
+
+        if cache_dir is None:
+            cache_dir = os.path.join(CAMSTIM_DIR, "image_cache")
+        cache = DecodedImageCache(cache_dir)
+        loaded = cache.load_all(self._image_path_list, workers=workers)
+        for img_path, img in zip(self._image_path_list, loaded):
+            if isinstance(img, (IOError, ValueError)):
+                print("Failed to load: {} It will be skipped. ({})".format(
+                    img_path, img))
+                continue
+            elif isinstance(img, Exception):
+                raise img
+            self._images.append(img)
+            self.image_path_list.append(img_path)
+
+        # textures are created as needed, see `_scene`
+        self.stim = [None] * len(self._images)
+        self._change_frames = np.zeros(0, dtype=np.int64)
+        self._change_sweeps = np.zeros(0, dtype=np.int64)
 
         self.sweep_length = sweep_length
         self.start_time = start_time
@@ -638,6 +727,43 @@ class NaturalScenes(Stimulus):
         if self.shuffle:
             random.shuffle(self.sweep_order)
 
+    def _build_frame_list(self):
+        super(NaturalScenes, self)._build_frame_list()
+        self._change_frames, self._change_sweeps = sweep_changes(
+            self.frame_list)
+
+    def set_display_sequence(self, display_intervals):
+        super(NaturalScenes, self).set_display_sequence(display_intervals)
+        self._change_frames, self._change_sweeps = sweep_changes(
+            self.frame_list)
+
+    def _scene(self, index):
+        """
+        Gets the image stimulus for an image, creating its texture if it
+            doesn't have one yet.
+        """
+        scene = self.stim[index]
+        if scene is None:
+            img = np.asarray(self._images[index])
+            scene = ImageStimNumpyuByte(self._window,
+                                        image=img,
+                                        pos=self._pos,
+                                        size=img.shape[::-1],
+                                        units="pix",
+                                        flipVert=True)
+            self.stim[index] = scene
+        return scene
+
+    def _preload(self, frame):
+        """
+        Creates the texture for the first of the next `preload` images that
+            doesn't have one.
+        """
+        i = np.searchsorted(self._change_frames, frame, side='right')
+        for sweep in self._change_sweeps[i:i+self.preload]:
+            if self.stim[sweep] is None:
+                self._scene(sweep)
+                return
 
     def update(self, frame):
         """
@@ -654,15 +780,17 @@ class NaturalScenes(Stimulus):
             pass
         elif sweep_number == -1:
             #on a grey screen or blank screen
+            self._preload(frame)
             return
         else:
             #new sweep
             self._current_sweep = sweep_number
 
         self.draw()
+        self._preload(frame)
 
     def draw(self):
-        self.stim[self._current_sweep].draw()
+        self._scene(self._current_sweep).draw()
 
 
 class StimulusArray(Stimulus):
@@ -788,11 +916,17 @@ class SweepStim(Stim):
             self.add_stimulus(stim)
 
         self.items = OrderedDict()
+        self._scheduler = ItemScheduler()
+        self._check_keys_interval = 1  # set from config in `_setup_run`
+        self._check_keys_phase = 0
 
         self.primary_stimulus = None
 
         self.vsynccount = 0
 
+        # per-frame phase timing, created in `_setup_run` if enabled
+        self.frame_profiler = None
+
         #set up required submodules
         self._setup_syncpulse()
         self._setup_syncsquare()
@@ -876,12 +1010,13 @@ class SweepStim(Stim):
     def _setup_controlstream(self):
         """
         Sets up control steam socket to receive commands.
-
-        TODO:
-            - port should be configurable in some way.
         """
+        if not self.config['controlstream']:
+            return
         try:
-            controlstream = ControlStream(1111, self)
+            controlstream = ControlStream(self.config['controlstream_port'],
+                                          self,
+                                          self.config['controlstream_allowed'])
             self.add_item(controlstream, name="control_stream")
         except Exception as e:
             logging.exception("Failed to set up control stream: {}".format(e))
@@ -926,9 +1061,14 @@ class SweepStim(Stim):
         else:
             self.stimuli.remove(stimulus)
 
-    def add_item(self, item, name=""):
+    def add_item(self, item, name="", interval=None, phase=None,
+                 priority=None):
         """
-        Adds an item to the experiment.
+        Adds an item to the experiment.  The item is updated every `interval`
+            frames, at frame offset `phase`.  Items due on the same frame are
+            updated in order of `priority`.  Defaults are taken from the
+            item's `update_interval`, `update_phase` and `update_priority`
+            attributes if it has them (see `ItemScheduler`).
         """
         if not name:
             length = len(self.items.keys())
@@ -936,6 +1076,7 @@ class SweepStim(Stim):
 
         item._parent = self
         self.items[name] = item
+        self._scheduler.add(name, item, interval, phase, priority)
 
         # TODO: merge this into EObject
         if item.has_item("data_source"):
@@ -949,9 +1090,11 @@ class SweepStim(Stim):
             for k, v in self.items.iteritems():
                 if item is v:
                     del self.items[k]
+                    self._scheduler.remove(k)
                     break
         else:
             del self.items[name]
+            self._scheduler.remove(name)
 
     def run(self):
         """
@@ -988,9 +1131,18 @@ class SweepStim(Stim):
         for i in self.items.values():
             i.start()
 
+        if self.config['frame_profiler']:
+            self.frame_profiler = FrameProfiler()
+
         #import pdb; pdb.set_trace()
         self.total_frames = self._count_total_frames()
 
+        # periodic items and key checks are kept off sweep onset frames
+        self._scheduler.set_frame_costs(self._stimulus_frame_costs())
+        self._check_keys_interval = max(self.config['check_keys_interval'], 1)
+        self._check_keys_phase = self._scheduler.least_loaded_phase(
+            self._check_keys_interval)
+
         self._printExpInfo()
 
         if self.onpulse:
@@ -1042,11 +1194,21 @@ class SweepStim(Stim):
             raise IndexError('There are only %i stimuli.' % len(self.stimuli))
 
     def update(self, frame):
+        profiler = self.frame_profiler
+        if profiler:
+            profiler.start_frame(self.vsynccount)
         self._update_stimuli(frame)
+        if profiler:
+            profiler.mark("stimuli")
         self._update_items(frame)
         self.flip()
+        if profiler:
+            profiler.mark("flip")
         self.vsynccount += 1
-        self._check_keys()
+        if frame % self._check_keys_interval == self._check_keys_phase:
+            self._check_keys()
+            if profiler:
+                profiler.mark("check_keys")
 
     def flip(self):
         if self.framepulse:
@@ -1062,8 +1224,11 @@ class SweepStim(Stim):
             stim.update(frame)
 
     def _update_items(self, frame):
-        for item in self.items.values():
+        profiler = self.frame_profiler
+        for name, item in self._scheduler.due(frame):
             item.update(frame)
+            if profiler:
+                profiler.mark(name)
 
     def _check_keys(self):
         for keys in event.getKeys(timeStamped=True):
@@ -1084,6 +1249,19 @@ class SweepStim(Stim):
         print("Expected end time: %s" % endtime)
         print("Expected vsyncs: %s" % exp_time_frames)
 
+    def _stimulus_frame_costs(self):
+        """
+        Returns the number of stimuli that start a new sweep on each frame.
+        """
+        costs = np.zeros(self.total_frames)
+        for stim in self.stimuli:
+            frame_list = getattr(stim, "frame_list", None)
+            if frame_list is None:
+                continue
+            frames = sweep_changes(frame_list)[0]
+            np.add.at(costs, frames[frames < self.total_frames], 1)
+        return costs
+
     def _count_total_frames(self):
         if not self.stimuli:
             return 0
@@ -1137,6 +1315,8 @@ class SweepStim(Stim):
         print("Actual end time: %s" % str(self.stopdatetime))
 
         self.printFrameInfo()  #also saves intervalsms
+        if self.frame_profiler:
+            self.frame_profiler.log_summary()
 
         self._cleanup()
 
@@ -1149,6 +1329,9 @@ class SweepStim(Stim):
         """
         self.items = OrderedDict({k: v.package() for k, v in self.items.iteritems()})
         self.stimuli = [stim.package() for stim in self.stimuli]
+        if self.frame_profiler:
+            self.frame_profiler = self.frame_profiler.package()
+        self.item_schedule = self._scheduler.package()
 
         self.scripttext = open(self.script, 'r').read()
         self.monitor = getMonitorInfo(self.monitor)
@@ -1179,7 +1362,18 @@ class SweepStim(Stim):
         packaged = self.package()
         packaged = wecanpicklethat(packaged)
 
-        output_file = OutputFile()
+        sidecar_arrays = self.config['sidecar_arrays']
+        indexed = self.config['indexed_output']
+        if sidecar_arrays and self.lims_config['lims_upload']:
+            # the LIMS upload only sends the pkl
+            logging.warning("Sidecar arrays are disabled for LIMS uploads.")
+            sidecar_arrays = False
+        if indexed and self.lims_config['lims_upload']:
+            # LIMS reads the upload with pickle.load
+            logging.warning("Indexed output is disabled for LIMS uploads.")
+            indexed = False
+        output_file = OutputFile(sidecar_arrays=sidecar_arrays,
+                                 indexed=indexed)
         #_ = [pprint.pprint(item) for item in wecanpicklethat(self.__dict__).items()]
         output_file.add_data(packaged)
 
@@ -1197,7 +1391,7 @@ class SweepStim(Stim):
             mouse_dir = os.path.join(backupdir, mouseid+"/output")
             backup_path = os.path.join(mouse_dir, output_filename)
             logging.info("Backing up pkl file at %s" % backup_path)
-            output_file.save(backup_path)
+            output_file.save(backup_path, indexed=False)  # plain pickle
             logging.info("Backup complete!")
 
         # LIMS
@@ -1241,10 +1435,18 @@ class SweepStim(Stim):
         """
         Updates items but not stimuli.
         """
+        profiler = self.frame_profiler
+        if profiler:
+            profiler.start_frame(self.vsynccount)
         self._update_items(frame)
         self.flip()
+        if profiler:
+            profiler.mark("flip")
         self.vsynccount += 1
-        self._check_keys()
+        if frame % self._check_keys_interval == self._check_keys_phase:
+            self._check_keys()
+            if profiler:
+                profiler.mark("check_keys")
 
 
 
@@ -1254,100 +1456,183 @@ class ControlStream(EObject):
     """
     Stream for socket commands.  Allows commands from the agent.
 
-    #TODO: replace this with something like ZMQ or ZRO
+    Commands are UDP datagrams of the form "SET <name> <value>",
+        "GET <name>" or "RUN <name>", where <name> is a dotted attribute path
+        from the parent (list indices are allowed, ex: "stimuli.0.runs").
+        They are received on a background thread, checked against an
+        allowlist and queued.  Queued commands are applied by `update`, so
+        that nothing changes in the middle of a frame.  Values are parsed
+        as python literals, never evaluated.
+
+    Args:
+        port (int): UDP port to listen on.
+        parent (SweepStim): object that commands act on.
+        allowed (dict): allowed names for each command as lists of fnmatch
+            patterns.  Ex: `{"SET": ["stimuli.*.runs"], "RUN": []}`.
+            Commands missing from the dict are not allowed.  Private names
+            are never allowed.
+        max_queued (int): maximum number of commands waiting to be applied.
 
     """
-    def __init__(self, port, parent):
+    def __init__(self, port, parent, allowed=None, max_queued=100):
         super(ControlStream, self).__init__()
         self.port = port
         self.parent = parent
+        if allowed is None:
+            allowed = {"GET": ["*"]}
+        self.allowed = allowed
+
+        # (name, old value, new value, received vsync, applied vsync)
+        self.commandrecord = []
+        self.rejected = []
+
+        self._queue = Queue.Queue(maxsize=max_queued)
+        self._stop = threading.Event()
+        self._thread = None
 
         self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
         self.sock.bind(('localhost', self.port))
-        self.sock.settimeout(0.0)
+        self.sock.settimeout(0.1)
+
+    def start(self):
+        """
+        Starts receiving commands.
+        """
+        self._thread = threading.Thread(target=self._receive)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _receive(self):
+        """
+        Receive loop.  Runs on the background thread.
+        """
+        while not self._stop.is_set():
+            try:
+                data, addr = self.sock.recvfrom(1024)
+            except socket.timeout:
+                continue
+            except socket.error:
+                if self._stop.is_set():
+                    break
+                continue
+            command = self._parse(data)
+            if command is None:
+                continue
+            try:
+                self._queue.put_nowait((command, addr, self._vsync()))
+            except Queue.Full:
+                logging.warning("Control stream queue full, dropped: {}".format(
+                    data))
+
+    def _vsync(self):
+        return getattr(self.parent, "vsynccount", 0)
+
+    def _parse(self, data):
+        """
+        Splits a datagram into a command tuple, or returns None if it isn't
+            an allowed command.
+        """
+        command = data.strip().split(' ', 2)
+        if len(command) < 2 or (command[0] == 'SET' and len(command) < 3):
+            reason = "couldn't parse"
+        elif not self._is_allowed(command[0], command[1]):
+            reason = "not allowed"
+        else:
+            return command
+        self.rejected.append((data, reason, self._vsync()))
+        logging.warning("Control stream command {}: {}".format(reason, data))
+        return None
+
+    def _is_allowed(self, command, name):
+        if any(part.startswith('_') for part in name.split('.')):
+            return False
+        return any(fnmatch.fnmatchcase(name, pattern) for pattern in
+                   self.allowed.get(command, []))
 
     def update(self, frame):
-        if frame % 10 == 0:
+        """
+        Applies all queued commands.
+        """
+        while True:
             try:
-                data, addr = self.sock.recvfrom(48)
-                if data:
-                    data = data.split(' ')
-                    self._handleCommand(data)
-            except socket.error as e:
-                pass
-            except Exception as e:
-                print("Controlstream error: %s" % e)
+                command, addr, received = self._queue.get_nowait()
+            except Queue.Empty:
+                break
+            self._handleCommand(command, addr, received)
 
-    def _handleCommand(self, command):
+    def _resolve(self, name):
+        """
+        Returns the object that holds `name` and the attribute name.
         """
-        Handles a command from a UDP source.
+        parts = name.split('.')
+        obj = self.parent
+        for part in parts[:-1]:
+            if part.isdigit():
+                obj = obj[int(part)]
+            else:
+                obj = getattr(obj, part)
+        return obj, parts[-1]
 
-        TODO:
-            - Make this not totally fucking insane.
+    def _handleCommand(self, command, addr=None, received=None):
+        """
+        Applies a command from a UDP source.
         """
+        vsync = self._vsync()
+        if received is None:
+            received = vsync
+        latency = vsync - received
 
         if command[0] == 'SET':
             try:
-                name = command[1].split('.')
-                newvalue = eval(command[2])
-                if len(name,) == 2:
-                    oldvalue = getattr(eval("self."+name[0]), name[1])
-                    if type(oldvalue) == type(newvalue):
-                        setattr(eval("self.parent."+name[0]), name[1], newvalue)  # value is in child object
-                    else:
-                        try:
-                            oldtype = type(oldvalue)  # cast as new type?
-                            newvalue = oldtype(newvalue)
-                            setattr(eval("self.parent."+name[0]), name[1], newvalue)  # value is in child object
-                        except:
-                            raise TypeError('Old value is %s, new value is %s' % (
-                                type(oldvalue), type(newvalue)))
-                elif len(name,) == 1:
-                    oldvalue = getattr(self, name[0])
-                    if type(oldvalue) == type(newvalue):
-                        setattr(self.parent, name[0], newvalue)  # value is in self
-                    else:
-                        try:
-                            oldtype = type(oldvalue)
-                            newvalue = oldtype(newvalue)
-                            setattr(self.parent, name[0], newvalue)
-                        except:
-                            raise TypeError('Old value is %s, new value is %s' % (
-                                type(oldvalue), type(newvalue)))
-                elif len(name,) > 2:
-                    raise ValueError('Command could not be parsed. Check formatting.')
-                commandlist = (command[1], oldvalue, newvalue, self.vsynccount)
+                obj, attr = self._resolve(command[1])
+                oldvalue = getattr(obj, attr)
+                newvalue = ast.literal_eval(command[2])
+                if type(oldvalue) != type(newvalue):
+                    try:
+                        newvalue = type(oldvalue)(newvalue)  # cast as old type?
+                    except Exception:
+                        raise TypeError('Old value is %s, new value is %s' % (
+                            type(oldvalue), type(newvalue)))
+                setattr(obj, attr, newvalue)
+                commandlist = (command[1], oldvalue, newvalue, received, vsync)
                 self.commandrecord.append(commandlist)
-                print(commandlist)
+                logging.info("Control stream set {} = {} ({} frames latency)"
+                             .format(command[1], newvalue, latency))
             except Exception as e:
-                print("Failed to set value: %s" % e)
+                logging.warning("Failed to set value: %s" % e)
 
         elif command[0] == 'GET':
-            ##TODO: Do something with value that we get...
             try:
-                name = command[1].split('.')
-                if len(name,) == 2:
-                    value = getattr(eval("self.parent."+name[0]), name[1])
-                elif len(name,) == 1:
-                    value = getattr(self.parent, name[0])
+                obj, attr = self._resolve(command[1])
+                value = getattr(obj, attr)
+                if addr:
+                    self.sock.sendto(repr(value), addr)
             except Exception as e:
-                print("Failed to get value: %s" % e)
+                logging.warning("Failed to get value: %s" % e)
 
         elif command[0] == 'RUN':
             try:
-                methodname = command[1]  # currently only works with no args
-                getattr(self.parent, methodname)()
-                commandlist = (command[1], self.vsynccount)
+                obj, attr = self._resolve(command[1])
+                getattr(obj, attr)()  # currently only works with no args
+                commandlist = (command[1], None, None, received, vsync)
                 self.commandrecord.append(commandlist)
-                print(commandlist)
+                logging.info("Control stream ran {} ({} frames latency)".format(
+                    command[1], latency))
             except Exception as e:
-                print("Failed to run method: %s" % e)
+                logging.warning("Failed to run method: %s" % e)
         else:
-            print("Couldn't parse received command: %s" % command)
+            logging.warning("Couldn't parse received command: %s" % command)
+
+    def close(self):
+        self._stop.set()
+        if self._thread:
+            self._thread.join(1.0)
+        self.sock.close()
 
     def package(self):
         self.sock = str(self.sock)
         self.parent = str(self.parent)
+        self.apply_latency = [c[4] - c[3] for c in self.commandrecord]
         return super(ControlStream, self).package()
 
 
@@ -6,11 +6,23 @@ Translates new-style trials into old ones.
 Useful for backwards compatibility with old behavior code.
 
 """
+import os
+import glob
 import datetime
-import pickle
+import logging
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
 
 import numpy as np
 
+from .utils.output_tools import load_output
+
+STIM_LOG_DTYPE = np.dtype([('frame', np.int64), ('state', np.bool_),
+                           ('ori', np.float64)])
+RESPONSE_LOG_DTYPE = np.dtype([('frame', np.int64)])
+
 
 class TrialTranslator(object):
     """ 
@@ -119,38 +131,107 @@ class TrialTranslator(object):
         log = [{'frame': i} for i in licks]
         return log
 
-    def translate_file(self, new_data, output_path=""):
-        """ 
+    def make_columns(self, exp_data):
+        """ Builds the translated trial log, rewards, stimulus log, response
+                log and dx in a single pass over the trials.  The logs are
+                numpy record arrays instead of lists of dictionaries.
+        """
+        behavior = exp_data['items']['behavior']
+        trial_log = behavior['trial_log']
+
+        old_trial_log = []
+        rewards = []
+        lick_frames = []
+        for trial in trial_log:
+            old_trial_log.append(self.translate_trial(trial))
+            if trial['rewards']:
+                rewards.append(trial['rewards'][0])
+            if trial['licks']:
+                lick_frames.append(trial['licks'][0][1])
+
+        vsyncs = behavior['update_count']
+        draw_log = behavior['stimuli'].items()[0][1]['draw_log'] #GROSS
+        stim_log = np.zeros(vsyncs, dtype=STIM_LOG_DTYPE)
+        stim_log['frame'] = np.arange(vsyncs)
+        stim_log['state'] = np.asarray(draw_log[:vsyncs]) != 0
+
+        response_log = np.array(lick_frames, dtype=np.int64).view(
+            RESPONSE_LOG_DTYPE)
+
+        return {
+            'triallog': old_trial_log,
+            'new_trial_log': trial_log,
+            'params': behavior['params'],
+            'vsyncintervals': self.find_vsyncs(exp_data),
+            'rewards': np.array(rewards, dtype=np.float).reshape(-1, 2),
+            'dx': np.asarray(self.find_dx(exp_data)),
+            'stimuluslog': stim_log,
+            'responselog': response_log,
+        }
+
+    def translate_file(self, new_data, output_path="", columnar=False,
+                       mmap_mode='r'):
+        """ Translates an output file (or its loaded data).  Writes the
+                legacy output to `output_path` if it is set and returns the
+                translated trial log.
+
+            If `columnar` is True, the stimulus and response logs are written
+                as record arrays (see `make_columns`).  Arrays that the
+                output file stored out of band are memory-mapped with
+                `mmap_mode`.
         """
-        if isinstance(new_data, str):
-            # TODO: prepare for non-pickle files? zipped files?
-            with open(new_data, 'rb') as f:
-                data = pickle.load(f)
+        if isinstance(new_data, basestring):
+            data = load_output(new_data, mmap_mode=mmap_mode)
+        else:
+            data = new_data
 
         try:
             data['items']['behavior']
         except KeyError:
             data = {'items': {'behavior': data,},}
 
-        trial_log = self.find_trial_logs(data)
-        params = self.find_params(data)
-        vsyncs = self.find_vsyncs(data)
-        rewards = self.find_rewards(data)
-        dx = self.find_dx(data)
-        stim_log = self.make_stim_log(data)
-        response_log = self.make_response_log(data)
+        if columnar:
+            output = self.make_columns(data)
+        else:
+            trial_log = self.find_trial_logs(data)
+            output = {
+                'triallog': self.translate_log(trial_log),
+                'new_trial_log': trial_log,
+                'params': self.find_params(data),
+                'vsyncintervals': self.find_vsyncs(data),
+                'rewards': self.find_rewards(data),
+                'dx': self.find_dx(data),
+                'stimuluslog': self.make_stim_log(data),
+                'responselog': self.make_response_log(data),
+            }
 
-        old_trial_log = self.translate_log(trial_log)
         if output_path:
             with open(output_path, 'wb') as f:
-                pickle.dump({
-                    'triallog': old_trial_log,
-                    'new_trial_log': trial_log,
-                    'params': params,
-                    'vsyncintervals': vsyncs,
-                    'rewards': rewards,
-                    'dx': dx,
-                    'stimuluslog': stim_log,
-                    'responselog': response_log,
-                }, f)
-        return old_trial_log
+                pickle.dump(output, f, pickle.HIGHEST_PROTOCOL)
+        return output['triallog']
+
+    def translate_directory(self, input_dir, output_dir=None, pattern="*.pkl",
+                            columnar=True):
+        """ Batch converts every output file in `input_dir` that matches
+                `pattern`.  Outputs are written to `output_dir` (default:
+                `input_dir`) with a "_legacy" suffix.  Files that fail to
+                translate are logged and skipped.
+
+            Returns a list of the output paths written.
+        """
+        output_dir = output_dir or input_dir
+        if not os.path.isdir(output_dir):
+            os.makedirs(output_dir)
+        written = []
+        for path in sorted(glob.glob(os.path.join(input_dir, pattern))):
+            name = os.path.splitext(os.path.basename(path))[0]
+            if name.endswith("_legacy"):
+                continue
+            output_path = os.path.join(output_dir, name + "_legacy.pkl")
+            try:
+                self.translate_file(path, output_path, columnar=columnar)
+            except Exception as e:
+                logging.warning("Failed to translate {}: {}".format(path, e))
+                continue
+            written.append(output_path)
+        return written
@@ -0,0 +1,264 @@
+"""
+hdf5_tools.py
+
+Exports SweepStim and Behavior output files to HDF5, and reads them back
+    lazily.
+
+Known large fields (see `LARGE_FIELDS`), and any other array bigger than
+    `min_dataset_bytes`, become chunked, compressed datasets.  Dictionaries
+    become groups, lists of dictionaries (like "stimuli") become groups with
+    one subgroup per item, and everything else is stored as attributes.
+    Values that HDF5 can't hold natively are pickled.
+
+Requires h5py.
+
+"""
+import os
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+import numpy as np
+
+from .output_tools import load_output
+
+LARGE_FIELDS = ("posbyframe", "orisbyimg", "intervalsms", "dx", "lick_data",
+                "draw_log", "sweep_table", "frame_list")
+
+CHUNK_BYTES = 256 * 1024
+MAX_ATTRIBUTE_BYTES = 64000
+
+LIST_ATTR = "_camstim_list"  # marks a group made from a list
+PICKLED_ATTR = "_camstim_pickled"  # names of pickled attributes
+
+
+def chunk_shape(shape, itemsize, target_bytes=CHUNK_BYTES):
+    """ Chunks span whole rows (frames) and about `target_bytes`, so that
+            reading a range of frames touches as few chunks as possible.
+    """
+    if not shape or shape[0] == 0:
+        return None
+    row_bytes = int(np.prod(shape[1:], dtype=np.int64)) * itemsize
+    rows = max(1, target_bytes // max(row_bytes, 1))
+    return (int(min(rows, shape[0])),) + tuple(shape[1:])
+
+
+def _as_array(value):
+    """ Converts a large field to an array, or returns None if it can't be
+            stored as one.
+    """
+    if isinstance(value, np.ndarray):
+        array = value
+    elif isinstance(value, tuple) and len(value) == 1 and \
+            isinstance(value[0], np.ndarray):
+        array = value[0]  # lick_data is saved as np.where() output
+    elif isinstance(value, (list, tuple)) and value:
+        if isinstance(value[0], tuple):
+            # rows of mixed types, like the sweep table
+            try:
+                array = np.rec.fromrecords(value).view(np.ndarray)
+            except Exception:
+                return None
+        else:
+            array = np.asarray(value)
+    else:
+        return None
+    if array.dtype.hasobject or array.dtype.kind == "U":
+        return None
+    return array
+
+
+def _is_attribute_value(value):
+    if isinstance(value, (bool, int, long, float, str, np.generic)):
+        return True
+    if isinstance(value, np.ndarray):
+        return value.dtype.kind in "biuf" and value.nbytes <= MAX_ATTRIBUTE_BYTES
+    return False
+
+
+class HDF5Exporter(object):
+    """
+    Writes an output dictionary to an HDF5 file (see module docstring).
+
+    args:
+        compression (str): h5py compression filter.
+        compression_opts (int): compression level.
+        min_dataset_bytes (int): other arrays bigger than this also become
+            datasets.
+
+    """
+    def __init__(self, compression="gzip", compression_opts=4,
+                 min_dataset_bytes=65536):
+        self.compression = compression
+        self.compression_opts = compression_opts
+        self.min_dataset_bytes = min_dataset_bytes
+
+    def export(self, data, h5_path):
+        import h5py
+        with h5py.File(h5_path, "w") as h5:
+            self._write_dict(h5, data)
+        return h5_path
+
+    def _write_dict(self, group, data):
+        pickled = []
+        for key, value in data.iteritems():
+            if not isinstance(key, str) or "/" in key or not key:
+                raise ValueError("Can't use key as an HDF5 name: "
+                                 "{!r}".format(key))
+            self._write_value(group, key, value, pickled)
+        if pickled:
+            group.attrs[PICKLED_ATTR] = np.array(pickled)
+
+    def _write_value(self, group, key, value, pickled):
+        if isinstance(value, dict) and self._has_names(value):
+            self._write_dict(group.create_group(key), value)
+            return
+        if isinstance(value, list) and value and \
+                all(isinstance(v, dict) and self._has_names(v) for v in value):
+            sub = group.create_group(key)
+            sub.attrs[LIST_ATTR] = True
+            for i, item in enumerate(value):
+                self._write_dict(sub.create_group(str(i)), item)
+            return
+
+        if key in LARGE_FIELDS or isinstance(value, np.ndarray):
+            array = _as_array(value)
+            if array is not None and (key in LARGE_FIELDS or
+                                      array.nbytes > self.min_dataset_bytes):
+                self._write_dataset(group, key, array)
+                return
+
+        if _is_attribute_value(value):
+            group.attrs[key] = value
+            return
+
+        # everything else is pickled
+        data = np.frombuffer(pickle.dumps(value, pickle.HIGHEST_PROTOCOL),
+                             dtype=np.uint8)
+        if data.nbytes <= MAX_ATTRIBUTE_BYTES:
+            group.attrs[key] = np.void(data.tostring())
+            pickled.append(key)
+        else:
+            dataset = self._write_dataset(group, key, data)
+            dataset.attrs[PICKLED_ATTR] = True
+
+    def _has_names(self, data):
+        return all(isinstance(k, str) and k and "/" not in k for k in data)
+
+    def _write_dataset(self, group, key, array):
+        chunks = chunk_shape(array.shape, array.dtype.itemsize)
+        if chunks is None:
+            return group.create_dataset(key, data=array)
+        return group.create_dataset(key,
+                                    data=array,
+                                    chunks=chunks,
+                                    compression=self.compression,
+                                    compression_opts=self.compression_opts,
+                                    shuffle=True)
+
+
+def export_hdf5(source, h5_path=None, **kwargs):
+    """ Exports an output file (or loaded output dictionary) to HDF5.  Keyword
+            arguments are passed to `HDF5Exporter`.
+
+        Returns the path of the HDF5 file, which defaults to the output file
+            path with an .h5 extension.
+    """
+    if isinstance(source, basestring):
+        if h5_path is None:
+            h5_path = os.path.splitext(source)[0] + ".h5"
+        source = load_output(source)
+    elif h5_path is None:
+        raise ValueError("h5_path is required when exporting loaded data.")
+    return HDF5Exporter(**kwargs).export(source, h5_path)
+
+
+class LazyGroup(object):
+    """
+    Lazy view of an exported group.  Indexing returns another `LazyGroup`
+        for groups, the h5py dataset for arrays (slice it to read part of
+        it) and the value for attributes.  Paths like
+        "items/behavior/encoders/0/dx" are accepted.
+
+    `read` loads the whole group into dictionaries, lists and arrays.
+    """
+    def __init__(self, group):
+        self._group = group
+        pickled = group.attrs.get(PICKLED_ATTR, [])
+        self._pickled = set(str(k) for k in pickled)
+
+    @property
+    def is_list(self):
+        return bool(self._group.attrs.get(LIST_ATTR, False))
+
+    def keys(self):
+        keys = list(self._group.keys())
+        keys += [k for k in self._group.attrs.keys() if
+                 k not in (LIST_ATTR, PICKLED_ATTR)]
+        if self.is_list:
+            return sorted(keys, key=int)
+        return keys
+
+    def __len__(self):
+        return len(self.keys())
+
+    def __contains__(self, key):
+        return key in self.keys()
+
+    def __getitem__(self, key):
+        key = str(key)
+        if "/" in key:
+            first, rest = key.split("/", 1)
+            return self[first][rest]
+        if key in self._group:
+            obj = self._group[key]
+            if hasattr(obj, "keys"):
+                return LazyGroup(obj)
+            if obj.attrs.get(PICKLED_ATTR, False):
+                return pickle.loads(obj[()].tostring())
+            return obj
+        if key in self._group.attrs:
+            value = self._group.attrs[key]
+            if key in self._pickled:
+                return pickle.loads(value.tostring())
+            return value
+        raise KeyError(key)
+
+    def read(self):
+        values = {}
+        for key in self.keys():
+            value = self[key]
+            if isinstance(value, LazyGroup):
+                value = value.read()
+            elif hasattr(value, "dtype") and hasattr(value, "chunks"):
+                value = value[()]
+            values[key] = value
+        if self.is_list:
+            return [values[k] for k in sorted(values, key=int)]
+        return values
+
+
+class HDF5Output(LazyGroup):
+    """
+    Opens an exported file for lazy reading.
+
+    Ex:
+        with HDF5Output("session.h5") as output:
+            dx = output["items/behavior/encoders/0/dx"][1000:2000]
+            intervals = output["intervalsms"][:]
+
+    """
+    def __init__(self, path):
+        import h5py
+        self._file = h5py.File(path, "r")
+        super(HDF5Output, self).__init__(self._file)
+
+    def close(self):
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
@@ -1,10 +1,166 @@
 """
 """
-import pickle
+import io
+import os
+import shutil
+import struct
+from collections import OrderedDict
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
 
+import numpy as np
 import yaml
 
 
+def get_array_dir(path):
+    """ Gets the directory for out of band arrays that belong to an
+            output file.
+    """
+    return os.path.splitext(path)[0] + "_arrays"
+
+
+def copy_output(source, destination):
+    """ Copies an output file, and its out of band arrays if it has them, so
+            that the copy can still be loaded.
+    """
+    shutil.copyfile(source, destination)
+    array_dir = get_array_dir(source)
+    if os.path.isdir(array_dir):
+        dest_array_dir = get_array_dir(destination)
+        if os.path.isdir(dest_array_dir):
+            shutil.rmtree(dest_array_dir)
+        shutil.copytree(array_dir, dest_array_dir)
+
+
+def _array_loader(array_dir, mmap_mode='r'):
+    """ Gets the unpickler `persistent_load` for out of band arrays. """
+    def persistent_load(pid):
+        kind, filename = pid[:2]
+        if kind != "npy":
+            raise pickle.UnpicklingError("Unknown persistent id: {}".format(pid))
+        array = np.load(os.path.join(array_dir, filename), mmap_mode=mmap_mode)
+        if pid[2:] == ("list",):
+            return list(array)
+        return array
+    return persistent_load
+
+
+def is_indexed_output(path):
+    """ Checks whether an output file is an indexed container. """
+    with open(path, 'rb') as f:
+        return f.read(len(INDEX_MAGIC)) == INDEX_MAGIC
+
+
+def load_output(path, mmap_mode='r'):
+    """ Loads an output file.  Arrays that were saved out of band are
+            memory-mapped from their .npy files instead of being read into
+            memory.  Lists of equally shaped arrays (like "posbyframe") come
+            back as lists of rows of a single stacked array.  Plain output
+            files load as usual.
+
+        Indexed containers (see `IndexedOutput`) are loaded whole.
+    """
+    if is_indexed_output(path):
+        with IndexedOutput(path, mmap_mode=mmap_mode) as output:
+            return output.load()
+
+    with open(path, 'rb') as f:
+        unpickler = pickle.Unpickler(f)
+        unpickler.persistent_load = _array_loader(get_array_dir(path),
+                                                  mmap_mode)
+        return unpickler.load()
+
+
+# indexed output container:
+#   header  INDEX_HEADER: magic, index offset, index length
+#   records one pickled {"value": value} per top level key or group member
+#   index   pickled {"records": [(name, offset, length), ...],
+#                    "groups": {name: (type, [member, ...])},
+#                    "unpickleable": [...]}
+# offsets are from the start of the file.
+INDEX_MAGIC = "CSTIDX01"
+INDEX_HEADER = struct.Struct("<8sQQ")
+
+
+class IndexedOutput(object):
+    """ Reads an indexed output container (see `OutputFile`) one key at a
+            time.  Only the header and index are read on open.
+
+        Keys are the top level keys of the output.  Members of split groups,
+            like a single stimulus, can be loaded with paths like
+            "stimuli/3".
+
+        Ex:
+            with IndexedOutput(path) as output:
+                intervals = output["intervalsms"]
+                sequence = output["stimuli/0"]["display_sequence"]
+    """
+    def __init__(self, path, mmap_mode='r'):
+        self.path = path
+        self._persistent_load = _array_loader(get_array_dir(path), mmap_mode)
+        self._file = open(path, 'rb')
+        magic, offset, length = INDEX_HEADER.unpack(
+            self._file.read(INDEX_HEADER.size))
+        if magic != INDEX_MAGIC:
+            self._file.close()
+            raise ValueError("Not an indexed output file: {}".format(path))
+        self._file.seek(offset)
+        index = pickle.loads(self._file.read(length))
+        self._records = OrderedDict((name, (start, size)) for
+                                    name, start, size in index['records'])
+        self.groups = index['groups']
+        self.unpickleable = index['unpickleable']
+
+    def keys(self):
+        keys = []
+        for name in self._records:
+            key = name.split("/", 1)[0]
+            if key not in keys:
+                keys.append(key)
+        return keys
+
+    def __contains__(self, key):
+        return key in self._records or key in self.groups
+
+    def __getitem__(self, key):
+        if key in self._records:
+            return self._load_record(key)
+        if key in self.groups:
+            kind, members = self.groups[key]
+            values = [self._load_record("{}/{}".format(key, m)) for m in
+                      members]
+            if kind == "dict":
+                return OrderedDict(zip(members, values))
+            return values
+        raise KeyError(key)
+
+    def _load_record(self, name):
+        start, size = self._records[name]
+        self._file.seek(start)
+        unpickler = pickle.Unpickler(io.BytesIO(self._file.read(size)))
+        unpickler.persistent_load = self._persistent_load
+        return unpickler.load()['value']
+
+    def load(self):
+        """ Loads the whole output. """
+        output = {key: self[key] for key in self.keys()}
+        if self.unpickleable:
+            output['unpickleable'] = output.get('unpickleable', []) + \
+                self.unpickleable
+        return output
+
+    def close(self):
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
 def dict2types(input_dict):
     """ Converts a dictionary into a matching dictionary
             of just its types.
@@ -44,8 +200,7 @@ def item2typestr(item):
 def output2types(path):
     """ Converts an output file to a type dict.
     """
-    with open(path, 'rb') as f:
-        data = pickle.load(f)
+    data = load_output(path)
     return dict2types(data)
 
 
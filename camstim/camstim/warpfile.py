@@ -0,0 +1,115 @@
+"""
+warpfile.py
+
+Reads warp definition files for `window.Window` and converts them to a
+    binary format that can be memory-mapped.
+
+Text warpfiles are the Paul Bourke format
+    (http://paulbourke.net/dome/warpingfisheye/):
+
+    2
+    cols rows
+    x y u v intensity
+    ...
+
+Binary warpfiles have a `WARP_HEADER` (magic, file type, cols, rows) followed
+    by the same rows*cols*5 grid as float32.
+
+"""
+import os
+import struct
+
+import numpy as np
+
+WARP_MAGIC = b"CSTWARP1"
+WARP_HEADER = struct.Struct("<8sIII")
+
+
+def is_binary_warpfile(path):
+    with open(path, 'rb') as f:
+        return f.read(len(WARP_MAGIC)) == WARP_MAGIC
+
+
+def read_text_warpfile(path):
+    """
+    Reads a text warpfile.  Returns (filetype, cols, rows, data), where data
+        is a float64 array with one row of (x, y, u, v, intensity) per point.
+    """
+    with open(path, 'r') as f:
+        filetype = int(f.readline())
+        cols, rows = [int(v) for v in f.readline().split()[:2]]
+        data = np.fromstring(f.read(), dtype=np.float64, sep=" ")
+    if data.size % 5:
+        raise ValueError("Warpfile rows must have 5 values: {}".format(path))
+    return filetype, cols, rows, data.reshape(-1, 5)
+
+
+def read_binary_warpfile(path, mmap=True):
+    """
+    Reads a binary warpfile.  Returns (filetype, cols, rows, data), where data
+        is a float32 array (memory-mapped by default) with one row of
+        (x, y, u, v, intensity) per point.
+    """
+    with open(path, 'rb') as f:
+        magic, filetype, cols, rows = WARP_HEADER.unpack(
+            f.read(WARP_HEADER.size))
+    if magic != WARP_MAGIC:
+        raise ValueError("Not a binary warpfile: {}".format(path))
+    shape = (cols * rows, 5)
+    if os.path.getsize(path) != WARP_HEADER.size + cols * rows * 5 * 4:
+        raise ValueError("Binary warpfile is truncated: {}".format(path))
+    if mmap:
+        data = np.memmap(path, dtype='<f4', mode='r',
+                         offset=WARP_HEADER.size, shape=shape)
+    else:
+        with open(path, 'rb') as f:
+            f.seek(WARP_HEADER.size)
+            data = np.fromfile(f, dtype='<f4').reshape(shape)
+    return filetype, cols, rows, data
+
+
+def read_warpfile(path, mmap=True):
+    """ Reads a text or binary warpfile. """
+    if is_binary_warpfile(path):
+        return read_binary_warpfile(path, mmap=mmap)
+    return read_text_warpfile(path)
+
+
+def convert_warpfile(text_path, binary_path=None):
+    """
+    Converts a text warpfile to a binary one.  Returns the path of the binary
+        warpfile, which defaults to the text path with a .bin extension.
+    """
+    if binary_path is None:
+        binary_path = os.path.splitext(text_path)[0] + ".bin"
+    filetype, cols, rows, data = read_text_warpfile(text_path)
+    if data.shape[0] != cols * rows:
+        raise ValueError("Warpfile should have {} points but has {}: {}".format(
+            cols * rows, data.shape[0], text_path))
+    tmp = "{}.{}.tmp".format(binary_path, os.getpid())
+    with open(tmp, 'wb') as f:
+        f.write(WARP_HEADER.pack(WARP_MAGIC, filetype, cols, rows))
+        data.astype('<f4').tofile(f)
+    if os.path.isfile(binary_path):
+        os.remove(binary_path)
+    os.rename(tmp, binary_path)
+    return binary_path
+
+
+def warp_buffers(cols, rows, data):
+    """
+    Builds the vertex, texture coordinate and RGBA opacity arrays for the
+        warp quads.  Each quad's corners are the grid points (x, y),
+        (x+1, y), (x+1, y+1) and (x, y+1), quads are ordered by row, and the
+        intensity becomes the opacity's alpha.
+    """
+    x, y = np.meshgrid(np.arange(cols - 1), np.arange(rows - 1))
+    index = (y * cols + x).reshape(-1, 1)
+    corners = (index + [0, 1, cols + 1, cols]).ravel()
+    points = np.asarray(data)[corners]
+
+    vertices = points[:, 0:2].astype('float32')
+    tcoords = points[:, 2:4].astype('float32')
+    opacity = np.ones((len(corners), 4), dtype='float32')
+    opacity[:, 3] = points[:, 4]
+    return vertices, tcoords, opacity
@@ -89,6 +89,7 @@ psychopy.event.visualOpenWindows = openWindows
 #jayb
 import numpy as np
 from OpenGL.arrays import ArrayDatatype as ADT
+from warpfile import read_warpfile, warp_buffers
 from psychopy import visual, monitors
 import ConfigParser
 
@@ -454,15 +455,12 @@ class Window(visual.Window):
     def projectionWarpfile (self):
         ''' Use a warp definition file to create the projection.
             See: http://paulbourke.net/dome/warpingfisheye/ 
+
+            The warpfile can also be a binary warpfile made with
+            `warpfile.convert_warpfile`, which is memory-mapped.
         '''
         try:
-            fh = open (self.warpfile)
-            lines = fh.readlines()
-            fh.close()
-            filetype = int(lines[0])
-            rc = map(int, lines[1].split())
-            cols, rows = rc[0], rc[1]
-            warpdata = np.loadtxt(self.warpfile, skiprows=2)
+            filetype, cols, rows, warpdata = read_warpfile(self.warpfile)
         except:
             error = 'Unable to read warpfile: ' + self.warpfile
             logging.warning(error)
@@ -480,42 +478,8 @@ class Window(visual.Window):
           
         self.nverts = (self.xgrid-1)*(self.ygrid-1)*4
 
-        # create vertex grid array, and texture coords times 4 for quads
-        vertices = np.zeros(((self.xgrid-1)*(self.ygrid-1)*4, 2),dtype='float32')
-        tcoords = np.zeros(((self.xgrid-1)*(self.ygrid-1)*4, 2),dtype='float32')
-        # opacity is RGBA
-        opacity = np.ones(((self.xgrid-1)*(self.ygrid-1)*4,4),dtype='float32')
-
-        #loop to create quads
-        vdex = 0
-        for y in xrange(0,self.ygrid-1):
-            for x in xrange(0,self.xgrid-1):
-                index = y*(self.xgrid) + x
-                
-                vertices[vdex+0,0] = warpdata[index,0]          #x_coords[y,x]
-                vertices[vdex+0,1] = warpdata[index,1]          #y_coords[y,x]
-                vertices[vdex+1,0] = warpdata[index+1,0]        #x_coords[y,x+1]
-                vertices[vdex+1,1] = warpdata[index+1,1]        #y_coords[y,x+1]
-                vertices[vdex+2,0] = warpdata[index+cols+1,0]   #x_coords[y+1,x+1]
-                vertices[vdex+2,1] = warpdata[index+cols+1,1]   #y_coords[y+1,x+1]
-                vertices[vdex+3,0] = warpdata[index+cols,0]     #x_coords[y+1,x]
-                vertices[vdex+3,1] = warpdata[index+cols,1]     #y_coords[y+1,x]
-                
-                tcoords[vdex+0,0] = warpdata[index,2]           # u_coords[y,x]
-                tcoords[vdex+0,1] = warpdata[index,3]           # v_coords[y,x]
-                tcoords[vdex+1,0] = warpdata[index+1,2]         # u_coords[y,x+1]
-                tcoords[vdex+1,1] = warpdata[index+1,3]         # v_coords[y,x+1]
-                tcoords[vdex+2,0] = warpdata[index+cols+1,2]    # u_coords[y+1,x+1]
-                tcoords[vdex+2,1] = warpdata[index+cols+1,3]    # v_coords[y+1,x+1]
-                tcoords[vdex+3,0] = warpdata[index+cols,2]      # u_coords[y+1,x]
-                tcoords[vdex+3,1] = warpdata[index+cols,3]      # v_coords[y+1,x]
-                
-                opacity[vdex,3] = warpdata[index, 4]
-                opacity[vdex+1,3] = warpdata[index+1, 4]
-                opacity[vdex+2,3] = warpdata[index+cols+1, 4]
-                opacity[vdex+3,3] = warpdata[index+cols, 4]
-
-                vdex += 4
+        # vertex grid, texture coords and RGBA opacity, times 4 for quads
+        vertices, tcoords, opacity = warp_buffers(cols, rows, warpdata)
 
         self.createVertexAndTextureBuffers (vertices, tcoords, opacity)        
         
@@ -22,12 +22,13 @@ import sys
 from datetime import datetime
 import subprocess
 import json
-from shutil import copyfile
+import shutil
 
 from zro import Publisher, Proxy, ZroError
 from zmq.error import Again
 
 from camstim.misc import CAMSTIM_DIR
+from camstim.utils.output_tools import copy_output, get_array_dir
 from camstim import __version__
 
 AGENTLOG = os.path.join(CAMSTIM_DIR, 'agentlog')
@@ -481,9 +482,31 @@ class Agent(Publisher):
                 logging.warning("Failed to check DIO state: {}".format(e))
         return states
 
+    def prefetch_movies(self, script):
+        """
+        Starts copying the movies that a script uses into the local movie
+            cache, so that the script doesn't wait on network copies.
+
+        Args:
+            script (str): file path or just raw code.
+
+        Returns:
+            list: movie paths found in the script.
+
+        """
+        from camstim.movies import find_script_movies, prefetch_movies
+        if os.path.isfile(script):
+            with open(script, 'r') as f:
+                script = f.read()
+        movies = find_script_movies(script)
+        logging.info("Prefetching movies: {}".format(movies))
+        prefetch_movies(movies)
+        return movies
+
     def copy_arbitrary_file(self, source, destination, delete_source=False):
         """
-        Copies an arbitrary file.
+        Copies an arbitrary file.  Output files saved with sidecar arrays
+            are copied with their "<name>_arrays" folder.
 
         Args:
             source (str): source file path
@@ -492,10 +515,17 @@ class Agent(Publisher):
 
         """
         logging.info("Copying: \n {} -> {}".format(source, destination))
-        copyfile(source, destination)
+        is_output = source.endswith(".pkl") and \
+            os.path.isdir(get_array_dir(source))
+        if is_output:
+            copy_output(source, destination)
+        else:
+            shutil.copyfile(source, destination)
         logging.info("... Finished!")
         if delete_source:
             os.remove(source)
+            if is_output:
+                shutil.rmtree(get_array_dir(source))
             logging.info("SOURCE COPY REMOVED!")
 
     def get_last_output(self, root_dir):
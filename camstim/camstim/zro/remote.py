@@ -3,6 +3,7 @@
 import time
 from camstim.experiment import EObject
 from zro import Publisher
+from camstim.zro.telemetry import TelemetrySender, pack_telemetry
 
 class RemoteControl(Publisher, EObject):
     """
@@ -63,30 +64,63 @@ class RemoteControl(Publisher, EObject):
 class HabituationRemoteControl(RemoteControl):
     """ Passive habituation remote control.  Exposes controls for habituating
         animals and automatically publishes data every second.
+
+    Packets are published on updates where
+        `index % packet_interval == packet_phase`, where `index` counts
+        updates of the behavior task.
+
+    Packets are the original dictionaries by default.  If `binary` is True,
+        they are binary telemetry frames instead (see
+        `telemetry.pack_telemetry`) holding every lick, reward and encoder dx
+        since the last packet.  Only enable it for subscribers that decode
+        these frames; the header and footer are dictionaries either way.
+        Either way, packing and publishing happen on a background thread,
+        which drops the oldest packets if more than `max_queued` are waiting.
     """
     def __init__(self,
                  task,
                  rep_port=12000,
                  pub_port=9998,
+                 packet_phase=0,
+                 packet_interval=60,
+                 binary=False,
+                 max_queued=16,
                  ):
-        super(HabituationRemoteControl, self).__init__(self,
+        super(HabituationRemoteControl, self).__init__(task=task,
                                                        rep_port=rep_port,
                                                        pub_port=pub_port)
-        self._packet_interval = 60  #send a packet every 60 updates (frames)
+        self._packet_interval = packet_interval  # updates (frames) per packet
+        self._packet_phase = packet_phase % self._packet_interval
         self._packet_counter = 0
+        self._binary = binary
+        self._encoder_frame = 0  # first encoder frame not yet published
 
         # publish header automatically
         self.publish_header()
 
+        if binary:
+            self._sender = TelemetrySender(self.publish, pack=pack_telemetry,
+                                           max_queued=max_queued)
+        else:
+            self._sender = TelemetrySender(self.publish, max_queued=max_queued)
+        self._sender.start()
+
     def update(self, index=None):
         super(HabituationRemoteControl, self).update(index)
         if not index:
             index = self._task._update_count
-        if index % self._packet_interval == 0:
-            self.publish(self._build_packet())
+        if index % self._packet_interval == self._packet_phase:
+            self._sender.put(self._build_packet())
         self._packet_counter += 1
 
     def _build_packet(self):
+        if self._binary:
+            frame = self._encoder_frame
+            dx = self._task.encoders[0].dx
+            self._encoder_frame = len(dx)
+            return (self._packet_counter, frame, time.clock(),
+                    self._lick_packet, self._reward_packet,
+                    dx.tail(len(dx) - frame))
         return {
             "lick_sensors": self._lick_packet,
             "rewards": self._reward_packet,
@@ -108,11 +142,18 @@ class HabituationRemoteControl(RemoteControl):
     @property
     def _encoder_packet(self):
         """One packet of encoder data destined for display server."""
-        return self._task.encoders[0].dx[-59:]
+        return self._task.encoders[0].dx.tail(59).tolist()
+
+    def package(self):
+        data = super(HabituationRemoteControl, self).package()
+        data["telemetry"] = self._sender.package()
+        data["telemetry"]["binary"] = self._binary
+        return data
 
     def close(self):
-        """ Called at experiment end. Automatically publishes footer. """
-        self.publish_footer()
+        """ Called at experiment end. Sends queued packets then publishes
+            footer. """
+        self._sender.stop(last=self.publish_footer)
         super(HabituationRemoteControl, self).close()
 
 
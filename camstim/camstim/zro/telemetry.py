@@ -0,0 +1,279 @@
+"""
+telemetry.py
+
+Binary telemetry frames for live monitoring, and a background sender.
+
+A frame is a fixed header followed by three record arrays:
+
+    header      TELEMETRY_HEADER (little endian)
+                    magic       4s  'CSTL'
+                    version     H
+                    index       I   packet counter
+                    frame       I   first frame the packet covers
+                    time        d   time.clock() when the packet was built
+                    n_licks     H
+                    n_rewards   H
+                    n_encoder   H
+    licks       LICK_DTYPE * n_licks
+    rewards     REWARD_DTYPE * n_rewards
+    encoder     float32 * n_encoder (dx, one per frame from `frame`)
+
+"""
+import time
+import struct
+import logging
+import threading
+import collections
+from timeit import default_timer
+
+import numpy as np
+
+TELEMETRY_MAGIC = "CSTL"
+TELEMETRY_VERSION = 1
+TELEMETRY_HEADER = struct.Struct("<4sHIIdHHH")
+
+LICK_DTYPE = np.dtype([("sensor", "<u1"), ("frame", "<u4")])
+REWARD_DTYPE = np.dtype([("reward", "<u1"), ("time", "<f8"), ("frame", "<u4")])
+ENCODER_DTYPE = np.dtype("<f4")
+
+
+def pack_telemetry(index, frame, t, licks, rewards, dx):
+    """
+    Packs one telemetry frame.
+
+    args:
+        index (int): packet counter.
+        frame (int): first frame of the encoder data.
+        t (float): packet time.
+        licks (list): one list of lick frames per lick sensor.
+        rewards (list): one list of (time, frame) per reward.
+        dx (numpy.ndarray): encoder dx, one value per frame.
+
+    returns:
+        str: the packed frame.
+    """
+    lick_records = np.array([(i, f) for i, sensor in enumerate(licks)
+                             for f in sensor], dtype=LICK_DTYPE)
+    reward_records = np.array([(i, rt, f) for i, reward in enumerate(rewards)
+                               for rt, f in reward], dtype=REWARD_DTYPE)
+    dx = np.asarray(dx, dtype=ENCODER_DTYPE)
+    header = TELEMETRY_HEADER.pack(TELEMETRY_MAGIC, TELEMETRY_VERSION, index,
+                                   frame, t, len(lick_records),
+                                   len(reward_records), len(dx))
+    return "".join((header, lick_records.tostring(),
+                    reward_records.tostring(), dx.tostring()))
+
+
+def unpack_telemetry(data):
+    """
+    Unpacks a frame made by `pack_telemetry`.
+
+    returns:
+        dict: header fields plus "licks", "rewards" and "encoder" arrays.
+    """
+    fields = TELEMETRY_HEADER.unpack_from(data)
+    magic, version, index, frame, t, n_licks, n_rewards, n_encoder = fields
+    if magic != TELEMETRY_MAGIC:
+        raise ValueError("Not a telemetry frame.")
+    if version != TELEMETRY_VERSION:
+        raise ValueError("Unsupported telemetry version: {}".format(version))
+    offset = TELEMETRY_HEADER.size
+    licks = np.frombuffer(data, LICK_DTYPE, n_licks, offset)
+    offset += licks.nbytes
+    rewards = np.frombuffer(data, REWARD_DTYPE, n_rewards, offset)
+    offset += rewards.nbytes
+    encoder = np.frombuffer(data, ENCODER_DTYPE, n_encoder, offset)
+    return {
+        "index": index,
+        "frame": frame,
+        "time": t,
+        "licks": licks,
+        "rewards": rewards,
+        "encoder": encoder,
+    }
+
+
+class TelemetrySender(object):
+    """
+    Sends items from a background thread.  `put` never blocks: if more than
+        `max_queued` items are waiting, the oldest is dropped, counted in
+        `dropped` and logged.
+
+    `send` is only called on the sender thread, so it can use a socket that
+        isn't thread safe.  A final item, like a footer, can be sent after the
+        queue with `stop(last=...)`.
+
+    args:
+        send (callable): called with each item (after `pack`) on the sender
+            thread.
+        pack (callable): optional, converts an item before sending.  Lets
+            the caller hand over raw data and keep packing off its thread.
+        max_queued (int): number of items held before dropping.
+
+    """
+    def __init__(self, send, pack=None, max_queued=16):
+        self._send = send
+        self._pack = pack
+        self.max_queued = max_queued
+        self.sent = 0
+        self.dropped = 0
+        self.bytes_sent = 0
+        self._queue = collections.deque(maxlen=max_queued)
+        self._wake = threading.Event()
+        self._running = False
+        self._last = None
+        self._thread = None
+
+    def start(self):
+        self._running = True
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def put(self, item):
+        if len(self._queue) == self.max_queued:
+            self.dropped += 1
+            logging.warning("Telemetry sender queue is full, dropped the "
+                            "oldest item ({} dropped).".format(self.dropped))
+        self._queue.append(item)
+        self._wake.set()
+
+    def stop(self, timeout=2.0, last=None):
+        """
+        Sends what is queued and stops the thread.
+
+        args:
+            timeout (float): seconds to wait for the queue to be sent.
+            last (callable): called on the sender thread once the queue is
+                sent.  Still called there if that takes longer than
+                `timeout`.
+        """
+        self._last = last
+        self._running = False
+        self._wake.set()
+        if self._thread:
+            self._thread.join(timeout)
+            if self._thread.is_alive():
+                logging.warning("Telemetry sender still had {} items queued "
+                                "after {} s.".format(len(self._queue),
+                                                     timeout))
+        elif last:
+            last()
+        if self.dropped:
+            logging.warning("Telemetry sender dropped {} items.".format(
+                self.dropped))
+
+    def _run(self):
+        while True:
+            self._wake.wait(0.5)
+            self._wake.clear()
+            while self._queue:
+                item = self._queue.popleft()
+                try:
+                    if self._pack:
+                        item = self._pack(*item)
+                    self._send(item)
+                except Exception as e:
+                    logging.warning("Failed to send telemetry: {}".format(e))
+                    continue
+                self.sent += 1
+                if isinstance(item, str):
+                    self.bytes_sent += len(item)
+            if not self._running:
+                break
+        if self._last:
+            try:
+                self._last()
+            except Exception as e:
+                logging.warning("Failed to send telemetry: {}".format(e))
+
+    def package(self):
+        return {
+            "max_queued": self.max_queued,
+            "sent": self.sent,
+            "dropped": self.dropped,
+            "bytes_sent": self.bytes_sent,
+        }
+
+
+def benchmark(packets=2000, interval=60, port=9997):
+    """
+    Publishes `packets` telemetry packets to a local zmq subscriber, once as
+        pickled dictionaries and once as binary frames, and reports the time
+        spent on the publishing thread and the subscriber throughput.
+
+    args:
+        packets (int): packets per run.
+        interval (int): frames per packet.
+        port (int): local port to publish on.
+
+    returns:
+        dict: results for "pickle" and "binary".
+    """
+    import zmq
+
+    rng = np.random.RandomState(0)
+    licks = [list(np.sort(rng.randint(0, interval, 3)))]
+    rewards = [[(1.5, 10)]]
+    dx = rng.randn(interval).astype(np.float32)
+
+    def build_dict(i):
+        return {"lick_sensors": licks, "rewards": rewards,
+                "encoder": dx.tolist(), "index": i}
+
+    context = zmq.Context()
+    results = {}
+    for name in ("pickle", "binary"):
+        pub = context.socket(zmq.PUB)
+        pub.bind("tcp://127.0.0.1:{}".format(port))
+        sub = context.socket(zmq.SUB)
+        sub.connect("tcp://127.0.0.1:{}".format(port))
+        sub.setsockopt(zmq.SUBSCRIBE, "")
+        time.sleep(0.5)  # let the subscription through
+
+        if name == "pickle":
+            sender = TelemetrySender(pub.send_pyobj, max_queued=packets)
+        else:
+            sender = TelemetrySender(pub.send, pack=pack_telemetry,
+                                     max_queued=packets)
+        sender.start()
+
+        received = [0, 0]
+
+        def receive():
+            while received[0] < packets:
+                if not sub.poll(1000):
+                    break
+                received[1] += len(sub.recv())
+                received[0] += 1
+
+        subscriber = threading.Thread(target=receive)
+        subscriber.start()
+
+        start = default_timer()
+        for i in range(packets):
+            if name == "pickle":
+                sender.put(build_dict(i))
+            else:
+                sender.put((i, i * interval, time.clock(), licks, rewards,
+                            dx))
+        producer = default_timer() - start
+        sender.stop(timeout=30.0)
+        subscriber.join()
+        elapsed = default_timer() - start
+
+        results[name] = {
+            "producer_us_per_packet": producer / packets * 1e6,
+            "received": received[0],
+            "bytes_per_packet": received[1] / max(received[0], 1),
+            "packets_per_s": received[0] / elapsed,
+        }
+        pub.close()
+        sub.close()
+    context.term()
+    return results
+
+
+if __name__ == "__main__":
+    for name, result in sorted(benchmark().items()):
+        print("{}: {}".format(name, result))
@@ -1,3 +1,79 @@
 """
 test_behavior.py
 """
+import threading
+import time
+
+from camstim.behavior import (BehaviorEncoder, SimulatedEncoder,
+                              SimulatedLickSensor)
+
+
+def test_threaded_simulated_encoder():
+    encoder = BehaviorEncoder(SimulatedEncoder(speed=360.0),
+                              acquisition_thread=True,
+                              sample_rate=1000.0)
+    encoder.start()
+    try:
+        for i in range(5):
+            time.sleep(0.02)
+            encoder.update(i)
+    finally:
+        encoder.close()
+
+    dx = encoder.dx.to_array()
+    samples = encoder.samples.to_array()
+    assert len(dx) == len(samples) == 5
+    assert samples.sum() > 20
+    # 360 deg/s for ~0.1 s
+    assert 20 < dx.sum() < 60
+    assert encoder.dropped_samples == 0
+
+
+def test_simulated_encoder_keys_on_main_thread():
+    simulated = SimulatedEncoder(key_speed=360.0)
+    threads = []
+
+    def check_keys():
+        threads.append(threading.current_thread())
+        return 1
+    simulated._check_keys = check_keys
+
+    encoder = BehaviorEncoder(simulated, acquisition_thread=True,
+                              sample_rate=1000.0)
+    encoder.start()
+    try:
+        for i in range(5):
+            time.sleep(0.02)
+            encoder.update(i)
+    finally:
+        encoder.close()
+
+    assert len(threads) == 5
+    assert set(threads) == set([threading.current_thread()])
+    assert encoder.dx.to_array().sum() > 20
+
+
+def test_polled_lick_sensor_edges():
+    sensor = SimulatedLickSensor(lick_ms=5.0)
+    sensor.set_polling(2000.0)
+    licks = []
+    sensor.lickOccurred.connect(licks.append)
+    sensor.start()
+    try:
+        sensor.update(0)
+        t0 = time.clock()
+        sensor.lick()  # shorter than a frame
+        time.sleep(0.02)
+        sensor.update(1)
+        sensor.lick()
+        time.sleep(0.02)
+        sensor.flush()
+        sensor.update(2)
+    finally:
+        sensor.close()
+
+    # each lick reported once, with the frame it happened in
+    assert [frame for t, frame in licks] == [0, 1]
+    assert licks[0][0] >= t0
+    assert sensor.lick_events == [0, 1]
+    assert list(sensor.lick_data) == [0, 1, 1]
@@ -0,0 +1,58 @@
+"""
+test_buffers.py
+
+Tests for the growable data log buffers.
+
+"""
+import numpy as np
+
+from camstim.buffers import GrowableArray, ColumnLog, RingBuffer
+
+
+def test_growable_array():
+    buf = GrowableArray(np.float32, chunk_size=8)
+    values = np.arange(30, dtype=np.float32) * 0.5
+    for v in values[:20]:
+        buf.append(v)
+    assert len(buf) == 20
+    assert np.array_equal(buf.tail(13), values[7:20])
+
+    exported = buf.to_array()
+    assert exported.dtype == np.float32
+    assert np.array_equal(exported, values[:20])
+
+    # merged buffer has room to grow, later exports share its memory
+    buf.extend(values[20:25])
+    again = buf.to_array()
+    assert np.shares_memory(exported, again)
+    assert np.array_equal(again, values[:25])
+    assert np.array_equal(np.array(buf), values[:25])
+    assert buf[-1] == values[24]
+    assert np.array_equal(buf.tail(100), values[:25])
+
+
+def test_column_log():
+    log = ColumnLog([("value", object), ("frame", np.int64)], chunk_size=2)
+    rows = [(("gratings", 90), 0), ("im065", 12), (None, 30)]
+    for row in rows:
+        log.append(row)
+    assert len(log) == 3
+    assert log.rows() == rows
+    arrays = log.to_arrays()
+    assert np.array_equal(arrays["frame"], [0, 12, 30])
+    assert arrays["value"][0] == ("gratings", 90)
+
+
+def test_ring_buffer():
+    ring = RingBuffer(size=4, dtype=np.int32)
+    assert len(ring.read()) == 0
+    for i in range(3):
+        ring.write(i)
+    assert list(ring.read()) == [0, 1, 2]
+    for i in range(3, 6):
+        ring.write(i)
+    assert list(ring.read()) == [3, 4, 5]  # wraps around
+    for i in range(6, 13):
+        ring.write(i)
+    assert list(ring.read()) == [9, 10, 11, 12]
+    assert ring.dropped == 3
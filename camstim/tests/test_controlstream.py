@@ -0,0 +1,76 @@
+"""
+test_controlstream.py
+
+Tests for the SweepStim control stream.
+
+"""
+import socket
+import time
+
+import pytest
+
+from camstim.sweepstim import ControlStream
+
+
+class Child(object):
+    def __init__(self):
+        self.runs = 1
+        self.opacity = 1.0
+        self._private = 0
+
+
+class Parent(object):
+    def __init__(self):
+        self.vsynccount = 0
+        self.stimuli = [Child()]
+        self.stopped = False
+
+    def stop(self):
+        self.stopped = True
+
+
+@pytest.fixture
+def stream():
+    allowed = {"SET": ["stimuli.*"], "GET": ["*"], "RUN": ["stop"]}
+    stream = ControlStream(0, Parent(), allowed)
+    stream.start()
+    yield stream
+    stream.close()
+
+
+def send(stream, *commands):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    for command in commands:
+        sock.sendto(command, stream.sock.getsockname())
+    sock.close()
+    # wait for the receive thread to queue or reject everything
+    for _ in range(100):
+        if stream._queue.qsize() + len(stream.rejected) >= len(commands):
+            break
+        time.sleep(0.01)
+
+
+def test_commands_applied_on_update(stream):
+    parent = stream.parent
+    send(stream, "SET stimuli.0.runs 3", "SET stimuli.0.opacity 0", "RUN stop")
+    assert parent.stimuli[0].runs == 1
+
+    parent.vsynccount = 2
+    stream.update(2)
+    assert parent.stimuli[0].runs == 3
+    assert parent.stimuli[0].opacity == 0.0
+    assert isinstance(parent.stimuli[0].opacity, float)
+    assert parent.stopped
+    assert [c[4] - c[3] for c in stream.commandrecord] == [2, 2, 2]
+
+
+def test_commands_rejected(stream):
+    parent = stream.parent
+    send(stream, "SET vsynccount 10", "SET stimuli.0._private 1",
+         "RUN __class__", "SET stimuli.0.runs __import__('os')")
+    stream.update(0)
+    assert len(stream.rejected) == 3
+    assert parent.vsynccount == 0
+    assert parent.stimuli[0]._private == 0
+    assert parent.stimuli[0].runs == 1
+    assert stream.commandrecord == []
@@ -0,0 +1,46 @@
+"""
+test_frameloop.py
+
+Tests for the vsync-locked frame loop.
+
+"""
+import numpy as np
+
+from camstim.frameloop import FrameLoop, VirtualClock
+
+
+def test_virtual_clock_paced_loop():
+    clock = VirtualClock(fps=200.0)
+    budgets = []
+    updates = []
+
+    def update(index):
+        updates.append(index)
+        if index == 19:
+            loop.stop()
+
+    loop = FrameLoop(update, clock.flip, process_events=budgets.append,
+                     event_budget_ms=1.5, fps=200.0)
+    loop.run()
+
+    assert updates == range(20)
+    assert loop.frame_count == 20
+    # stopped during the last update, so it was not flipped
+    assert budgets == [1.5] * 19
+    assert np.allclose(loop.intervals, 0.005, atol=0.004)
+
+    data = loop.package()
+    assert len(data['intervals_ms']) == 18
+    assert len(data['latency_ms']) == 19
+    assert data['jitter_ms'] >= 0.0
+    assert data['phases']['phase_names'] == ['update', 'flip', 'events']
+
+
+def test_virtual_clock_drops_missed_ticks():
+    clock = VirtualClock(fps=100.0)
+    clock.flip()
+    start = clock._next
+    clock._next -= 0.025  # 2.5 ticks late
+    clock.flip()
+    # back on the tick grid, half a tick along
+    assert np.isclose(clock._next, start + 0.005)
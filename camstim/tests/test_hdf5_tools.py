@@ -0,0 +1,77 @@
+"""
+test_hdf5_tools.py
+
+Tests for the HDF5 exporter and lazy reader.
+
+"""
+import cPickle as pickle
+
+import numpy as np
+import pytest
+
+h5py = pytest.importorskip("h5py")
+
+from camstim.utils.hdf5_tools import HDF5Output, chunk_shape, export_hdf5
+
+
+def make_output():
+    frames = 5000
+    return {
+        "intervalsms": np.random.rand(frames - 1) + 16.0,
+        "vsynccount": frames,
+        "script": "print 'hello'",
+        "stimuli": [{
+            "stim_path": "gratings",
+            "sweep_table": [(0.0, "a", 0.04), (90.0, "b", 0.08)],
+            "frame_list": [0, -1, 1] * 100,
+            "draw_log": np.ones(frames, dtype=np.uint8),
+            "posbyframe": [np.random.rand(40, 2) for _ in range(50)],
+            "display_sequence": None,
+        }],
+        "items": {
+            "behavior": {
+                "encoders": [{"dx": np.random.rand(frames).astype(np.float32)}],
+                "lick_sensors": [{"lick_data": (np.array([10, 200]),)}],
+                "params": {1: "not a valid name"},
+            },
+        },
+    }
+
+
+def test_chunk_shape():
+    assert chunk_shape((100,), 8) == (100,)
+    assert chunk_shape((10 ** 6,), 8) == (32768,)
+    assert chunk_shape((10 ** 4, 40, 2), 8) == (409, 40, 2)
+    assert chunk_shape((0,), 8) is None
+
+
+def test_export_and_lazy_read(tmpdir):
+    data = make_output()
+    pkl_path = str(tmpdir.join("session.pkl"))
+    with open(pkl_path, "wb") as f:
+        pickle.dump(data, f)
+    h5_path = export_hdf5(pkl_path)
+    assert h5_path == str(tmpdir.join("session.h5"))
+
+    with HDF5Output(h5_path) as output:
+        assert output["vsynccount"] == 5000
+        assert output["script"] == data["script"]
+
+        dx = output["items/behavior/encoders/0/dx"]
+        assert dx.compression == "gzip"
+        assert np.array_equal(dx[100:200],
+                              data["items"]["behavior"]["encoders"][0]["dx"][100:200])
+
+        stim = output["stimuli"][0]
+        assert stim["posbyframe"].shape == (50, 40, 2)
+        assert stim["sweep_table"][1].tolist() == (90.0, "b", 0.08)
+        assert stim["display_sequence"] is None
+        assert output["items/behavior/params"] == {1: "not a valid name"}
+
+        full = output.read()
+        assert isinstance(full["stimuli"], list)
+        assert np.array_equal(full["stimuli"][0]["frame_list"],
+                              data["stimuli"][0]["frame_list"])
+        assert np.array_equal(full["intervalsms"], data["intervalsms"])
+        assert full["items"]["behavior"]["lick_sensors"][0]["lick_data"].tolist() \
+            == [10, 200]
@@ -0,0 +1,85 @@
+"""
+test_images.py
+
+Tests for the decoded image cache and converted image sets.
+
+"""
+import os
+import zipfile
+import cPickle as pickle
+
+import numpy as np
+
+from camstim.images import DecodedImageCache, ImageSetCache
+
+
+def test_decoded_image_cache(tmpdir):
+    decoded = []
+
+    def decode(path):
+        decoded.append(os.path.basename(path))
+        if path.endswith("bad.png"):
+            raise IOError("can't decode")
+        return np.full((4, 6), len(open(path).read()), dtype=np.uint8)
+
+    paths = []
+    for name, text in [("a.png", "a"), ("b.png", "bb"), ("bad.png", "?"),
+                       ("copy_of_a.png", "a")]:
+        path = str(tmpdir.join(name))
+        with open(path, 'w') as f:
+            f.write(text)
+        paths.append(path)
+
+    cache = DecodedImageCache(str(tmpdir.join("cache")), decode=decode)
+    images = cache.load_all(paths, workers=3)
+    assert images[0][0, 0] == 1
+    assert images[1][0, 0] == 2
+    assert isinstance(images[2], IOError)
+    assert isinstance(images[1], np.memmap)
+
+    # cached by content, so only the failed image is decoded again
+    del decoded[:]
+    again = cache.load_all(paths, workers=1)
+    assert decoded == ["bad.png"]
+    assert np.array_equal(again[3], images[0])
+
+
+def test_image_set_cache(tmpdir):
+    image_set = {
+        "im000": {"a": np.zeros((3, 4), np.uint8),
+                  "b": np.ones((3, 4), np.uint8)},
+        "im001": {"c": np.full((5, 2), 7, np.uint8)},
+    }
+    pkl = str(tmpdir.join("images.pkl"))
+    with open(pkl, 'wb') as f:
+        pickle.dump(image_set, f, 2)
+    source = str(tmpdir.join("images.zip"))
+    with zipfile.ZipFile(source, 'w') as z:
+        z.write(pkl, "images.pkl")
+    csv = str(tmpdir.join("matrix.csv"))
+    with open(csv, 'w') as f:
+        f.write("aa,ab\nba,bb\n")
+
+    cache = ImageSetCache(str(tmpdir.join("cache")))
+    loaded = cache.get_image_set(source)
+    assert list(loaded) == list(image_set)
+    for group_name, group in image_set.items():
+        assert list(loaded[group_name]) == list(group)
+        for name, image in group.items():
+            assert np.array_equal(loaded[group_name][name], image)
+            assert isinstance(loaded[group_name][name].base, np.memmap)
+
+    # opened from the cache without reading the source
+    os.remove(pkl)
+    with open(source, 'r+b') as f:
+        content = f.read()
+    st = os.stat(source)
+    with open(source, 'wb') as f:
+        f.write(b"x" * len(content))
+    os.utime(source, (st.st_atime, st.st_mtime))
+    assert np.array_equal(cache.get_image_set(source)["im001"]["c"],
+                          image_set["im001"]["c"])
+
+    matrix = cache.get_sampling_matrix(csv)
+    assert matrix.tolist() == [[b"aa", b"ab"], [b"ba", b"bb"]]
+    assert isinstance(cache.get_sampling_matrix(csv), np.memmap)
@@ -0,0 +1,200 @@
+"""
+test_misc.py
+
+Tests for the output serializer and image texture updates in misc.py.
+
+"""
+import os
+import ctypes
+import cPickle as pickle
+from collections import OrderedDict
+
+import numpy as np
+import pytest
+
+from camstim import misc
+from camstim.misc import (ImageStimNumpyuByte, PickleSerializer,
+                          wecanpicklethat)
+from camstim.utils.output_tools import (IndexedOutput, copy_output,
+                                        get_array_dir, is_indexed_output,
+                                        load_output)
+
+
+@pytest.fixture
+def serializer():
+    return PickleSerializer()
+
+
+def test_wecanpicklethat():
+    data = wecanpicklethat({'a': 1, '_private': 2})
+    assert data == {'a': 1, 'unpickleable': []}
+
+
+def test_serializer_roundtrip(serializer):
+    data = wecanpicklethat({
+        'intervalsms': np.arange(100, dtype=np.float64),
+        'items': OrderedDict([('b', {'c': 1}), ('a', [1, 2])]),
+        'name': "test",
+    })
+    loaded = pickle.loads(serializer.dumps(data))
+    assert np.array_equal(loaded['intervalsms'], data['intervalsms'])
+    assert loaded['items'] == data['items']
+    assert isinstance(loaded['items'], OrderedDict)
+    assert loaded['unpickleable'] == []
+    assert serializer.unpickleable == []
+
+
+def test_serializer_unpickleable(serializer):
+    stim = wecanpicklethat({'sweep_table': [(0,), (1,)], 'stim': lambda: 0})
+    data = wecanpicklethat({'stimuli': [stim], 'socket': lambda: 1})
+    loaded = pickle.loads(serializer.dumps(data))
+    assert loaded['unpickleable'] == ['socket']
+    assert loaded['stimuli'][0]['sweep_table'] == [(0,), (1,)]
+    assert loaded['stimuli'][0]['unpickleable'] == ['stim']
+    assert sorted(serializer.unpickleable) == ['socket', 'stimuli[0].stim']
+
+
+def test_sidecar_arrays(tmpdir):
+    path = str(tmpdir) + "/output.pkl"
+    posbyframe = [np.full((50, 2), i, dtype=np.int16) for i in range(1000)]
+    data = wecanpicklethat({
+        'intervalsms': np.arange(10000, dtype=np.float64),
+        'small': np.arange(4),
+        'session_params': {'posbyframe': posbyframe},
+    })
+    serializer = PickleSerializer(array_dir=get_array_dir(path))
+    with open(path, 'wb') as f:
+        serializer.dump(data, f)
+    assert len(os.listdir(get_array_dir(path))) == 2
+
+    loaded = load_output(path)
+    assert isinstance(loaded['intervalsms'], np.memmap)
+    assert np.array_equal(loaded['intervalsms'], data['intervalsms'])
+    assert not isinstance(loaded['small'], np.memmap)
+    rows = loaded['session_params']['posbyframe']
+    assert type(rows) is list and len(rows) == 1000
+    assert rows[10].shape == (50, 2)
+    assert np.array_equal(rows[10], posbyframe[10])
+    assert isinstance(rows[10], np.memmap)
+
+
+def test_copy_sidecar_output(tmpdir):
+    path = str(tmpdir.mkdir("output").join("session.pkl"))
+    data = {'intervalsms': np.arange(10000, dtype=np.float64)}
+    serializer = PickleSerializer(array_dir=get_array_dir(path))
+    with open(path, 'wb') as f:
+        serializer.dump(data, f)
+
+    copy = str(tmpdir.mkdir("backup").join("session.pkl"))
+    copy_output(path, copy)
+    copy_output(path, copy)  # overwrites
+    loaded = load_output(copy)
+    assert np.array_equal(loaded['intervalsms'], data['intervalsms'])
+    assert loaded['intervalsms'].filename.startswith(str(tmpdir.join("backup")))
+
+
+def test_indexed_output_plain_backup(tmpdir):
+    from camstim.experiment import OutputFile
+    output_file = OutputFile(output={'intervalsms': np.arange(10)},
+                             indexed=True)
+    output_file.save(str(tmpdir.join("output.pkl")))
+    assert is_indexed_output(output_file.path)
+    output_file.save(str(tmpdir.join("backup.pkl")), indexed=False)
+    with open(output_file.path, 'rb') as f:
+        assert np.array_equal(pickle.load(f)['intervalsms'], np.arange(10))
+
+
+def test_indexed_output(tmpdir):
+    path = str(tmpdir) + "/output.pkl"
+    stim = wecanpicklethat({'display_sequence': [(0, 60)], 'stim': lambda: 0})
+    data = wecanpicklethat({
+        'intervalsms': np.arange(10000, dtype=np.float64),
+        'stimuli': [stim, {'display_sequence': [(60, 120)]}],
+        'items': OrderedDict([('behavior', {'dx': np.ones(10)})]),
+        'socket': lambda: 1,
+    })
+    serializer = PickleSerializer(array_dir=get_array_dir(path),
+                                  min_array_bytes=1000)
+    with open(path, 'wb') as f:
+        discarded = serializer.dump_indexed(data, f)
+    assert sorted(discarded) == ['socket', 'stimuli/0.stim']
+
+    with IndexedOutput(path) as output:
+        assert sorted(output.keys()) == ['intervalsms', 'items', 'stimuli',
+                                         'unpickleable']
+        assert output['stimuli/1']['display_sequence'] == [(60, 120)]
+        assert output['stimuli'][0]['unpickleable'] == ['stim']
+        assert isinstance(output['intervalsms'], np.memmap)
+        assert output['items'].keys() == ['behavior']
+
+    loaded = load_output(path)
+    assert loaded['unpickleable'] == ['socket']
+    assert np.array_equal(loaded['intervalsms'], data['intervalsms'])
+    assert np.array_equal(loaded['items']['behavior']['dx'], np.ones(10))
+
+
+class FakeGL(object):
+    """ Records texture calls. """
+    GLuint = ctypes.c_uint
+
+    def __init__(self):
+        self.calls = []
+        self.next_id = 10
+
+    def __getattr__(self, name):
+        if name.startswith("GL_"):
+            return name
+        def call(*args):
+            self.calls.append(name)
+        return call
+
+    def glGenTextures(self, n, tid):
+        tid._obj.value = self.next_id
+        self.next_id += 1
+
+    def glBindTexture(self, target, tid):
+        self.calls.append(("bind", tid.value))
+
+
+def make_image_stim(**kwargs):
+    stim = ImageStimNumpyuByte.__new__(ImageStimNumpyuByte)
+    stim._texID = ctypes.c_uint(1)  # made by ImageStim
+    stim.__init__(None, image=np.zeros((4, 6), np.uint8), **kwargs)
+    return stim
+
+
+def test_image_stim_texture_updates(monkeypatch):
+    gl = FakeGL()
+    monkeypatch.setattr(misc, "GL", gl)
+
+    stim = make_image_stim()
+    assert gl.calls.count("glTexImage2D") == 1
+    del gl.calls[:]
+    stim.setReplaceImage(np.ones((4, 6), np.uint8))
+    assert gl.calls == ["glEnable", ("bind", 1), "glTexSubImage2D"]
+    stim.setReplaceImage(np.ones((5, 6), np.uint8))  # new size
+    assert "glTexImage2D" in gl.calls
+
+    # preloaded images are only rebound
+    images = [np.full((4, 6), i, np.uint8) for i in range(3)]
+    stim.preload(images)
+    del gl.calls[:]
+    stim._needUpdate = False
+    stim.setReplaceImage(images[1])
+    assert gl.calls == []
+    assert stim._texID.value == 11 and stim._needUpdate
+    stim.setReplaceImage(np.ones((4, 6), np.uint8))
+    assert stim._texID.value == 1
+
+
+def test_image_stim_double_buffer(monkeypatch):
+    gl = FakeGL()
+    monkeypatch.setattr(misc, "GL", gl)
+
+    stim = make_image_stim(double_buffer=True)
+    shown = []
+    for i in range(4):
+        stim.setReplaceImage(np.full((4, 6), i, np.uint8))
+        shown.append(stim._texID.value)
+    assert shown == [1, 10, 1, 10]
+    assert gl.calls.count("glTexImage2D") == 2
@@ -0,0 +1,170 @@
+"""
+test_movies.py
+
+Tests for memory-mapped movie reading and the movie cache.
+
+"""
+import os
+import shutil
+import threading
+import time
+
+import numpy as np
+import pytest
+
+from camstim.movies import (FileLock, MovieCache, MovieFrameReader,
+                            find_script_movies, open_numpy_movie)
+
+
+@pytest.fixture
+def movie(tmpdir):
+    path = str(tmpdir.join("movie.npy"))
+    frames = np.arange(50, dtype=np.uint8)[:, None, None] * np.ones((1, 6, 8),
+                                                                    np.uint8)
+    np.save(path, frames)
+    return open_numpy_movie(path)
+
+
+def test_open_numpy_movie(tmpdir, movie):
+    assert isinstance(movie, np.memmap)
+    path = str(tmpdir.join("bad.npy"))
+    np.save(path, np.zeros((4, 4), np.uint8))
+    with pytest.raises(ValueError):
+        open_numpy_movie(path)
+
+
+def test_read_ahead(movie):
+    order = [3, 4, 5, 40, 41, 0, 1, 2, 3, 49]
+    reader = MovieFrameReader(movie, order, ring_size=4)
+    reader.start()
+    try:
+        shown = []
+        for k in range(len(order)):
+            for _ in range(100):  # let the reader get ahead
+                if reader._produced > k or reader._produced == len(order):
+                    break
+                time.sleep(0.001)
+            shown.append(reader.get(k)[0, 0])
+            assert reader.get(k) is reader.get(k)
+        assert shown == order
+        assert reader.misses == 0
+
+        # jumping back is read directly, and read ahead continues after it
+        assert reader.get(1)[0, 0] == 4
+        assert reader.misses == 1
+        time.sleep(0.05)
+        assert reader.get(2)[0, 0] == 5
+        assert reader.misses == 1
+    finally:
+        reader.stop()
+
+
+def test_movie_cache(tmpdir):
+    share = tmpdir.mkdir("share")
+    sources = []
+    for i in range(3):
+        path = str(share.join("movie{}.npy".format(i)))
+        np.save(path, np.full((10, 100, 100), i, dtype=np.uint8))
+        sources.append(path)
+    size = os.path.getsize(sources[0])
+    cache = MovieCache(str(tmpdir.join("cache")), quota_bytes=2 * size,
+                       chunk_size=8192, workers=3)
+
+    cache.prefetch(sources[:2])
+    assert cache.wait() == {}
+    local = cache.get(sources[0])
+    assert open(local, 'rb').read() == open(sources[0], 'rb').read()
+    assert cache.hash_file(local) == cache._index["movie0.npy"]["sha1"]
+
+    # truncated copies are caught
+    with open(local, 'r+b') as f:
+        f.truncate(size - 10)
+    assert not cache.is_valid(sources[0])
+    # corrupt copies are caught
+    local1 = cache.local_path(sources[1])
+    with open(local1, 'r+b') as f:
+        f.seek(200)
+        f.write("x")
+    os.utime(local1, (0, 0))
+    assert not cache.is_valid(sources[1])
+
+    cache.get(sources[0])
+    time.sleep(0.01)
+    cache.get(sources[2])  # over quota, evicts movie1
+    assert sorted(cache._index) == ["movie0.npy", "movie2.npy"]
+    assert not os.path.exists(local1)
+    assert [f for f in os.listdir(cache.cache_dir) if
+            f.endswith(".part") or f.endswith(".lock")] == []
+
+    script = "m = MovieStim(r'C:\\movies\\a.npy', window)\nb = \"b.npy\""
+    assert find_script_movies(script) == ["C:\\movies\\a.npy", "b.npy"]
+
+
+def test_shared_movie_cache(tmpdir):
+    share = tmpdir.mkdir("share")
+    sources = []
+    for i in range(3):
+        path = str(share.join("movie{}.npy".format(i)))
+        np.save(path, np.full((10, 100, 100), i, dtype=np.uint8))
+        sources.append(path)
+    cache_dir = str(tmpdir.join("cache"))
+    # one cache per process
+    agent = MovieCache(cache_dir, chunk_size=8192)
+    script = MovieCache(cache_dir, chunk_size=8192)
+
+    # the script waits for a copy that the agent has in flight
+    lock = FileLock(os.path.join(cache_dir, "movie0.npy.lock"))
+    lock.acquire()
+    thread = threading.Thread(target=script.get, args=(sources[0],))
+    thread.start()
+    time.sleep(0.2)
+    assert thread.is_alive()
+    agent.get(sources[1])
+    lock.release()
+    thread.join()
+
+    # neither overwrote the other's index entry
+    assert sorted(agent._load_index()) == ["movie0.npy", "movie1.npy"]
+    agent.get(sources[0])  # copied by the script, so not copied again
+    assert agent._index["movie0.npy"]["mtime"] == \
+        script._index["movie0.npy"]["mtime"]
+
+    # stale locks are removed
+    lock_path = os.path.join(cache_dir, "movie2.npy.lock")
+    open(lock_path, 'w').close()
+    os.utime(lock_path, (0, 0))
+    script.get(sources[2])
+    assert not os.path.exists(lock_path)
+    assert [f for f in os.listdir(cache_dir) if f.endswith(".stale")] == []
+
+    # locks that were taken over aren't removed by their old owner
+    lock = FileLock(lock_path)
+    lock.acquire()
+    assert open(lock_path).read().split()[0] == str(os.getpid())
+    with open(lock_path, 'w') as f:
+        f.write("another owner")
+    lock.release()
+    assert open(lock_path).read() == "another owner"
+    os.remove(lock_path)
+
+    # a stale lock replaced by a live one after it was checked is kept
+    with open(lock_path, 'w') as f:
+        f.write("live owner")
+    os.utime(lock_path, (0, 0))
+    waiter = FileLock(lock_path)
+    reads = ["dead owner"]
+    read = waiter._read
+    waiter._read = lambda path: reads.pop() if reads else read(path)
+    waiter._remove_stale()
+    assert open(lock_path).read() == "live owner"
+    assert [f for f in os.listdir(cache_dir) if f.endswith(".stale")] == []
+    os.remove(lock_path)
+
+    # the cached copy is checked on its own when the source is unreachable
+    shutil.rmtree(str(share))
+    assert script.is_valid(sources[0])
+    local = script.local_path(sources[0])
+    with open(local, 'r+b') as f:
+        f.seek(200)
+        f.write("x")
+    assert not script.is_valid(sources[0])
@@ -0,0 +1,57 @@
+"""
+test_profiler.py
+
+Tests the frame profiler ring buffer and summaries.
+
+"""
+import time
+
+import pytest
+
+from camstim.profiler import FrameProfiler
+
+
+@pytest.fixture
+def profiler():
+    return FrameProfiler(size=8, n_slowest=3)
+
+
+def test_phases(profiler):
+    for vsync in range(20):
+        profiler.start_frame(vsync)
+        profiler.mark("stimuli")
+        if vsync == 13:
+            time.sleep(0.01)
+        profiler.mark("flip")
+    output = profiler.package()
+    assert output['phase_names'] == ["stimuli", "flip"]
+    assert output['frame_count'] == 20
+    assert output['histograms']['flip'].sum() == 20
+    assert output['frame_histogram'].sum() == 20
+    assert output['slowest'][0]['vsync'] == 13
+    assert output['slowest'][0]['phases_ms']['flip'] >= 10.0
+    assert len(output['slowest']) == 3
+
+
+def test_max_phases():
+    profiler = FrameProfiler(size=4, max_phases=1)
+    profiler.start_frame(0)
+    profiler.mark("stimuli")
+    profiler.mark("flip")
+    assert profiler.package()['phase_names'] == ["stimuli"]
+
+
+def test_phases_that_skip_frames(profiler):
+    for vsync in range(20):
+        profiler.start_frame(vsync)
+        profiler.mark("stimuli")
+        if vsync % 5 == 0:
+            time.sleep(0.002)
+            profiler.mark("interval_item")
+        profiler.mark("flip")
+    output = profiler.package()
+    assert output['phase_counts'] == {"stimuli": 20, "interval_item": 4,
+                                      "flip": 20}
+    assert output['histograms']['interval_item'].sum() == 4
+    assert output['histograms']['interval_item'][0] == 0
+    assert output['mean_ms']['interval_item'] >= 2.0
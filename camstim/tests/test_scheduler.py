@@ -0,0 +1,67 @@
+"""
+test_scheduler.py
+
+Tests for the item update scheduler.
+
+"""
+from camstim.scheduler import ItemScheduler
+
+
+class Item(object):
+    pass
+
+
+class SlowItem(object):
+    update_interval = 10
+
+
+def test_every_frame_by_default():
+    scheduler = ItemScheduler()
+    item = Item()
+    scheduler.add("item", item)
+    assert [scheduler.due(f) for f in range(3)] == [[("item", item)]] * 3
+
+
+def test_interval_and_phase():
+    scheduler = ItemScheduler()
+    scheduler.add("slow", SlowItem())
+    scheduler.add("fixed", Item(), interval=4, phase=6)
+    assert [f for f in range(30) if scheduler.due(f)] == \
+        [0, 2, 6, 10, 14, 18, 20, 22, 26]
+    schedule = scheduler.package()
+    assert schedule["slow"] == {'interval': 10, 'phase': 0, 'priority': 0}
+    assert schedule["fixed"]["phase"] == 2
+
+
+def test_phases_are_spread():
+    scheduler = ItemScheduler()
+    scheduler.add("sync", Item())
+    for i in range(3):
+        scheduler.add(str(i), Item(), interval=3)
+    assert [scheduler.package()[str(i)]["phase"] for i in range(3)] == \
+        [0, 1, 2]
+    assert scheduler.least_loaded_phase(6) == 0
+    assert scheduler.least_loaded_phase(2) == 0
+
+
+def test_priority_order():
+    scheduler = ItemScheduler()
+    scheduler.add("a", Item())
+    scheduler.add("b", Item(), priority=-1)
+    scheduler.add("c", Item())
+    assert [name for name, _ in scheduler.due(0)] == ["b", "a", "c"]
+    scheduler.remove("b")
+    assert [name for name, _ in scheduler.due(0)] == ["a", "c"]
+
+
+def test_frame_costs():
+    scheduler = ItemScheduler()
+    scheduler.add("a", Item(), interval=4)
+    scheduler.add("b", Item(), interval=4)
+    scheduler.add("fixed", Item(), interval=4, phase=1)
+    costs = [0, 0, 0, 0] * 5
+    costs[::4] = [3] * 5  # sweep onsets every 4 frames
+    scheduler.set_frame_costs(costs)
+    schedule = scheduler.package()
+    assert schedule["fixed"]["phase"] == 1
+    assert sorted([schedule["a"]["phase"], schedule["b"]["phase"]]) == [2, 3]
@@ -0,0 +1,75 @@
+"""
+test_telemetry.py
+
+Tests for binary telemetry frames and the background sender.
+
+"""
+import logging
+import threading
+
+import numpy as np
+
+from camstim.zro.telemetry import (TelemetrySender, pack_telemetry,
+                                   unpack_telemetry)
+
+
+def test_pack_unpack():
+    dx = np.linspace(-1, 1, 60).astype(np.float32)
+    data = pack_telemetry(3, 120, 12.5, [[121, 150], []], [[(12.1, 125)]], dx)
+    frame = unpack_telemetry(data)
+    assert frame["index"] == 3
+    assert frame["frame"] == 120
+    assert frame["time"] == 12.5
+    assert frame["licks"].tolist() == [(0, 121), (0, 150)]
+    assert frame["rewards"].tolist() == [(0, 12.1, 125)]
+    assert np.array_equal(frame["encoder"], dx)
+
+
+def test_sender_drops_oldest(caplog):
+    sent = []
+    release = threading.Event()
+
+    def send(item):
+        release.wait(2.0)  # a slow subscriber
+        sent.append(item)
+
+    sender = TelemetrySender(send, max_queued=3)
+    sender.start()
+    sender.put(0)
+    for _ in range(100):  # wait for 0 to be taken off the queue
+        if not sender._queue:
+            break
+        release.wait(0.01)
+    with caplog.at_level(logging.WARNING):
+        for i in range(1, 8):
+            sender.put(i)
+    assert len([r for r in caplog.records if "dropped" in r.getMessage()]) \
+        == 4
+    release.set()
+    sender.stop()
+
+    assert sent == [0, 5, 6, 7]
+    assert sender.dropped == 4
+    assert sender.sent == 4
+
+
+def test_sender_sends_last_after_queue():
+    sent = []
+    threads = set()
+
+    def send(item):
+        threads.add(threading.current_thread())
+        sent.append(item)
+
+    def footer():
+        threads.add(threading.current_thread())
+        sent.append("footer")
+
+    sender = TelemetrySender(send, max_queued=16)
+    sender.start()
+    for i in range(5):
+        sender.put(i)
+    sender.stop(last=footer)
+
+    assert sent == [0, 1, 2, 3, 4, "footer"]
+    assert threads == set([sender._thread])
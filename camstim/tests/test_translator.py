@@ -54,3 +54,53 @@ def test_translate_file(tmpdir, translator):
     new_trials = t.find_trial_logs(exp_data)
     old_trial_log = t.translate_file(path, out_path)
     assert len(new_trials) == len(old_trial_log)
+
+def make_exp_data(n_trials=5, vsyncs=2000):
+    trials = []
+    for i in range(n_trials):
+        trial = dict(NEW_TRIAL, index=i)
+        if i % 2:
+            trial['rewards'] = []
+            trial['licks'] = []
+        trials.append(trial)
+    draw_log = [i % 3 == 0 for i in range(vsyncs)]
+    return {
+        'trial_log': trials,
+        'params': {'mouse_id': 'test'},
+        'update_count': vsyncs,
+        'intervalsms': [16.0] * (vsyncs - 1),
+        'stimuli': {'images': {'draw_log': draw_log}},
+        'encoders': [{'dx': [0.5] * vsyncs}],
+    }
+
+def test_translate_columnar(tmpdir, translator):
+    path = str(tmpdir.join("session.pkl"))
+    with open(path, 'wb') as f:
+        pickle.dump(make_exp_data(), f)
+    legacy_path = str(tmpdir.join("legacy.pkl"))
+    columnar_path = str(tmpdir.join("columnar.pkl"))
+    translator.translate_file(path, legacy_path)
+    translator.translate_file(path, columnar_path, columnar=True)
+    with open(legacy_path, 'rb') as f:
+        legacy = pickle.load(f)
+    with open(columnar_path, 'rb') as f:
+        columnar = pickle.load(f)
+
+    stim_log = columnar['stimuluslog']
+    assert stim_log['frame'].tolist() == [e['frame'] for e in legacy['stimuluslog']]
+    assert stim_log['state'].tolist() == [e['state'] for e in legacy['stimuluslog']]
+    assert columnar['responselog']['frame'].tolist() == \
+        [e['frame'] for e in legacy['responselog']]
+    assert columnar['rewards'].tolist() == legacy['rewards'].tolist()
+    assert list(columnar['dx']) == legacy['dx']
+    assert len(columnar['triallog']) == len(legacy['triallog']) == 5
+
+def test_translate_directory(tmpdir, translator):
+    for name in ("a.pkl", "b.pkl"):
+        with open(str(tmpdir.join(name)), 'wb') as f:
+            pickle.dump(make_exp_data(), f)
+    written = translator.translate_directory(str(tmpdir))
+    assert [os.path.basename(p) for p in written] == ["a_legacy.pkl",
+                                                      "b_legacy.pkl"]
+    # outputs aren't translated again
+    assert len(translator.translate_directory(str(tmpdir))) == 2
@@ -0,0 +1,71 @@
+"""
+test_warpfile.py
+
+Tests for reading and converting warpfiles.
+
+"""
+import numpy as np
+import pytest
+
+from camstim.warpfile import (convert_warpfile, read_warpfile, warp_buffers)
+
+
+def loop_buffers(cols, rows, warpdata):
+    """ Buffers built the way Window.projectionWarpfile used to. """
+    n = (cols - 1) * (rows - 1) * 4
+    vertices = np.zeros((n, 2), dtype='float32')
+    tcoords = np.zeros((n, 2), dtype='float32')
+    opacity = np.ones((n, 4), dtype='float32')
+    vdex = 0
+    for y in xrange(0, rows - 1):
+        for x in xrange(0, cols - 1):
+            index = y * cols + x
+            for i, corner in enumerate([index, index + 1, index + cols + 1,
+                                        index + cols]):
+                vertices[vdex + i] = warpdata[corner, 0:2]
+                tcoords[vdex + i] = warpdata[corner, 2:4]
+                opacity[vdex + i, 3] = warpdata[corner, 4]
+            vdex += 4
+    return vertices, tcoords, opacity
+
+
+@pytest.fixture
+def text_warpfile(tmpdir):
+    cols, rows = 7, 5
+    rng = np.random.RandomState(0)
+    data = np.column_stack([rng.uniform(-1.3, 1.3, (cols * rows, 2)),
+                            rng.uniform(0, 1, (cols * rows, 2)),
+                            rng.uniform(0, 1, cols * rows)])
+    path = str(tmpdir.join("warp.data"))
+    with open(path, 'w') as f:
+        f.write("2\n{} {}\n".format(cols, rows))
+        for row in data:
+            f.write(" ".join("{:.9f}".format(v) for v in row) + "\n")
+    return path
+
+
+def test_warp_buffers(text_warpfile):
+    filetype, cols, rows, data = read_warpfile(text_warpfile)
+    assert (filetype, cols, rows) == (2, 7, 5)
+    assert np.array_equal(data, np.loadtxt(text_warpfile, skiprows=2))
+    expected = loop_buffers(cols, rows, data)
+
+    binary = convert_warpfile(text_warpfile)
+    assert binary.endswith("warp.bin")
+    filetype, cols, rows, mapped = read_warpfile(binary)
+    assert isinstance(mapped, np.memmap)
+    assert (filetype, cols, rows) == (2, 7, 5)
+
+    for buffers in [warp_buffers(cols, rows, data),
+                    warp_buffers(cols, rows, mapped)]:
+        for array, reference in zip(buffers, expected):
+            assert array.dtype == np.float32
+            assert array.tostring() == reference.tostring()
+
+
+def test_truncated_binary_warpfile(text_warpfile):
+    binary = convert_warpfile(text_warpfile)
+    with open(binary, 'r+b') as f:
+        f.truncate(100)
+    with pytest.raises(ValueError):
+        read_warpfile(binary)
@@ -4,20 +4,24 @@ Created on Tue Apr 24 03:35:50 2018
 
 @author: lyra7
 """
+import ctypes
 import logging
 import os
 import time
 
-from PIL import ImageChops
+from PIL import Image, ImageChops
+import pyglet
+GL = pyglet.gl
 from psychopy import logging as logging_psychopy
 from psychopy import event, core
 from psychopy.visual import ElementArrayStim
 from psychopy.tools.arraytools import val2array
-from psychopy.tools.attributetools import attributeSetter, setAttribute
+from psychopy.tools.attributetools import attributeSetter, setAttribute, logAttrib
 
 import numpy as np
 
-from camstim import SweepStim
+from camstim import SweepStim, Stimulus
+from mask_tools import load_display_mask, mask_bbox
 
 def unique_directory(main_path):
     # creates a unique directory and returns path
@@ -59,14 +63,40 @@ def frame_log_freq(n_total):
 
     return freq
 
+def read_frame_region(window_height, x, y, width, height, buffer="back", 
+                      grayscale=False):
+    # reads back a region of the buffer (x, y from the top left), with rows 
+    # from the top, as a (height, width, 3) uint8 RGB array or, if grayscale, 
+    # a (height, width) uint8 array of the red channel alone (all stimuli 
+    # are gray, so the channels are identical).
+
+    GL.glReadBuffer(GL.GL_BACK if buffer == "back" else GL.GL_FRONT)
+    GL.glPixelStorei(GL.GL_PACK_ALIGNMENT, 1)
+    if grayscale:
+        data = np.empty((height, width), dtype=np.uint8)
+        pix_format = GL.GL_RED
+    else:
+        data = np.empty((height, width, 3), dtype=np.uint8)
+        pix_format = GL.GL_RGB
+    GL.glReadPixels(x, window_height - y - height, width, height, 
+        pix_format, GL.GL_UNSIGNED_BYTE, data.ctypes.data_as(ctypes.c_void_p))
+
+    return np.ascontiguousarray(data[::-1])
 
 
 class SweepStimModif(SweepStim):
     def __init__(self, frames_output=False, save_from_frame=0, name="", warp=False, 
-                 set_brightness=True, **kwargs):
+                 set_brightness=True, display_mask=None, grayscale=False, **kwargs):
         """
         Modified camstim sweep stimulus allowing frames to be saved in an on-going way, 
         instead of accumulating in memory.
+
+        If a display_mask is provided (image path or boolean array, see 
+        load_display_mask()), saved frames are cropped to the bounding box of 
+        the visible pixels, and pixels outside the display are set to black.
+
+        If grayscale is True, frames are saved as 8-bit single-channel images, 
+        read back from the red channel (all stimuli are gray).
         """
 
         self._set_brightness = set_brightness
@@ -97,6 +127,24 @@ class SweepStimModif(SweepStim):
             if self.save_from_frame < 0:
                 raise ValueError("self.save_from_frame cannot be negative.")
 
+        # compute the crop once, so only the region within it is read back
+        self.display_mask = display_mask
+        self.grayscale = grayscale
+        self._crop = None
+        self._crop_masked = None
+        if display_mask is not None and self.frames_output:
+            if self.warp:
+                raise ValueError("A display mask cannot be applied to warped frames.")
+            visible = load_display_mask(display_mask, self.window.size)
+            self._crop = mask_bbox(visible)
+            x, y, width, height = self._crop
+            self._crop_masked = ~visible[y : y + height, x : x + width]
+            logging.info("Cropping saved frames to {} x {} pixels.".format(
+                width, height))
+        elif grayscale and self.frames_output:
+            width, height = [int(v) for v in self.window.size]
+            self._crop = (0, 0, width, height)
+
 
     def save_frame(self, frame, warn_final=False):
         """
@@ -117,7 +165,7 @@ class SweepStimModif(SweepStim):
 
         if not os.path.exists(self.frames_list):
             with open(self.frames_list, "w") as f:
-                f.write("# {} frame list".format(self.name))
+                f.write(self._frames_list_header())
 
         if frame % self._log_freq == 0:
             logging.info("At frame {}...".format(frame))
@@ -146,10 +194,13 @@ class SweepStimModif(SweepStim):
                     "from the front buffer. The final frame image recorded will be a "
                     "duplicate of the preceeding frame.")
 
-            self.window.getMovieFrame(buffer=self._save_buffer)
             frame_name = "{}{}{}".format(
                 self.frames_path, frame - self._shift_save, self.frames_ext)
-            self.window.saveMovieFrames(frame_name, fps=self.fps)
+            if self._crop is None:
+                self.window.getMovieFrame(buffer=self._save_buffer)
+                self.window.saveMovieFrames(frame_name, fps=self.fps)
+            else:
+                self._save_cropped_frame(frame_name)
             self._local_frame_name = os.path.split(frame_name)[1]
         
         # record frame name (only once at least one frame image has been saved)
@@ -159,6 +210,43 @@ class SweepStimModif(SweepStim):
 
         # record for later
         self._prev_blank = self.window._is_blank
+
+
+    def _frames_list_header(self):
+        """
+        Returns the frame list header, which records how frames were saved 
+        (comment lines are ignored by ffmpeg).
+        """
+
+        header = "# {} frame list".format(self.name)
+        if self.grayscale:
+            header = ("{}\n# pixel format: gray (8-bit, red channel of the "
+                "RGB frame)").format(header)
+        if self._crop_masked is not None:
+            mask_name = self.display_mask
+            if not isinstance(mask_name, str):
+                mask_name = "array"
+            width, height = [int(v) for v in self.window.size]
+            header = ("{}\n# display mask: {}\n# window size (width, height): "
+                "{}, {}\n# crop (x, y, width, height): {}, {}, {}, {}").format(
+                header, mask_name, width, height, *self._crop)
+
+        return header
+
+
+    def _save_cropped_frame(self, frame_name):
+        """
+        Reads back the cropped region of the frame (the whole frame if there 
+        is no display mask), sets pixels outside the display to black, and 
+        saves it.
+        """
+
+        x, y, width, height = self._crop
+        data = read_frame_region(int(self.window.size[1]), x, y, width, height, 
+            buffer=self._save_buffer, grayscale=self.grayscale)
+        if self._crop_masked is not None:
+            data[self._crop_masked] = 0
+        Image.fromarray(data).save(frame_name)
             
 
     def run(self):
@@ -183,6 +271,8 @@ class SweepStimModif(SweepStim):
             self.update(frame)
             if self.frames_output:
                 self.save_frame(frame)
+                if self.frame_profiler:
+                    self.frame_profiler.mark("save_frame")
             if self._skip_flip:
                 self.window.clearBuffer()
 
@@ -194,12 +284,22 @@ class SweepStimModif(SweepStim):
         Same as self.super._blank_period(), except skips flips 
         if required (e.g., saving frames).
         """
+        profiler = self.frame_profiler
+        if profiler:
+            profiler.start_frame(self.vsynccount)
         self._update_stimuli(frame)
+        if profiler:
+            profiler.mark("stimuli")
         self._update_items(frame)
         if not self._skip_flip:
             self.flip()
+            if profiler:
+                profiler.mark("flip")
         self.vsynccount += 1
-        self._check_keys()
+        if frame % self._check_keys_interval == self._check_keys_phase:
+            self._check_keys()
+            if profiler:
+                profiler.mark("check_keys")
 
 
     def _blank_period(self, frame):
@@ -207,11 +307,19 @@ class SweepStimModif(SweepStim):
         Same as self.super._blank_period(), except skips flips 
         if required (e.g., saving frames).
         """
+        profiler = self.frame_profiler
+        if profiler:
+            profiler.start_frame(self.vsynccount)
         self._update_items(frame)
         if not self._skip_flip:
             self.flip()
+            if profiler:
+                profiler.mark("flip")
         self.vsynccount += 1
-        self._check_keys()
+        if frame % self._check_keys_interval == self._check_keys_phase:
+            self._check_keys()
+            if profiler:
+                profiler.mark("check_keys")
 
 
     def printFrameInfo(self):
@@ -243,6 +351,8 @@ class SweepStimModif(SweepStim):
             self._blank_period(frame)
             if self.frames_output:
                 self.save_frame(frame + last_frame + 1) 
+                if self.frame_profiler:
+                    self.frame_profiler.mark("save_frame")
             if self._skip_flip:
                 self.window.clearBuffer()
         
@@ -265,6 +375,78 @@ class SweepStimModif(SweepStim):
             logging.warning("Not setting screen brightness or contrast.")
 
 
+class PrefetchStimulus(Stimulus):
+    """
+    Camstim stimulus that computes the next sweep's state ahead of time, on 
+    the idle frames of the current sweep, and swaps it in at the transition. 
+    This keeps sampling work off the sweep onset frames.
+
+    The psychopy stimulus must implement prefetchSweep(params) and 
+    applyPrefetched() (see CredAssignStims). To keep RNG draws in the same 
+    order, the next sweep is only prefetched if it starts within 
+    max_gap_sweeps sweep lengths (plus the blank length), so that no other 
+    stimulus can be displayed (and draw from a shared RNG) in between.
+    """
+
+    def __init__(self, psychopy_stimulus, sweep_params, sweep_length, 
+                 max_gap_sweeps=1, **kwargs):
+
+        super(PrefetchStimulus, self).__init__(
+            psychopy_stimulus, sweep_params, sweep_length, **kwargs)
+
+        self.max_gap_sweeps = max_gap_sweeps
+        self._prefetch_frame = None # frame at which prefetched sweep starts
+        self._prefetch_checked = None # last sweep for which prefetch was checked
+
+
+    def update(self, frame):
+        """
+        Same as self.super.update(), except applies prefetched sweep states 
+        at sweep transitions, and prefetches the next sweep during the 
+        current one.
+        """
+        try:
+            sweep_number = self.frame_list[frame]
+        except IndexError:
+            sweep_number = -1 # stimulus finished
+
+        if sweep_number == -1 or sweep_number == self._current_sweep:
+            super(PrefetchStimulus, self).update(frame)
+            if sweep_number != -1:
+                self._prefetch_next(frame, sweep_number)
+        elif self._prefetch_frame == frame:
+            # new, prefetched sweep
+            self.current_frame = frame
+            self.stim.applyPrefetched()
+            self._prefetch_frame = None
+            self._current_sweep = sweep_number
+            self.draw()
+        else:
+            super(PrefetchStimulus, self).update(frame)
+
+
+    def _prefetch_next(self, frame, sweep_number):
+        """
+        Prefetches the next sweep, if it directly follows the current one.
+        Checked once per sweep.
+        """
+        if self._prefetch_checked == sweep_number:
+            return
+        self._prefetch_checked = sweep_number
+
+        max_frames = int(self.fps * (self.sweep_length * (1 + self.max_gap_sweeps) 
+            + self.blank_length)) + 1
+        ahead = self.frame_list[frame + 1 : frame + 1 + max_frames]
+        starts = np.where((ahead != -1) & (ahead != sweep_number))[0]
+        if len(starts) == 0:
+            return
+
+        next_frame = frame + 1 + starts[0]
+        params = dict(zip(self.dimnames, self.sweep_table[ahead[starts[0]]]))
+        self.stim.prefetchSweep(params)
+        self._prefetch_frame = next_frame
+
+
 class CredAssignStims(ElementArrayStim):
     """
     Stimulus class for Credit Assignment project Gabors and Bricks stimuli.
@@ -299,6 +481,8 @@ class CredAssignStims(ElementArrayStim):
             
             self._printed = False # useful for printing things once     
             self._stim_updated = True # used to initiate any new draws
+            self._prefetched = None # next sweep state (see prefetchSweep)
+            self._vertexOffsets = None # element corners (see _updateVertices)
             
             self.elemParams = elemParams
             
@@ -438,6 +622,57 @@ class CredAssignStims(ElementArrayStim):
         # compile orientations at every sweep (as int16)
         self.orisByImg.extend([np.around(self.oris).astype(np.int16)])
         
+    def prefetchSweep(self, params):
+        """Computes the state that setOriSurp and setPosSizesAll would set for 
+        a sweep (params: dict of sweep param values), without applying it. 
+        Draws from the RNG in exactly the same order as the setters, so 
+        applying it with applyPrefetched() gives identical stimuli, as long as 
+        nothing else draws from the RNG in between.
+        """
+
+        orimu, surp = params["OriSurp"]
+        combo = params["PosSizesAll"]
+
+        # orientations sampled (and logged) by setOriSurp
+        logged_oris = self._sampleOris(orimu)
+        if np.isscalar(logged_oris):
+            logged_oris = np.ones(self.nElements) * logged_oris
+
+        # orientations resampled by setPosSizesAll
+        if surp == 1 and combo == 3:
+            pos, sizes = self.possizes[4]
+            orimu = (orimu + 90)%360
+        else:
+            pos, sizes = self.possizes[combo]
+        
+        self._prefetched = {
+            "orimu": orimu, 
+            "surp": surp, 
+            "logged_oris": np.around(logged_oris).astype(np.int16),
+            "pos": pos,
+            "sizes": sizes,
+            "sfs": self._getSFs(sizes),
+            "oris": self._sampleOris(orimu),
+            }
+
+    def applyPrefetched(self):
+        """Applies the state computed by prefetchSweep(), in place of calling 
+        setOriSurp and setPosSizesAll.
+        """
+
+        prefetched = self._prefetched
+        self._prefetched = None
+
+        self._orimu = prefetched["orimu"]
+        self._surp = prefetched["surp"]
+        self.orisByImg.extend([prefetched["logged_oris"]])
+
+        self.setXYs(prefetched["pos"])
+        self.setSizes(prefetched["sizes"])
+        if prefetched["sfs"] is not None:
+            self.setSfs(prefetched["sfs"])
+        self.setOris(prefetched["oris"])
+        self._stim_updated = True
         
     def setOriKappa(self, ori_kappa, operation="", log=None):
         """Not used internally, but just to allow new sets of orientations to 
@@ -453,17 +688,22 @@ class CredAssignStims(ElementArrayStim):
         """Initialize new sets of orientations based on parameters using sweeps.
         No need to pass anything as long as self._orimu and self._orikappa are up to date.
         """
-        if self._orikappa is None: # no dispersion
-            ori_array = self._orimu
-        else:
-            if self.rng is not None:
-                ori_array_rad = self.rng.vonmises(np.deg2rad(self._orimu), self._orikappa, self.nElements)
-            else:
-                ori_array_rad = np.random.vonmises(np.deg2rad(self._orimu), self._orikappa, self.nElements)
-            ori_array = np.rad2deg(ori_array_rad)
+        ori_array = self._sampleOris(self._orimu)
         
         self.setOris(ori_array, operation, log)
         self._stim_updated = True
+
+    def _sampleOris(self, orimu):
+        # sample orientations (deg) around orimu (deg)
+        if self._orikappa is None: # no dispersion
+            return orimu
+        
+        if self.rng is not None:
+            ori_array_rad = self.rng.vonmises(np.deg2rad(orimu), self._orikappa, self.nElements)
+        else:
+            ori_array_rad = np.random.vonmises(np.deg2rad(orimu), self._orikappa, self.nElements)
+        
+        return np.rad2deg(ori_array_rad)
     
     def setSizesAll(self, sizes, operation="", log=None):
         """Set new sizes.
@@ -476,16 +716,23 @@ class CredAssignStims(ElementArrayStim):
     
     def _adjustSF(self, sizes):
         # update spatial frequency to fit with set nbr of visible cycles
-                
+        
+        sfs = self._getSFs(sizes)
+        if sfs is not None:
+            self.setSfs(sfs)
+
+    def _getSFs(self, sizes):
+        # get spatial frequencies for sizes (None if they are not adjusted)
+        sfs = None
         if self._cyc is not None:
             sfs = self._cyc/sizes
-            self.setSfs(sfs)
         
         # if units are pixels, assume sf was provided to elementarray as cyc/pix, 
         # update spatial frequency cyc/stim_wid (which is what elementarray expects)
         if self.sf is not None and self.units == "pix":
             sfs = [self.sf * x for x in sizes]
-            self.setSfs(sfs)
+        
+        return sfs
             
             
     def setSizeParams(self, size_params, operation="", log=None):
@@ -697,7 +944,29 @@ class CredAssignStims(ElementArrayStim):
         if dead.any():
             self._coords[dead,:] = self._newStimsXY(sum(dead))
         
-        self.setXYs(self._coords)
+        self._moveVertices()
+
+    def _moveVertices(self):
+        """
+        Sets xys to self._coords by translating the existing vertex array in 
+        place, instead of having ElementArrayStim rebuild every vertex from 
+        sizes and oris on the next draw. Falls back on setXYs if the vertices 
+        are already due for a rebuild (e.g., sizes or oris changed).
+        """
+        
+        verts = self.__dict__.get("verticesPix")
+        xys = self.__dict__.get("xys")
+        if (self._needVertexUpdate or self._vertexOffsets is None or 
+            verts is None or xys is None or xys.shape != self._coords.shape):
+            self.setXYs(self._coords)
+            return
+        
+        xys[:] = self._coords
+        # same sum as pix conversion in ElementArrayStim._updateVertices
+        positions = xys + self.fieldPos
+        np.add(self._vertexOffsets, positions[:, np.newaxis], 
+               out=verts[:, :, :2])
+        logAttrib(self, log=None, attrib="xys", value=self._coords)
 
     def _update_stim_speed(self, signal=None):        
         # flip speed (i.e., direction) if needed
@@ -769,6 +1038,37 @@ class CredAssignStims(ElementArrayStim):
         self.sizes = sizes
     
     
+    def _updateVertices(self):
+        """
+        Rebuilds verticesPix (see ElementArrayStim) and keeps the corner 
+        offsets of each element, so that _moveVertices can translate the 
+        vertices in place while sizes and oris are unchanged.
+        """
+        
+        super(CredAssignStims, self)._updateVertices()
+        
+        if self.units not in ["pix", "pixels"]: # vertices not simply offset
+            self._vertexOffsets = None
+            return
+        
+        # corner offsets, as computed in ElementArrayStim._updateVertices
+        radians = 0.017453292519943295
+        wx = -self.sizes[:,0]*np.cos(self.oris[:]*radians)/2
+        wy = self.sizes[:,0]*np.sin(self.oris[:]*radians)/2
+        hx = self.sizes[:,1]*np.sin(self.oris[:]*radians)/2
+        hy = self.sizes[:,1]*np.cos(self.oris[:]*radians)/2
+        
+        offsets = np.empty([self.nElements, 4, 2])
+        offsets[:,0,0] = -wx - hx
+        offsets[:,1,0] = +wx - hx
+        offsets[:,2,0] = +wx + hx
+        offsets[:,3,0] = -wx + hx
+        offsets[:,0,1] = -wy - hy
+        offsets[:,1,1] = +wy - hy
+        offsets[:,2,1] = +wy + hy
+        offsets[:,3,1] = -wy + hy
+        self._vertexOffsets = offsets
+    
     def draw(self, win=None):
         """Draw the stimulus in its relevant window. You must call
         this method after every MyWin.flip() if you want the
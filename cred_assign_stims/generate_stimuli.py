@@ -76,7 +76,8 @@ def check_reproduce(monitor, fullscreen=False, raise_error=False):
 
 
 def generate_stimuli(session_params, seed=None, save_frames="", save_directory=".", 
-                     monitor=None, fullscreen=False, warp=False, save_from_frame=0):
+                     monitor=None, fullscreen=False, warp=False, save_from_frame=0, 
+                     display_mask=None, grayscale=False):
     """
     generate_stimuli(session_params)
 
@@ -102,6 +103,14 @@ def generate_stimuli(session_params, seed=None, save_frames="", save_directory="
                                  default: False
         - save_from_frame (int): Frame as of which to start saving frames, if saving
                                  default: 0
+        - display_mask (str)   : Path to a display mask image (e.g., 
+                                 example_videos/display_mask.png). If provided, 
+                                 saved frames are cropped to the display, and 
+                                 out-of-frame pixels are set to black.
+                                 default: None
+        - grayscale (bool)     : If True, frames are saved as 8-bit single-channel 
+                                 images.
+                                 default: False
     """
 
     # Record orientations of gabors at each sweep (LEAVE AS TRUE)
@@ -190,6 +199,8 @@ def generate_stimuli(session_params, seed=None, save_frames="", save_directory="
         save_from_frame=save_from_frame,
         name=session_params["seed"],
         warp=warp,
+        display_mask=display_mask,
+        grayscale=grayscale,
         set_brightness=False # skip setting brightness
         )
 
@@ -0,0 +1,55 @@
+# -*- coding: utf-8 -*-
+"""
+Display mask helpers for cropping saved frames to the visible part of the
+display.
+"""
+import numpy as np
+
+def load_display_mask(display_mask, size):
+    # loads a display mask as a boolean array that is True where the display 
+    # is visible. display_mask is either an image, which is visible where it 
+    # is transparent (e.g., example_videos/display_mask.png) or, without an 
+    # alpha channel, where it is not black, or a boolean array (e.g., from 
+    # allensdk's make_display_mask()).
+
+    if isinstance(display_mask, np.ndarray):
+        visible = display_mask.astype(bool)
+    else:
+        from PIL import Image # only needed for image files
+        image = np.asarray(Image.open(display_mask))
+        if image.ndim == 3 and image.shape[2] in [2, 4]:
+            visible = (image[..., -1] == 0)
+        elif image.ndim == 3:
+            visible = image.any(axis=2)
+        else:
+            visible = (image > 0)
+
+    width, height = [int(v) for v in size]
+    if visible.shape != (height, width):
+        raise ValueError("Display mask shape {} does not match window size "
+            "{}.".format(visible.shape, (height, width)))
+    if not visible.any():
+        raise ValueError("Display mask does not show any pixels.")
+
+    return visible
+
+def mask_bbox(visible, even=True):
+    # returns bounding box (x, y, width, height) of visible pixels, from the 
+    # top left. If even, width and height are grown by a pixel where needed 
+    # (within the mask) to be even, as video encoders require for yuv420p.
+
+    rows = np.flatnonzero(visible.any(axis=1))
+    cols = np.flatnonzero(visible.any(axis=0))
+    x, y = int(cols[0]), int(rows[0])
+    width, height = int(cols[-1] - x + 1), int(rows[-1] - y + 1)
+
+    if even:
+        full_height, full_width = visible.shape
+        if width % 2 and width < full_width:
+            width += 1
+            x = min(x, full_width - width) # grow left at the right edge
+        if height % 2 and height < full_height:
+            height += 1
+            y = min(y, full_height - height) # grow up at the bottom edge
+
+    return x, y, width, height
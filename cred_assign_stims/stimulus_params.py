@@ -5,7 +5,7 @@ import itertools
 import time
 
 from camstim import Stimulus
-from cred_assign_stims import CredAssignStims
+from cred_assign_stims import CredAssignStims, PrefetchStimulus
 
 """ Functions to initialize parameters for Gabors or Squares, and present and record stimuli.
 
@@ -476,14 +476,16 @@ def init_gabors(window, session_params, recordOris, gabor_params=GABOR_PARAMS):
     # Add these attributes for the logs
     gabors.gabor_params = gabor_params
     
-    gb = Stimulus(gabors,
-                  sweepPar,
-                  sweep_length=gabor_params["im_len"], 
-                  blank_sweeps=gabor_params["n_im"], # present a blank screen after every set of images
-                  start_time=0.0,
-                  runs=1,
-                  shuffle=False,
-                  )
+    # next image's orientations, positions and sizes are computed ahead of 
+    # time, off the image onset frames
+    gb = PrefetchStimulus(gabors,
+                          sweepPar,
+                          sweep_length=gabor_params["im_len"], 
+                          blank_sweeps=gabor_params["n_im"], # present a blank screen after every set of images
+                          start_time=0.0,
+                          runs=1,
+                          shuffle=False,
+                          )
     
     # record attributes from CredAssignStims
     if recordOris: # potentially large array
@@ -0,0 +1,47 @@
+"""
+test_mask_tools.py
+
+Tests for the display mask crop used when saving frames.
+
+"""
+import os
+
+import numpy as np
+import pytest
+
+from cred_assign_stims.mask_tools import load_display_mask, mask_bbox
+
+DISPLAY_MASK = os.path.join(os.path.dirname(__file__), "..", "..",
+                            "example_videos", "display_mask.png")
+
+
+def test_display_mask_bbox():
+    pytest.importorskip("PIL")
+    visible = load_display_mask(DISPLAY_MASK, (1920, 1200))
+    assert visible.shape == (1200, 1920)
+    assert mask_bbox(visible, even=False) == (374, 143, 1173, 914)
+    x, y, width, height = mask_bbox(visible)
+    assert (x, y, width, height) == (374, 143, 1174, 914)
+    assert visible[y:y + height, x:x + width].sum() == visible.sum()
+
+
+def test_mask_bbox_even():
+    visible = np.zeros((10, 12), dtype=bool)
+    visible[3:6, 2:5] = True
+    assert mask_bbox(visible) == (2, 3, 4, 4)
+    # grows towards the inside at the edges
+    visible = np.zeros((10, 12), dtype=bool)
+    visible[7:, 9:] = True
+    assert mask_bbox(visible) == (8, 6, 4, 4)
+    # unless the mask itself is odd
+    assert mask_bbox(np.ones((5, 7), dtype=bool)) == (0, 0, 7, 5)
+
+
+def test_load_display_mask_array():
+    visible = np.zeros((4, 6), dtype=np.uint8)
+    visible[1, 2] = 1
+    assert load_display_mask(visible, (6, 4)).dtype == bool
+    with pytest.raises(ValueError):
+        load_display_mask(visible, (4, 6))
+    with pytest.raises(ValueError):
+        load_display_mask(np.zeros((4, 6)), (6, 4))
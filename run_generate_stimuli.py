@@ -142,7 +142,8 @@ def run_generate_stimuli(args):
         generate_stimuli(session_params, seed=seed, save_frames=args.save_frames, 
             save_directory=args.save_directory, monitor=monitor, 
             fullscreen=args.fullscreen, warp=args.warp, 
-            save_from_frame=args.save_from_frame)
+            save_from_frame=args.save_from_frame, display_mask=args.display_mask, 
+            grayscale=args.grayscale)
 
 
 if __name__ == "__main__":
@@ -177,6 +178,11 @@ if __name__ == "__main__":
         help="Format for saving stimulus frames (jpg, png, tif).")
     parser.add_argument("--save_from_frame", default=0, type=int,
         help="Frame from which to start saving, if saving.")
+    parser.add_argument("--display_mask", default=None, 
+        help="Display mask image applied to saved frames, which are cropped "
+        "to the display (e.g., example_videos/display_mask.png).")
+    parser.add_argument("--grayscale", action="store_true", 
+        help="Save frames as 8-bit single-channel (grayscale) images.")
 
     args = parser.parse_args()
 